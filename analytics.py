@@ -0,0 +1,320 @@
+"""Per-user analytics: integer-coded counting kernels and incremental state
+
+AnalyticsState folds a user's emotion_history into counters keyed by UTC
+day, so any whole-day date range and emotion filter is answered from the
+counters alone, with the same numbers the $facet aggregation in
+database.get_emotion_analytics gives. The state remembers the
+(timestamp, _id) of the last detection it folded; later visits fold only
+detections after that high-water mark.
+
+Transitions count consecutive detections (in (timestamp, _id) order) that
+fall on the same day, keyed by the day; with an emotion filter, only pairs
+whose two emotions are both selected are kept.
+
+The kernels work on integer arrays only: text columns are mapped to codes
+through a shared CodeBook, timestamps to day and hour numbers, and every
+breakdown is one np.bincount over a combined integer key.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from storage.base import WEEKDAY_NAMES
+
+MS_PER_HOUR = 3600 * 1000
+MS_PER_DAY = 24 * MS_PER_HOUR
+# Largest key space counted with np.bincount; sparser keys are sorted instead
+BINCOUNT_MAX_BINS = 1 << 22
+
+# Bump when the counters change meaning; stored states of older versions are rebuilt
+ANALYTICS_STATE_VERSION = 1
+
+# Columns folded into the state (see storage.base.frame_from_batches)
+ANALYTICS_FRAME_SCHEMA = {
+    '_id': 'str',
+    'timestamp': 'datetime',
+    'emotion': 'category',
+    'language': 'category',
+    'singer': 'category'
+}
+
+def _add(counts: Dict, key, n: int):
+    counts[key] = counts.get(key, 0) + n
+
+class CodeBook:
+    """Shared value -> integer code dictionary; code 0 stands for a missing value"""
+
+    def __init__(self):
+        self.values = [None]
+        self.codes = {None: 0}
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def encode(self, column: pd.Series) -> np.ndarray:
+        """Codes of a column; only its distinct values go through Python"""
+        if not isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype('category')
+        local = np.zeros(len(column.cat.categories) + 1, dtype=np.int32)
+        for i, value in enumerate(column.cat.categories, start=1):
+            code = self.codes.get(value)
+            if code is None:
+                code = self.codes[value] = len(self.values)
+                self.values.append(value)
+            local[i] = code
+        # Categorical codes are -1 for missing, which lands on local[0] == 0
+        return local[column.cat.codes.to_numpy() + 1]
+
+def count_keys(keys: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Distinct keys in [0, size) and how often each occurs"""
+    if size <= BINCOUNT_MAX_BINS:
+        counts = np.bincount(keys, minlength=size)
+        present = np.flatnonzero(counts)
+        return present, counts[present]
+    return np.unique(keys, return_counts=True)
+
+def time_codes(timestamps: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Days since the epoch and hour of day of datetime64[ms] timestamps"""
+    ms = timestamps.to_numpy().astype('datetime64[ms]').astype(np.int64)
+    return ms // MS_PER_DAY, (ms // MS_PER_HOUR) % 24
+
+def day_names(days: np.ndarray) -> List[str]:
+    return list(np.asarray(days, dtype='datetime64[D]').astype(str))
+
+def weekday_codes(days: np.ndarray) -> np.ndarray:
+    """Indexes into WEEKDAY_NAMES (Sunday first); 1970-01-01 was a Thursday"""
+    return (days + 4) % 7
+
+class AnalyticsArrays:
+    """Analytics breakdowns as compact count arrays, accumulated chunk by chunk
+
+    hour_emotion is 24 x emotions, weekday_emotion 7 x emotions (Sunday
+    first), daily counts detections per day from first_day, and the
+    language and singer arrays count per code; column i of every emotion
+    axis is emotions.values[i].
+    """
+
+    def __init__(self):
+        self.emotions = CodeBook()
+        self.languages = CodeBook()
+        self.singers = CodeBook()
+        self.hour_emotion = np.zeros((24, 1), dtype=np.int64)
+        self.weekday_emotion = np.zeros((7, 1), dtype=np.int64)
+        self.emotion_counts = np.zeros(1, dtype=np.int64)
+        self.language_counts = np.zeros(1, dtype=np.int64)
+        self.singer_counts = np.zeros(1, dtype=np.int64)
+        self.first_day = None
+        self.daily = np.zeros(0, dtype=np.int64)
+
+    def add(self, frame: pd.DataFrame):
+        """Count a chunk with timestamp, emotion, language and singer columns"""
+        if frame.empty:
+            return
+        emotion = self.emotions.encode(frame['emotion'])
+        language = self.languages.encode(frame['language'])
+        singer = self.singers.encode(frame['singer'])
+        days, hours = time_codes(frame['timestamp'])
+        n = len(self.emotions)
+
+        self.hour_emotion = _grow(self.hour_emotion, n)
+        self.hour_emotion += np.bincount(hours * n + emotion, minlength=24 * n).reshape(24, n)
+        self.weekday_emotion = _grow(self.weekday_emotion, n)
+        self.weekday_emotion += np.bincount(weekday_codes(days) * n + emotion, minlength=7 * n).reshape(7, n)
+        self.emotion_counts = _grow(self.emotion_counts, n)
+        self.emotion_counts += np.bincount(emotion, minlength=n)
+        self.language_counts = _grow(self.language_counts, len(self.languages))
+        self.language_counts += np.bincount(language, minlength=len(self.languages))
+        self.singer_counts = _grow(self.singer_counts, len(self.singers))
+        self.singer_counts += np.bincount(singer, minlength=len(self.singers))
+
+        first, last = int(days.min()), int(days.max())
+        if self.first_day is None:
+            self.first_day = first
+        if first < self.first_day:
+            self.daily = np.concatenate([np.zeros(self.first_day - first, dtype=np.int64), self.daily])
+            self.first_day = first
+        self.daily = _grow(self.daily, last - self.first_day + 1)
+        self.daily += np.bincount(days - self.first_day, minlength=len(self.daily))
+
+    def days(self) -> np.ndarray:
+        """Dates of the daily counts"""
+        start = np.datetime64(self.first_day or 0, 'D')
+        return start + np.arange(len(self.daily))
+
+    def to_result(self) -> Dict:
+        """The arrays in database.get_emotion_analytics' result shape"""
+        emotions = self.emotions.values
+        hours, hour_emotions = np.nonzero(self.hour_emotion)
+        weekdays, weekday_emotions = np.nonzero(self.weekday_emotion)
+        daily = np.flatnonzero(self.daily)
+
+        def top(book, counts, n=None):
+            # Missing values (code 0) are not counted, as in the aggregation
+            order = np.argsort(-counts[1:], kind='stable')[:n] + 1
+            return {book.values[i]: int(counts[i]) for i in order if counts[i]}
+
+        by_emotion = np.argsort(-self.emotion_counts, kind='stable')
+        return {
+            "total_detections": int(self.emotion_counts.sum()),
+            "emotion_counts": {emotions[i]: int(self.emotion_counts[i]) for i in by_emotion
+                               if self.emotion_counts[i]},
+            "daily_counts": list(zip(day_names(self.days()[daily]), self.daily[daily].tolist())),
+            "hourly": [{"hour": int(h), "emotion": emotions[e], "count": int(self.hour_emotion[h, e])}
+                       for h, e in zip(hours, hour_emotions)],
+            "weekday": [{"weekday": WEEKDAY_NAMES[w], "emotion": emotions[e],
+                         "count": int(self.weekday_emotion[w, e])}
+                        for w, e in zip(weekdays, weekday_emotions)],
+            "language_counts": top(self.languages, self.language_counts, 10),
+            "singer_counts": top(self.singers, self.singer_counts, 10)
+        }
+
+def _grow(counts: np.ndarray, size: int) -> np.ndarray:
+    """counts padded with zeros along its last axis to size"""
+    missing = size - counts.shape[-1]
+    if missing <= 0:
+        return counts
+    pad = [(0, 0)] * (counts.ndim - 1) + [(0, missing)]
+    return np.pad(counts, pad)
+
+class AnalyticsState:
+    def __init__(self):
+        self.hours = {}         # (day, hour, emotion) -> detections
+        self.languages = {}     # (day, emotion, language) -> detections
+        self.singers = {}       # (day, emotion, singer) -> detections
+        self.transitions = {}   # (day, from emotion, to emotion) -> pairs
+        self.high_water = None  # (timestamp, _id) of the last folded detection
+        self.last = None        # (day, emotion) of that detection
+
+    def fold(self, frame: pd.DataFrame):
+        """Add detections newer than the high-water mark, sorted by (timestamp, _id)"""
+        if frame.empty:
+            return
+        book = CodeBook()
+        emotion = book.encode(frame['emotion'])
+        days, hours = time_codes(frame['timestamp'])
+        first_day = int(days.min())
+        day = days - first_day
+        n_days, n = int(day.max()) + 1, len(book)
+        day_labels = day_names(np.arange(first_day, first_day + n_days))
+
+        keys, counts = count_keys((day * 24 + hours) * n + emotion, n_days * 24 * n)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            key, e = divmod(key, n)
+            d, hour = divmod(key, 24)
+            _add(self.hours, (day_labels[d], hour, book.values[e]), count)
+
+        for field, counts_by_key in (('language', self.languages), ('singer', self.singers)):
+            values = CodeBook()
+            value = values.encode(frame[field])
+            present = value > 0
+            m = len(values)
+            keys, counts = count_keys(((day * n + emotion) * m + value)[present], n_days * n * m)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                key, v = divmod(key, m)
+                d, e = divmod(key, n)
+                _add(counts_by_key, (day_labels[d], book.values[e], values.values[v]), count)
+
+        # Pair each detection with the one before it, the first with the last folded one
+        if self.last is not None:
+            last_day = int(np.datetime64(self.last[0], 'D').astype(np.int64)) - first_day
+            last_emotion = book.codes.get(self.last[1])
+            if last_emotion is None:
+                last_emotion = book.codes[self.last[1]] = len(book.values)
+                book.values.append(self.last[1])
+                n = len(book)
+        else:
+            last_day, last_emotion = -1, 0
+        previous_day = np.concatenate([[last_day], day[:-1]])
+        previous_emotion = np.concatenate([[last_emotion], emotion[:-1]])
+        same_day = previous_day == day
+        keys, counts = count_keys(((day * n + previous_emotion) * n + emotion)[same_day], n_days * n * n)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            key, target = divmod(key, n)
+            d, source = divmod(key, n)
+            _add(self.transitions, (day_labels[d], book.values[source], book.values[target]), count)
+
+        last = frame.iloc[-1]
+        self.high_water = (last['timestamp'].to_pydatetime(), last['_id'])
+        self.last = (day_labels[day[-1]], book.values[emotion[-1]])
+
+    def truncate(self, day: str):
+        """Forget every day from day on; the caller refolds from the detection before it"""
+        for counts in (self.hours, self.languages, self.singers, self.transitions):
+            for key in [key for key in counts if key[0] >= day]:
+                del counts[key]
+        self.high_water = None
+        self.last = None
+
+    def drop_before(self, day: str):
+        """Forget days before day (moved to the archive)"""
+        for counts in (self.hours, self.languages, self.singers, self.transitions):
+            for key in [key for key in counts if key[0] < day]:
+                del counts[key]
+
+    def counters(self, start_day: str = None, end_day: str = None,
+                 emotion_filter: List[str] = None) -> Dict:
+        """Counters for days in [start_day, end_day], in database.get_emotion_analytics' layout"""
+        wanted = set(emotion_filter) if emotion_filter else None
+
+        def selected(day, emotion):
+            return ((start_day is None or day >= start_day) and (end_day is None or day <= end_day)
+                    and (wanted is None or emotion in wanted))
+
+        result = {name: {} for name in ('emotions', 'daily', 'hourly', 'weekday', 'languages', 'singers')}
+        weekdays = {}
+        for (day, hour, emotion), n in self.hours.items():
+            if not selected(day, emotion):
+                continue
+            if day not in weekdays:
+                weekdays[day] = WEEKDAY_NAMES[(datetime.strptime(day, '%Y-%m-%d').weekday() + 1) % 7]
+            _add(result['emotions'], emotion, n)
+            _add(result['daily'], day, n)
+            _add(result['hourly'], (hour, emotion), n)
+            _add(result['weekday'], (weekdays[day], emotion), n)
+        for field, counts in (('languages', self.languages), ('singers', self.singers)):
+            for (day, emotion, value), n in counts.items():
+                if selected(day, emotion):
+                    _add(result[field], value, n)
+        return result
+
+    def transition_counts(self, start_day: str = None, end_day: str = None,
+                          emotion_filter: List[str] = None) -> Dict[Tuple[str, str], int]:
+        wanted = set(emotion_filter) if emotion_filter else None
+        counts = {}
+        for (day, source, target), n in self.transitions.items():
+            if (start_day is None or day >= start_day) and (end_day is None or day <= end_day) \
+                    and (wanted is None or (source in wanted and target in wanted)):
+                _add(counts, (source, target), n)
+        return counts
+
+    def copy(self) -> "AnalyticsState":
+        state = AnalyticsState()
+        state.hours, state.languages = dict(self.hours), dict(self.languages)
+        state.singers, state.transitions = dict(self.singers), dict(self.transitions)
+        state.high_water, state.last = self.high_water, self.last
+        return state
+
+    def to_document(self) -> Dict:
+        return {
+            "version": ANALYTICS_STATE_VERSION,
+            "high_water": list(self.high_water) if self.high_water else None,
+            "last": list(self.last) if self.last else None,
+            "hours": [list(key) + [n] for key, n in self.hours.items()],
+            "languages": [list(key) + [n] for key, n in self.languages.items()],
+            "singers": [list(key) + [n] for key, n in self.singers.items()],
+            "transitions": [list(key) + [n] for key, n in self.transitions.items()]
+        }
+
+    @classmethod
+    def from_document(cls, doc: Optional[Dict]) -> "AnalyticsState":
+        """A stored state, or an empty one if doc is missing or of another version"""
+        state = cls()
+        if not doc or doc.get("version") != ANALYTICS_STATE_VERSION:
+            return state
+        for name in ('hours', 'languages', 'singers', 'transitions'):
+            setattr(state, name, {tuple(row[:-1]): row[-1] for row in doc.get(name, [])})
+        state.high_water = tuple(doc["high_water"]) if doc.get("high_water") else None
+        state.last = tuple(doc["last"]) if doc.get("last") else None
+        return state
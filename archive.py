@@ -0,0 +1,189 @@
+"""Columnar archive of old emotion history
+
+One compressed .npz file per user and month under ARCHIVE_DIR. Columns are
+stored as NumPy arrays (timestamps as epoch milliseconds, text columns as
+category codes plus a category table), so a month loads without pickling
+and without per-document dicts. ARCHIVE_DIR must be shared by every worker.
+"""
+import os
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+from storage.base import frame_from_batches
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Whole months older than this many days are moved out of emotion_history
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+
+# Columns kept for archived detections (see storage.base.frame_from_batches)
+ARCHIVE_SCHEMA = {
+    '_id': 'str',
+    'timestamp': 'datetime',
+    'emotion': 'category',
+    'language': 'category',
+    'singer': 'category',
+    'confidence': 'float'
+}
+
+def month_key(timestamp: datetime) -> str:
+    return timestamp.strftime('%Y-%m')
+
+def month_bounds(month: str) -> Tuple[datetime, datetime]:
+    """[start, end) of a 'YYYY-MM' month"""
+    start = datetime.strptime(month, '%Y-%m')
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start, end
+
+class HistoryArchive:
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = directory
+
+    def _user_dir(self, username: str) -> str:
+        return os.path.join(self.directory, quote(username, safe=''))
+
+    def _path(self, username: str, month: str) -> str:
+        return os.path.join(self._user_dir(username), f"{month}.npz")
+
+    def users(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.directory))
+
+    def months(self, username: str) -> List[str]:
+        """Archived months of a user, oldest first"""
+        user_dir = self._user_dir(username)
+        if not os.path.isdir(user_dir):
+            return []
+        return sorted(name[:-4] for name in os.listdir(user_dir) if name.endswith('.npz'))
+
+    def read_month(self, username: str, month: str) -> pd.DataFrame:
+        """One archived month as a DataFrame sorted by (timestamp, _id)"""
+        path = self._path(username, month)
+        if not os.path.exists(path):
+            return _empty_frame()
+        with np.load(path, allow_pickle=False) as data:
+            columns = {}
+            for field, kind in ARCHIVE_SCHEMA.items():
+                if kind == 'category':
+                    columns[field] = pd.Categorical.from_codes(
+                        data[f"{field}_codes"], categories=list(data[f"{field}_categories"])
+                    )
+                elif kind == 'datetime':
+                    columns[field] = data[field].astype('datetime64[ms]')
+                elif kind == 'str':
+                    columns[field] = data[field].astype(object)
+                else:
+                    columns[field] = data[field]
+        return pd.DataFrame(columns)
+
+    def write_month(self, username: str, month: str, frame: pd.DataFrame) -> pd.DataFrame:
+        """Merge frame into the month's file (deduplicating on _id); returns the merged month"""
+        frame = frame.assign(_id=frame['_id'].astype(str))
+        existing = self.read_month(username, month)
+        if not existing.empty:
+            frame = pd.concat([existing.astype({f: object for f in _text_fields()}),
+                               frame.astype({f: object for f in _text_fields()})], ignore_index=True)
+            frame = frame.drop_duplicates('_id', keep='last')
+        frame = frame.sort_values(['timestamp', '_id'], ignore_index=True)
+
+        arrays = {}
+        for field, kind in ARCHIVE_SCHEMA.items():
+            column = frame[field]
+            if kind == 'category':
+                codes, categories = pd.factorize(column, use_na_sentinel=True)
+                arrays[f"{field}_codes"] = codes.astype(np.int32)
+                arrays[f"{field}_categories"] = np.array([str(c) for c in categories], dtype=str)
+            elif kind == 'datetime':
+                arrays[field] = column.values.astype('datetime64[ms]').astype(np.int64)
+            elif kind == 'str':
+                arrays[field] = column.astype(str).to_numpy(dtype=str)
+            else:
+                arrays[field] = column.to_numpy(dtype=np.float64)
+
+        user_dir = self._user_dir(username)
+        os.makedirs(user_dir, exist_ok=True)
+        # Write then rename, so readers never see a half-written month
+        fd, tmp_path = tempfile.mkstemp(dir=user_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(tmp_path, self._path(username, month))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return self.read_month(username, month)
+
+    def month_ids(self, username: str, month: str) -> set:
+        """_ids (as strings) of one archived month, reading only that column"""
+        path = self._path(username, month)
+        if not os.path.exists(path):
+            return set()
+        with np.load(path, allow_pickle=False) as data:
+            return set(data['_id'].tolist())
+
+    def iter_frames(self, username: str, start_date: datetime = None, end_date: datetime = None,
+                    emotion_filter: List[str] = None, language_filter: List[str] = None,
+                    newest_first: bool = False) -> Iterable[pd.DataFrame]:
+        """Archived detections month by month, filtered like build_history_match"""
+        months = self.months(username)
+        if newest_first:
+            months.reverse()
+        for month in months:
+            month_start, month_end = month_bounds(month)
+            if (start_date and month_end <= start_date) or (end_date and month_start > end_date):
+                continue
+            frame = self.read_month(username, month)
+            mask = np.ones(len(frame), dtype=bool)
+            if start_date:
+                mask &= (frame['timestamp'] >= start_date).to_numpy()
+            if end_date:
+                mask &= (frame['timestamp'] <= end_date).to_numpy()
+            if emotion_filter:
+                mask &= frame['emotion'].isin(emotion_filter).to_numpy()
+            if language_filter:
+                mask &= frame['language'].isin(language_filter).to_numpy()
+            frame = frame[mask]
+            if newest_first:
+                frame = frame.iloc[::-1]
+            if not frame.empty:
+                yield frame.reset_index(drop=True)
+
+    def page(self, username: str, before: Tuple[datetime, Any] = None, page_size: int = 20,
+             emotion_filter: List[str] = None, language_filter: List[str] = None) -> List[Dict]:
+        """Up to page_size + 1 archived detections older than the cursor, newest first"""
+        end_date, last_id = before if before else (None, None)
+        rows = []
+        for frame in self.iter_frames(username, end_date=end_date, emotion_filter=emotion_filter,
+                                      language_filter=language_filter, newest_first=True):
+            if end_date is not None:
+                at_cursor = (frame['timestamp'] == end_date).to_numpy()
+                if last_id is None:
+                    frame = frame[~at_cursor]
+                else:
+                    frame = frame[~at_cursor | (frame['_id'] < str(last_id)).to_numpy()]
+            rows.extend(frame_to_docs(frame.head(page_size + 1 - len(rows))))
+            if len(rows) > page_size:
+                break
+        return rows
+
+def _text_fields() -> List[str]:
+    return [field for field, kind in ARCHIVE_SCHEMA.items() if kind == 'category']
+
+def _empty_frame() -> pd.DataFrame:
+    return frame_from_batches([], ARCHIVE_SCHEMA)
+
+def frame_to_docs(frame: pd.DataFrame) -> List[Dict]:
+    """Frame rows as history documents (missing values dropped, native datetimes)"""
+    records = []
+    for row in frame.astype(object).itertuples(index=False):
+        doc = {field: value for field, value in zip(frame.columns, row) if not pd.isna(value)}
+        doc['timestamp'] = pd.Timestamp(doc['timestamp']).to_pydatetime()
+        records.append(doc)
+    return records
+
+history_archive = HistoryArchive()
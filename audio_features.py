@@ -0,0 +1,214 @@
+"""Acoustic descriptors of a local music library
+
+scan_library updates the library index (library.py), then decodes the
+files whose content it has not described yet with pydub in a pool of
+worker processes. It keeps one row of AUDIO_FEATURES per file in
+CATALOG_DIR/audio_features.npz, keyed by content hash, so moved files keep
+their row. Files that could not be decoded get an all-NaN row, so they
+are not retried until they change.
+
+Descriptors are computed from a mono excerpt with one batched FFT over
+all frames: loudness, a tempo estimate from the autocorrelation of the
+spectral flux, spectral centroid and rolloff, and how clearly the chroma
+profile matches a major or minor key.
+
+Files are matched to catalog tracks by the artist and title in the
+library index, and build_vectors appends the matched descriptors to the
+catalog's feature matrix.
+"""
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from catalog import CATALOG_DIR, normalize
+from library import LIBRARY_DIR, LIBRARY_INDEX, LibraryIndex, scan_library as scan_files
+
+# Optional decoding support (pydub needs ffmpeg for anything but WAV)
+try:
+    from pydub import AudioSegment
+    PYDUB_AVAILABLE = True
+except Exception:
+    PYDUB_AVAILABLE = False
+
+AUDIO_FEATURES_PATH = os.path.join(CATALOG_DIR, "audio_features.npz")
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", str(os.cpu_count() or 2)))
+AUDIO_SAMPLE_RATE = 22050
+# Seconds decoded from the middle of each file
+AUDIO_EXCERPT_SECONDS = float(os.getenv("AUDIO_EXCERPT_SECONDS", "60"))
+AUDIO_FRAME = 2048
+AUDIO_HOP = 512
+AUDIO_MIN_BPM, AUDIO_MAX_BPM = 60, 200
+
+AUDIO_FEATURES = ["loudness", "loudness_std", "tempo", "pulse", "centroid", "centroid_std",
+                  "rolloff", "tonality", "mode"]
+
+# Krumhansl-Kessler key profiles, from C
+_MAJOR = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+_MINOR = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+def _key_profiles() -> np.ndarray:
+    """The 24 key profiles (12 major, then 12 minor), centred and unit length"""
+    profiles = np.stack([np.roll(p, shift) for p in (_MAJOR, _MINOR) for shift in range(12)])
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+_PROFILES = _key_profiles()
+
+def _pitch_classes(sample_rate: int = AUDIO_SAMPLE_RATE) -> np.ndarray:
+    """One-hot pitch class of each FFT bin from A0 to 5 kHz (bins outside are all zero)"""
+    freqs = np.fft.rfftfreq(AUDIO_FRAME, 1 / sample_rate)
+    audible = (freqs >= 27.5) & (freqs <= 5000)
+    classes = np.zeros((len(freqs), 12), dtype=np.float32)
+    midi = np.round(12 * np.log2(freqs[audible] / 440) + 69).astype(np.int64)
+    classes[np.flatnonzero(audible), midi % 12] = 1
+    return classes
+
+def describe(samples: np.ndarray, sample_rate: int = AUDIO_SAMPLE_RATE) -> np.ndarray:
+    """AUDIO_FEATURES of mono samples in [-1, 1]"""
+    samples = np.asarray(samples, dtype=np.float32)
+    # At least two frames, so there is one spectral flux value to take the tempo from
+    if len(samples) < AUDIO_FRAME + AUDIO_HOP:
+        samples = np.pad(samples, (0, AUDIO_FRAME + AUDIO_HOP - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, AUDIO_FRAME)[::AUDIO_HOP]
+    power = np.abs(np.fft.rfft(frames * np.hanning(AUDIO_FRAME).astype(np.float32), axis=1)) ** 2
+    freqs = np.fft.rfftfreq(AUDIO_FRAME, 1 / sample_rate)
+    total = power.sum(axis=1)
+    voiced = total > 1e-10 * AUDIO_FRAME
+
+    loudness = 10 * np.log10(np.maximum(np.mean(frames ** 2, axis=1), 1e-10))
+    centroid = (power @ freqs) / np.maximum(total, 1e-20)
+    rolloff = freqs[np.argmax(np.cumsum(power, axis=1) >= 0.85 * total[:, None], axis=1)]
+    if voiced.any():
+        loudness, centroid, rolloff = loudness[voiced], centroid[voiced], rolloff[voiced]
+
+    # Tempo: strongest periodicity of the onset strength within the BPM range,
+    # weighted towards 120 BPM to settle octave ambiguity
+    flux = np.maximum(np.diff(np.log1p(power), axis=0), 0).sum(axis=1)
+    flux = flux - flux.mean()
+    spectrum = np.fft.rfft(flux, n=2 * len(flux))
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2)[:len(flux)]
+    frame_rate = sample_rate / AUDIO_HOP
+    lags = np.arange(int(60 * frame_rate / AUDIO_MAX_BPM), int(60 * frame_rate / AUDIO_MIN_BPM) + 1)
+    lags = lags[lags < len(autocorrelation)]
+    tempo, pulse = 0.0, 0.0
+    if len(lags) and autocorrelation[0] > 0:
+        bpm = 60 * frame_rate / lags
+        prior = np.exp(-0.5 * np.log2(bpm / 120) ** 2)
+        best = int(np.argmax(autocorrelation[lags] * prior))
+        lag = lags[best]
+        pulse = autocorrelation[lag] / autocorrelation[0]
+        # The beat rarely falls on a whole number of hops: refine the lag on a parabola
+        if lag + 1 < len(autocorrelation):
+            before, peak, after = autocorrelation[lag - 1:lag + 2]
+            curvature = before - 2 * peak + after
+            if curvature < 0:
+                lag = lag + 0.5 * (before - after) / curvature
+        tempo = 60 * frame_rate / lag
+
+    # Mode: correlation of the mean chroma with the best major vs the best minor key
+    chroma = power @ _pitch_classes(sample_rate)
+    chroma = chroma / np.maximum(chroma.sum(axis=1, keepdims=True), 1e-20)
+    profile = chroma[voiced].mean(axis=0) if voiced.any() else np.zeros(12)
+    profile = profile - profile.mean()
+    norm = np.linalg.norm(profile)
+    correlations = _PROFILES @ (profile / norm) if norm > 0 else np.zeros(24)
+    tonality = correlations.max()
+    mode = correlations[:12].max() - correlations[12:].max()
+
+    return np.array([loudness.mean(), loudness.std(), tempo, pulse, centroid.mean(), centroid.std(),
+                     rolloff.mean(), tonality, mode], dtype=np.float32)
+
+def analyze_file(path: str, duration: Optional[float] = None) -> Optional[np.ndarray]:
+    """Descriptors of one audio file; None if it cannot be decoded"""
+    try:
+        if duration and duration > AUDIO_EXCERPT_SECONDS:
+            # Only the excerpt is decoded
+            audio = AudioSegment.from_file(path, start_second=(duration - AUDIO_EXCERPT_SECONDS) / 2,
+                                           duration=AUDIO_EXCERPT_SECONDS)
+        else:
+            audio = AudioSegment.from_file(path)
+        audio = audio.set_channels(1).set_frame_rate(AUDIO_SAMPLE_RATE)
+        samples = np.array(audio.get_array_of_samples(), dtype=np.float32) / (1 << (8 * audio.sample_width - 1))
+        return describe(samples)
+    except Exception as e:
+        print(f"Error analyzing {path}: {e}")
+        return None
+
+FEATURE_ARRAYS = ("paths", "hashes", "artists", "titles", "features")
+
+def load_features(path: str = AUDIO_FEATURES_PATH) -> Optional[Dict[str, np.ndarray]]:
+    """The saved library descriptors (paths, hashes, artists, titles, features)
+
+    None when there are none, or when they were saved in an older layout
+    (no hashes, or another descriptor set); scan_library then describes the
+    whole library again.
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as saved:
+        missing = [name for name in FEATURE_ARRAYS if name not in saved.files]
+        if missing or saved["features"].ndim != 2 or saved["features"].shape[1] != len(AUDIO_FEATURES):
+            print(f"Ignoring {path}: saved in an older layout; the next scan describes every file")
+            return None
+        return {name: saved[name] for name in saved.files}
+
+def _save_features(table: Dict[str, np.ndarray], path: str):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".partial", "wb") as f:
+        np.savez(f, **table)
+    os.replace(path + ".partial", path)
+
+def scan_library(directory: str = LIBRARY_DIR, path: str = AUDIO_FEATURES_PATH,
+                 workers: int = AUDIO_WORKERS, full: bool = False, index_path: str = LIBRARY_INDEX) -> Dict:
+    """Update the library index for directory, then describe every indexed file not described yet"""
+    if not PYDUB_AVAILABLE:
+        raise RuntimeError("Audio analysis needs pydub (pip install pydub) and ffmpeg")
+
+    started = time.perf_counter()
+    library = scan_files(directory, index_path)
+    files = LibraryIndex(index_path).files()
+    saved = None if full else load_features(path)
+    described = {}
+    if saved is not None:
+        described = dict(zip(saved["hashes"].tolist(), saved["features"]))
+    pending = [file for file in files if file["hash"] not in described]
+
+    if pending:
+        with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+            chunksize = max(1, min(16, len(pending) // (4 * max(1, workers))))
+            results = pool.map(analyze_file, [file["path"] for file in pending],
+                               [file["duration"] for file in pending], chunksize=chunksize)
+            for file, features in zip(pending, results):
+                described[file["hash"]] = features if features is not None else \
+                    np.full(len(AUDIO_FEATURES), np.nan, dtype=np.float32)
+
+    _save_features({
+        "paths": np.array([file["path"] for file in files], dtype=str),
+        "hashes": np.array([file["hash"] for file in files], dtype=str),
+        "artists": np.array([file["artist"] or "" for file in files], dtype=str),
+        "titles": np.array([file["title"] or "" for file in files], dtype=str),
+        "features": np.array([described[file["hash"]] for file in files],
+                             dtype=np.float32).reshape(len(files), len(AUDIO_FEATURES))
+    }, path)
+    failed = sum(1 for file in files if np.isnan(described[file["hash"]][0]))
+    return {"library": library, "files": len(files), "analyzed": len(pending), "failed": failed,
+            "seconds": time.perf_counter() - started}
+
+def match_tracks(catalog, features: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Catalog track numbers matched by library rows, and the matching row of each"""
+    numbers, rows = [], []
+    artist_postings, titles = catalog.postings["artist"], catalog.columns["title"]
+    decoded = ~np.isnan(features["features"]).any(axis=1)
+    for row, (artist, title) in enumerate(zip(features["artists"].tolist(), features["titles"].tolist())):
+        if not (artist and decoded[row]):
+            continue
+        title = normalize(title)
+        for number in artist_postings.get(artist):
+            if normalize(titles[number]) == title:
+                numbers.append(int(number))
+                rows.append(row)
+                break
+    return np.array(numbers, dtype=np.int64), np.array(rows, dtype=np.int64)
@@ -1,5 +1,4 @@
 import streamlit as st
-import pymongo
 import hashlib
 import re
 import jwt
@@ -10,30 +9,23 @@ import secrets
 import bcrypt
 import time
 
+from storage import DuplicateUserError, get_storage
+from storage.base import new_user_doc
+
 # Configuration
-MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
 JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_hex(32))
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", "your-google-client-id")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET", "your-google-client-secret")
 
 class AuthenticationSystem:
     def __init__(self):
-        self.client = None
-        self.db = None
-        self.users_collection = None
+        self.storage = None
         self._init_database()
     
     def _init_database(self):
-        """Initialize MongoDB connection"""
+        """Initialize the configured storage backend"""
         try:
-            self.client = pymongo.MongoClient(MONGODB_URI)
-            self.db = self.client['enhanced_music_app']
-            self.users_collection = self.db['users']
-            
-            # Create indexes for better performance
-            self.users_collection.create_index("username", unique=True)
-            self.users_collection.create_index("email", unique=True)
-            
+            self.storage = get_storage()
         except Exception as e:
             st.error(f"Database connection failed: {e}")
     
@@ -94,50 +86,21 @@ class AuthenticationSystem:
                 return False, password_message
             
             # Check if user exists
-            existing_user = self.users_collection.find_one({
-                "$or": [
-                    {"username": username},
-                    {"email": email}
-                ]
-            })
-            
-            if existing_user:
+            if self.storage.get_user(username) or self.storage.find_user_by_email(email):
                 return False, "Username or email already exists"
             
             # Create user document
             hashed_password = self.hash_password(password)
-            user_doc = {
-                "username": username,
-                "email": email,
-                "phone": phone,
-                "password": hashed_password,
-                "created_at": datetime.utcnow(),
-                "last_login": None,
-                "login_method": "email",
-                "email_verified": False,
-                "profile": {
-                    "preferred_language": "",
-                    "preferred_artist": "",
-                    "spotify_connected": False,
-                    "youtube_music_connected": False,
-                    "email_notifications": True,
-                    "emotion_alerts": False
-                },
-                "stats": {
-                    "total_sessions": 0,
-                    "total_emotions": 0,
-                    "games_played": 0,
-                    "days_active": 0
-                }
-            }
+            user_doc = new_user_doc(username, email, phone, hashed_password)
             
             # Insert user
-            result = self.users_collection.insert_one(user_doc)
-            if result.inserted_id:
+            if self.storage.create_user(user_doc):
                 return True, "Registration successful! Please login."
             else:
                 return False, "Registration failed. Please try again."
                 
+        except DuplicateUserError:
+            return False, "Username or email already exists"
         except Exception as e:
             return False, f"Registration error: {str(e)}"
     
@@ -145,12 +108,7 @@ class AuthenticationSystem:
         """Login user with username/email and password"""
         try:
             # Find user by username or email
-            user = self.users_collection.find_one({
-                "$or": [
-                    {"username": username},
-                    {"email": username}
-                ]
-            })
+            user = self.storage.find_user(username)
             
             if not user:
                 return False, "Invalid credentials"
@@ -159,14 +117,8 @@ class AuthenticationSystem:
             if not self.verify_password(password, user['password']):
                 return False, "Invalid credentials"
             
-            # Update last login
-            self.users_collection.update_one(
-                {"_id": user["_id"]},
-                {
-                    "$set": {"last_login": datetime.utcnow()},
-                    "$inc": {"stats.total_sessions": 1}
-                }
-            )
+            # Update last login, session count and active days
+            self.storage.record_login(user['username'])
             
             # Create session
             self._create_session(user['username'], user['email'])
@@ -203,54 +155,25 @@ class AuthenticationSystem:
                 
                 if email:
                     # Check if user exists
-                    existing_user = self.users_collection.find_one({"email": email})
+                    existing_user = self.storage.find_user_by_email(email)
                     
                     if existing_user:
-                        # Update last login
-                        self.users_collection.update_one(
-                            {"email": email},
-                            {
-                                "$set": {"last_login": datetime.utcnow()},
-                                "$inc": {"stats.total_sessions": 1}
-                            }
-                        )
                         username = existing_user['username']
+                        self.storage.record_login(username)
                     else:
                         # Create new user
                         username = email.split('@')[0]
                         # Ensure username is unique
                         counter = 1
                         original_username = username
-                        while self.users_collection.find_one({"username": username}):
+                        while self.storage.get_user(username):
                             username = f"{original_username}{counter}"
                             counter += 1
                         
-                        user_doc = {
-                            "username": username,
-                            "email": email,
-                            "phone": "",
-                            "password": "",  # No password for OAuth users
-                            "created_at": datetime.utcnow(),
-                            "last_login": datetime.utcnow(),
-                            "login_method": "google",
-                            "email_verified": True,
-                            "profile": {
-                                "preferred_language": "",
-                                "preferred_artist": "",
-                                "spotify_connected": False,
-                                "youtube_music_connected": False,
-                                "email_notifications": True,
-                                "emotion_alerts": False
-                            },
-                            "stats": {
-                                "total_sessions": 1,
-                                "total_emotions": 0,
-                                "games_played": 0,
-                                "days_active": 1
-                            }
-                        }
-                        
-                        self.users_collection.insert_one(user_doc)
+                        # No password for OAuth users
+                        user_doc = new_user_doc(username, email, password="", login_method="google",
+                                                email_verified=True, logged_in=True)
+                        self.storage.create_user(user_doc)
                     
                     # Create session
                     self._create_session(username, email)
@@ -276,6 +199,9 @@ class AuthenticationSystem:
         # Create JWT token
         token = jwt.encode(session_data, JWT_SECRET, algorithm='HS256')
         
+        # Record the session server-side (expires after 24 hours)
+        self.storage.start_session(username, email)
+        
         # Store in session state
         st.session_state['logged_in'] = True
         st.session_state['username'] = username
@@ -297,27 +223,22 @@ class AuthenticationSystem:
         """Get current user information"""
         username = st.session_state.get('username')
         if username:
-            return self.users_collection.find_one({"username": username})
+            return self.storage.get_user(username)
         return None
     
     def reset_password_request(self, email: str) -> tuple:
         """Request password reset (placeholder)"""
         # In a real implementation, you would send an email with reset link
-        user = self.users_collection.find_one({"email": email})
+        user = self.storage.find_user_by_email(email)
         if user:
             # Generate reset token and save to database
             reset_token = secrets.token_urlsafe(32)
             expiry = datetime.utcnow() + timedelta(hours=24)
             
-            self.users_collection.update_one(
-                {"email": email},
-                {
-                    "$set": {
-                        "reset_token": reset_token,
-                        "reset_token_expiry": expiry
-                    }
-                }
-            )
+            self.storage.update_user(user['username'], {
+                "reset_token": reset_token,
+                "reset_token_expiry": expiry
+            })
             
             return True, "Password reset email sent (feature not fully implemented)"
         else:
@@ -533,7 +454,6 @@ def show_auth_page():
             if login_btn and username and password:
                 success, message = auth_system.login_user(username, password)
                 if success:
-                    auth_system._create_session(username, "")
                     st.success(message)
                     time.sleep(1)
                     st.rerun()
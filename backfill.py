@@ -0,0 +1,298 @@
+"""Resumable, throttled backfills over MongoDB collections
+
+A backfill walks one collection in _id order, passes each batch of
+documents to its transform and applies the write operations it returns
+with one unordered bulk_write. The collection is split into disjoint _id
+ranges recorded in the backfills collection; workers (threads here, or
+other processes running the same backfill) lease one range at a time and
+checkpoint the last _id after every batch, so a stopped backfill resumes
+where it left off and a crashed worker's range is picked up once its lease
+expires.
+
+Transforms must be idempotent: a batch whose writes landed but whose
+checkpoint did not is processed again.
+
+Collections with a physical layout (emotion_history, see history_layout.py)
+are walked through it: the query matches stored documents holding a
+matching detection, the transform receives the detections and returns
+(_id, fields to set, fields to unset) updates that the layout applies.
+"""
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from database import (
+    MONGODB_PROBE_INTERVAL, db_manager, get_first_detection_time, invalidate_analytics_state,
+    rebuild_daily_rollups, rebuild_emotion_transitions, reconcile_user_stats
+)
+
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "500"))
+# Documents per second per process, across its workers
+BACKFILL_MAX_DOCS_PER_SEC = float(os.getenv("BACKFILL_MAX_DOCS_PER_SEC", "2000"))
+# A bulk_write slower than this means the cluster is busy; the worker backs off
+BACKFILL_MAX_WRITE_MS = float(os.getenv("BACKFILL_MAX_WRITE_MS", "200"))
+# Seconds without a checkpoint before another worker may take over a range
+BACKFILL_LEASE_SECONDS = float(os.getenv("BACKFILL_LEASE_SECONDS", "120"))
+
+class Backfill:
+    def __init__(self, name: str, collection: str, transform: Callable[[List[Dict]], List],
+                 query: Dict = None, projection: Dict = None, target: str = None,
+                 after: Callable[[List[Dict]], None] = None, description: str = ""):
+        self.name = name
+        self.collection = collection
+        self.transform = transform
+        self.query = query or {}
+        self.projection = projection
+        self.target = target or collection
+        # Called with each batch once its writes are applied
+        self.after = after
+        self.description = description
+
+    @property
+    def layout(self):
+        """The collection's physical layout, or None for collections stored one document per item"""
+        return db_manager.layouts.get(self.collection)
+
+BACKFILLS: Dict[str, Backfill] = {}
+
+def backfill(name: str, collection: str, **options):
+    """Register the decorated function as the transform of a backfill"""
+    def register(transform):
+        BACKFILLS[name] = Backfill(name, collection, transform,
+                                   description=(transform.__doc__ or "").strip(), **options)
+        return transform
+    return register
+
+class RateLimiter:
+    """Token bucket shared by the workers of one process"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.allowance = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: int):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.updated) * self.rate)
+            self.updated = now
+            self.allowance -= n
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+def plan_ranges(job: Backfill, parts: int) -> int:
+    """Split the collection into parts _id ranges unless the backfill already has some"""
+    meta = db_manager.db['backfills']
+    existing = meta.count_documents({"name": job.name})
+    if existing:
+        return existing
+
+    collection = db_manager.db[job.collection]
+    first = collection.find_one({}, {"_id": 1}, sort=[("_id", 1)])
+    last = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if first is None:
+        bounds = []
+    elif isinstance(first["_id"], ObjectId) and isinstance(last["_id"], ObjectId):
+        # ObjectIds grow with time, so equal time slices give ranges without a scan
+        start, end = first["_id"].generation_time, last["_id"].generation_time
+        step = (end - start) / parts
+        bounds = [ObjectId.from_datetime(start + step * i) for i in range(1, parts)]
+    else:
+        buckets = collection.aggregate([{"$bucketAuto": {"groupBy": "$_id", "buckets": parts}}],
+                                       allowDiskUse=True)
+        bounds = [bucket["_id"]["min"] for bucket in buckets][1:]
+    edges = [None] + sorted(set(bounds)) + [None]
+
+    for i in range(len(edges) - 1):
+        try:
+            meta.insert_one({
+                "_id": f"{job.name}|{i}",
+                "name": job.name,
+                "start": edges[i],
+                "end": edges[i + 1],
+                "last_id": None,
+                "status": "pending",
+                "processed": 0,
+                "written": 0,
+                "created_at": datetime.utcnow()
+            })
+        except DuplicateKeyError:
+            # Another worker planned the same backfill concurrently
+            pass
+    return len(edges) - 1
+
+def _claim_range(job: Backfill, owner: str):
+    now = datetime.utcnow()
+    return db_manager.db['backfills'].find_one_and_update(
+        {
+            "name": job.name,
+            "$or": [
+                {"status": "pending"},
+                {"status": "running", "heartbeat": {"$lt": now - timedelta(seconds=BACKFILL_LEASE_SECONDS)}}
+            ]
+        },
+        {"$set": {"status": "running", "owner": owner, "heartbeat": now}},
+        sort=[("_id", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def _process_range(job: Backfill, range_doc: Dict, owner: str, limiter: RateLimiter,
+                   batch_size: int) -> int:
+    """Walk one leased range; returns the number of documents processed"""
+    meta = db_manager.db['backfills']
+    source = db_manager.db[job.collection]
+    target = db_manager.db[job.target]
+    layout = job.layout
+    job_query = layout.stored_query(job.query) if layout else job.query
+    projection = layout.stored_projection(job.projection) if layout else job.projection
+    processed = 0
+
+    while True:
+        if not db_manager.is_available():
+            time.sleep(MONGODB_PROBE_INTERVAL)
+            continue
+
+        id_range = {}
+        if range_doc["last_id"] is not None:
+            id_range["$gt"] = range_doc["last_id"]
+        elif range_doc["start"] is not None:
+            id_range["$gte"] = range_doc["start"]
+        if range_doc["end"] is not None:
+            id_range["$lt"] = range_doc["end"]
+        query = dict(job_query, _id=id_range) if id_range else dict(job_query)
+
+        stored = list(source.find(query, projection, sort=[("_id", 1)], limit=batch_size))
+        if not stored:
+            meta.update_one({"_id": range_doc["_id"], "owner": owner},
+                            {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+            return processed
+
+        docs = layout.unpack_documents(stored) if layout else stored
+        limiter.acquire(len(docs))
+        started = time.perf_counter()
+        ops = job.transform(docs)
+        if ops and layout:
+            layout.update_documents(target, ops)
+        elif ops:
+            target.bulk_write(ops, ordered=False)
+        if job.after:
+            job.after(docs)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        range_doc["last_id"] = stored[-1]["_id"]
+        checkpoint = meta.update_one(
+            {"_id": range_doc["_id"], "owner": owner},
+            {
+                "$set": {"last_id": range_doc["last_id"], "heartbeat": datetime.utcnow()},
+                "$inc": {"processed": len(docs), "written": len(ops or [])}
+            }
+        )
+        processed += len(docs)
+        if checkpoint.matched_count == 0:
+            print(f"Lost the lease on {range_doc['_id']}; leaving it to its new owner")
+            return processed
+
+        if elapsed_ms > BACKFILL_MAX_WRITE_MS:
+            # Give production traffic the time this batch took
+            time.sleep(elapsed_ms / 1000)
+
+def run_backfill(name: str, workers: int = 1, parts: int = None,
+                 batch_size: int = BACKFILL_BATCH_SIZE,
+                 max_docs_per_sec: float = BACKFILL_MAX_DOCS_PER_SEC) -> int:
+    """Run (or resume) a registered backfill; returns documents processed by this process"""
+    if not db_manager.is_available():
+        print("Database connection not available")
+        return 0
+
+    job = BACKFILLS[name]
+    if job.layout and not job.layout.supports_updates(db_manager.db):
+        print(f"Backfill {name} cannot run on the {job.layout.name} layout of {job.collection} "
+              "on this server (time-series updates need MongoDB 7.0)")
+        return 0
+    plan_ranges(job, parts or max(workers, 1) * 4)
+    limiter = RateLimiter(max_docs_per_sec)
+    owner_prefix = f"{socket.gethostname()}:{os.getpid()}"
+    totals = []
+
+    def work(worker: int):
+        owner = f"{owner_prefix}:{worker}"
+        processed = 0
+        try:
+            while True:
+                range_doc = _claim_range(job, owner)
+                if range_doc is None:
+                    break
+                processed += _process_range(job, range_doc, owner, limiter, batch_size)
+        except Exception as e:
+            print(f"Backfill {name} worker {worker} stopped: {e}")
+        totals.append(processed)
+
+    threads = [threading.Thread(target=work, args=(i,), name=f"backfill-{name}-{i}")
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(totals)
+
+def backfill_status(name: str) -> Dict:
+    """Range counts by status and documents processed so far"""
+    status = {"ranges": {}, "processed": 0, "written": 0}
+    for doc in db_manager.db['backfills'].find({"name": name}):
+        status["ranges"][doc["status"]] = status["ranges"].get(doc["status"], 0) + 1
+        status["processed"] += doc.get("processed", 0)
+        status["written"] += doc.get("written", 0)
+    return status
+
+def reset_backfill(name: str) -> int:
+    """Forget a backfill's ranges and progress so it runs from the start"""
+    return db_manager.db['backfills'].delete_many({"name": name}).deleted_count
+
+# Registered backfills
+def _history_changed(docs: List[Dict]):
+    for username in {doc.get("username") for doc in docs}:
+        invalidate_analytics_state(username)
+
+@backfill("history-singer-field", "emotion_history",
+          query={"artist": {"$exists": True}, "singer": {"$exists": False}},
+          projection={"username": 1, "artist": 1}, after=_history_changed)
+def history_singer_field(docs: List[Dict]) -> List:
+    """Rename artist to singer on detections stored by older save_emotion_detection"""
+    # Buckets also hold detections that do not match the query
+    return [(doc["_id"], {"singer": doc["artist"]}, ["artist"])
+            for doc in docs if "artist" in doc and "singer" not in doc]
+
+@backfill("daily-rollups", "users", projection={"username": 1, "stats.first_emotion_at": 1})
+def daily_rollups(docs: List[Dict]) -> List:
+    """Rebuild emotion_daily from emotion_history for every user"""
+    now = datetime.utcnow()
+    for doc in docs:
+        # Users reconcile_user_stats has not reached yet have no first_emotion_at
+        first = (doc.get("stats") or {}).get("first_emotion_at") or get_first_detection_time(doc["username"])
+        if first:
+            rebuild_daily_rollups(doc["username"], first, now)
+    return []
+
+@backfill("emotion-transitions", "users", projection={"username": 1})
+def emotion_transitions(docs: List[Dict]) -> List:
+    """Recount emotion_transitions and the global day totals from history for every user"""
+    for doc in docs:
+        rebuild_emotion_transitions(doc["username"])
+    return []
+
+@backfill("user-stats", "users", projection={"username": 1})
+def user_stats(docs: List[Dict]) -> List:
+    """Recompute users.stats counters from history"""
+    reconcile_user_stats(batch_size=len(docs), usernames=[doc["username"] for doc in docs])
+    return []
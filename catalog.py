@@ -0,0 +1,338 @@
+"""Local track catalog with an in-memory inverted index
+
+Track metadata is ingested from CSV or JSONL files (manage.py
+ingest-catalog) and saved as one .npz index. Tracks are numbered by
+popularity, most popular first, and every emotion, language, artist, tag
+and (emotion, language) pair has a posting: the ascending array of the
+numbers of its tracks. A query intersects the postings it needs,
+smallest first, and the first numbers left are already the best ranked
+tracks, so lookups take microseconds even for millions of tracks.
+"""
+import bisect
+import os
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+CATALOG_DIR = os.getenv("CATALOG_DIR", "catalog")
+CATALOG_INDEX = os.path.join(CATALOG_DIR, "index.npz")
+CATALOG_CHUNK_SIZE = int(os.getenv("CATALOG_CHUNK_SIZE", "100000"))
+
+# Source column names accepted for each catalog field
+CATALOG_COLUMNS = {
+    "track_id": ["track_id", "id", "uri"],
+    "title": ["title", "name", "track", "track_name", "song"],
+    "artist": ["artist", "artists", "singer", "artist_name"],
+    "language": ["language", "lang"],
+    "tags": ["tags", "genres", "genre"],
+    "emotion": ["emotion", "mood"],
+    "valence": ["valence"],
+    "arousal": ["arousal", "energy"],
+    "popularity": ["popularity", "plays", "play_count"]
+}
+# Separators of multi-valued tag strings
+TAG_SEPARATORS = r"[|;,]"
+# Valence-arousal (0..1) centres, used to label tracks that have no mood field
+EMOTION_VALENCE_AROUSAL = {
+    'happy': (0.85, 0.65),
+    'surprise': (0.7, 0.85),
+    'neutral': (0.5, 0.4),
+    'sad': (0.2, 0.25),
+    'fear': (0.25, 0.7),
+    'angry': (0.15, 0.85),
+    'disgust': (0.25, 0.5)
+}
+POSTING_FIELDS = ("emotion", "language", "artist", "tag", "emotion_language")
+
+def file_version(path: str) -> str:
+    """Identifies one build of a file written by os.replace; "" if it does not exist"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ""
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+def normalize(value) -> str:
+    return str(value).strip().casefold()
+
+class StringColumn:
+    """Strings packed into one UTF-8 buffer with offsets, decoded on access"""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_list(cls, values: Iterable[str]) -> "StringColumn":
+        encoded = [str(value).encode('utf-8') for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+class Postings:
+    """Track numbers per value of one field, as slices of one sorted array"""
+
+    def __init__(self, values: StringColumn, offsets: np.ndarray, ids: np.ndarray):
+        self.values = values
+        self.offsets = offsets
+        self.ids = ids
+
+    @classmethod
+    def build(cls, track_ids: np.ndarray, keys: np.ndarray) -> "Postings":
+        """Postings of (track number, normalized value) pairs"""
+        values, codes = np.unique(keys, return_inverse=True)
+        # Stable sort by value keeps each posting in track order
+        order = np.argsort(codes, kind='stable')
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(values)), out=offsets[1:])
+        return cls(StringColumn.from_list(values), offsets, track_ids[order].astype(np.int32))
+
+    def get(self, value: str) -> np.ndarray:
+        # Values are stored sorted, so a binary search finds the code
+        value = normalize(value)
+        code = bisect.bisect_left(self.values, value)
+        if code == len(self.values) or self.values[code] != value:
+            return self.ids[:0]
+        return self.ids[self.offsets[code]:self.offsets[code + 1]]
+
+    def counts(self) -> Dict[str, int]:
+        return {self.values[i]: int(self.offsets[i + 1] - self.offsets[i]) for i in range(len(self.values))}
+
+def _filter(candidates: np.ndarray, postings: List[np.ndarray]) -> np.ndarray:
+    for other in postings:
+        if len(candidates) == 0 or len(other) == 0:
+            return candidates[:0]
+        # Binary search of the candidates in the (larger) posting
+        candidates = candidates[other[np.minimum(np.searchsorted(other, candidates), len(other) - 1)] == candidates]
+    return candidates
+
+def intersect(postings: List[np.ndarray], limit: int = None) -> np.ndarray:
+    """Track numbers present in every posting, ascending
+
+    With a limit, the smallest posting is walked in growing blocks and the
+    walk stops once limit numbers are found.
+    """
+    smallest, *others = sorted(postings, key=len)
+    if limit is None:
+        return _filter(smallest, others)
+    found, start, block = [], 0, max(limit * 4, 64)
+    while start < len(smallest) and sum(map(len, found)) < limit:
+        found.append(_filter(smallest[start:start + block], others))
+        start += block
+        block *= 4
+    return np.concatenate(found)[:limit] if found else smallest[:0]
+
+def read_tracks(path: str, chunk_size: int = CATALOG_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Raw track metadata chunks from a CSV or JSONL file"""
+    if path.endswith((".jsonl", ".json", ".ndjson")):
+        yield from pd.read_json(path, lines=True, chunksize=chunk_size, dtype=False)
+    else:
+        yield from pd.read_csv(path, chunksize=chunk_size, dtype=str, keep_default_na=False)
+
+def _column(frame: pd.DataFrame, field: str) -> Optional[pd.Series]:
+    lowered = {str(column).strip().lower(): column for column in frame.columns}
+    for alias in CATALOG_COLUMNS[field]:
+        if alias in lowered:
+            return frame[lowered[alias]]
+    return None
+
+def _unit(values: Optional[pd.Series], length: int) -> np.ndarray:
+    """Numeric values scaled to 0..1 (-1..1 and 0..100 scales are recognized)"""
+    if values is None:
+        return np.full(length, np.nan, dtype=np.float32)
+    numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+    if np.nanmin(numbers, initial=0) < 0:
+        numbers = (numbers + 1) / 2
+    elif np.nanmax(numbers, initial=0) > 1:
+        numbers = numbers / 100
+    return numbers.astype(np.float32)
+
+def prepare_tracks(frame: pd.DataFrame) -> pd.DataFrame:
+    """Catalog columns of one chunk; rows without a title or artist are dropped"""
+    n = len(frame)
+    empty = pd.Series([""] * n, index=frame.index, dtype=object)
+
+    def text(field):
+        column = _column(frame, field)
+        if column is None:
+            return empty
+        # JSONL files may hold lists (several artists or tags)
+        column = column.map(lambda value: "|".join(map(str, value)) if isinstance(value, list) else value)
+        return column.fillna("").astype(str).str.strip()
+
+    popularity = _column(frame, "popularity")
+    tracks = pd.DataFrame({
+        "track_id": text("track_id"),
+        "title": text("title"),
+        "artist": text("artist"),
+        "language": text("language"),
+        "tags": text("tags"),
+        "emotion": text("emotion").str.casefold(),
+        "valence": _unit(_column(frame, "valence"), n),
+        "arousal": _unit(_column(frame, "arousal"), n),
+        "popularity": np.zeros(n, dtype=np.float32) if popularity is None else
+            pd.to_numeric(popularity, errors='coerce').fillna(0).to_numpy(dtype=np.float32)
+    }, index=frame.index)
+
+    # Label tracks without a mood by their nearest valence-arousal centre
+    unlabeled = (tracks["emotion"] == "") & tracks["valence"].notna() & tracks["arousal"].notna()
+    if unlabeled.any():
+        names = list(EMOTION_VALENCE_AROUSAL)
+        centres = np.array([EMOTION_VALENCE_AROUSAL[name] for name in names], dtype=np.float32)
+        points = tracks.loc[unlabeled, ["valence", "arousal"]].to_numpy(dtype=np.float32)
+        nearest = ((points[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        tracks.loc[unlabeled, "emotion"] = np.array(names, dtype=object)[nearest]
+    return tracks[(tracks["title"] != "") & (tracks["artist"] != "")]
+
+class Catalog:
+    def __init__(self, columns: Dict[str, StringColumn], numbers: Dict[str, np.ndarray],
+                 postings: Dict[str, Postings]):
+        self.columns = columns
+        self.numbers = numbers
+        self.postings = postings
+        # Changes whenever the index is rebuilt; part of every cached result's key
+        self.version = ""
+
+    def __len__(self) -> int:
+        return len(self.columns["title"])
+
+    @classmethod
+    def build(cls, frames: Iterable[pd.DataFrame]) -> "Catalog":
+        tracks = pd.concat([prepare_tracks(frame) for frame in frames], ignore_index=True)
+        # Track numbers are popularity ranks, so every posting is in rank order
+        tracks = tracks.sort_values("popularity", ascending=False, kind='stable').reset_index(drop=True)
+        ids = np.arange(len(tracks), dtype=np.int32)
+
+        keys = {
+            "emotion": tracks["emotion"].to_numpy(dtype=object),
+            "language": tracks["language"].str.casefold().to_numpy(dtype=object),
+            "artist": tracks["artist"].str.casefold().to_numpy(dtype=object),
+        }
+        keys["emotion_language"] = keys["emotion"] + "|" + keys["language"]
+        postings = {field: Postings.build(ids, values.astype(str)) for field, values in keys.items()}
+        tags = tracks["tags"].str.casefold().str.split(TAG_SEPARATORS, regex=True).explode().str.strip()
+        tags = tags[tags.notna() & (tags != "")]
+        postings["tag"] = Postings.build(ids[tags.index.to_numpy()], tags.to_numpy(dtype=str))
+
+        columns = {field: StringColumn.from_list(tracks[field])
+                   for field in ("track_id", "title", "artist", "language", "emotion")}
+        numbers = {field: tracks[field].to_numpy(dtype=np.float32) for field in ("valence", "arousal", "popularity")}
+        return cls(columns, numbers, postings)
+
+    def save(self, path: str = CATALOG_INDEX):
+        arrays = {}
+        for field, column in self.columns.items():
+            arrays[f"column.{field}.data"], arrays[f"column.{field}.offsets"] = column.data, column.offsets
+        for field, values in self.numbers.items():
+            arrays[f"number.{field}"] = values
+        for field, posting in self.postings.items():
+            arrays[f"posting.{field}.values"] = posting.values.data
+            arrays[f"posting.{field}.value_offsets"] = posting.values.offsets
+            arrays[f"posting.{field}.offsets"] = posting.offsets
+            arrays[f"posting.{field}.ids"] = posting.ids
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        partial = path + ".partial.npz"
+        np.savez(partial, **arrays)
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path: str = CATALOG_INDEX) -> "Catalog":
+        version = file_version(path)
+        with np.load(path) as arrays:
+            def get(name):
+                return arrays[name]
+
+            columns = {field: StringColumn(get(f"column.{field}.data"), get(f"column.{field}.offsets"))
+                       for field in ("track_id", "title", "artist", "language", "emotion")}
+            numbers = {field: get(f"number.{field}") for field in ("valence", "arousal", "popularity")}
+            postings = {
+                field: Postings(StringColumn(get(f"posting.{field}.values"), get(f"posting.{field}.value_offsets")),
+                                get(f"posting.{field}.offsets"), get(f"posting.{field}.ids"))
+                for field in POSTING_FIELDS
+            }
+        catalog = cls(columns, numbers, postings)
+        catalog.version = version
+        return catalog
+
+    def track(self, number: int) -> Dict:
+        track = {field: column[number] for field, column in self.columns.items()}
+        track.update({field: float(values[number]) for field, values in self.numbers.items()})
+        track["number"] = int(number)
+        return track
+
+    def search(self, emotion: str = None, language: str = None, artist: str = None,
+               tags: List[str] = None, limit: int = 10) -> np.ndarray:
+        """Numbers of the best ranked tracks matching every given filter"""
+        postings = []
+        if emotion and language:
+            postings.append(self.postings["emotion_language"].get(f"{normalize(emotion)}|{normalize(language)}"))
+        elif emotion:
+            postings.append(self.postings["emotion"].get(emotion))
+        elif language:
+            postings.append(self.postings["language"].get(language))
+        if artist:
+            postings.append(self.postings["artist"].get(artist))
+        for tag in tags or []:
+            postings.append(self.postings["tag"].get(tag))
+        if not postings:
+            return np.arange(min(limit, len(self)), dtype=np.int32)
+        return intersect(postings, limit)
+
+    def recommend(self, emotion: str, language: str = None, artist: str = None,
+                  limit: int = 10) -> Tuple[List[Dict], List[str]]:
+        """Tracks for the detected emotion; drops the artist, then the language, if nothing matches
+
+        Returns the tracks and the filters that were applied.
+        """
+        attempts = [("emotion", "language", "artist"), ("emotion", "language"), ("emotion",)]
+        given = {"emotion": emotion, "language": language, "artist": artist}
+        for fields in attempts:
+            applied = [field for field in fields if given[field]]
+            numbers = self.search(**{field: given[field] for field in applied}, limit=limit)
+            if len(numbers):
+                return [self.track(number) for number in numbers], applied
+        return [], []
+
+    def summary(self) -> Dict:
+        return {
+            "tracks": len(self),
+            "emotions": self.postings["emotion"].counts(),
+            "languages": len(self.postings["language"].values),
+            "artists": len(self.postings["artist"].values),
+            "tags": len(self.postings["tag"].values)
+        }
+
+def ingest_catalog(paths: List[str], index_path: str = CATALOG_INDEX) -> Dict:
+    """Build the catalog index from track files; returns its summary"""
+    def frames():
+        for path in paths:
+            yield from read_tracks(path)
+
+    catalog = Catalog.build(frames())
+    catalog.save(index_path)
+    _catalogs.pop(index_path, None)
+    return catalog.summary()
+
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+def get_catalog(index_path: str = CATALOG_INDEX) -> Optional[Catalog]:
+    """The saved catalog, loaded once per process and again when it is rebuilt; None if none was ingested"""
+    version = file_version(index_path)
+    with _catalog_lock:
+        cached = _catalogs.get(index_path)
+        if cached is None or cached[0] != version:
+            try:
+                _catalogs[index_path] = (version, Catalog.load(index_path) if version else None)
+            except Exception as e:
+                print(f"Error loading catalog: {e}")
+                _catalogs[index_path] = (version, None)
+        return _catalogs[index_path][1]
@@ -0,0 +1,155 @@
+"""Plotly figures for the Analytics page
+
+Figures are built from get_emotion_analytics results, with the daily
+series downsampled to CHART_MAX_POINTS by Largest-Triangle-Three-Buckets,
+and cached per (user, data version, filters) so a rerun with unchanged
+data neither recomputes the analytics nor rebuilds the figures.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from transitions import transition_probabilities
+
+# Most points a time-series chart sends to the browser
+CHART_MAX_POINTS = int(os.getenv("CHART_MAX_POINTS", "500"))
+# Figure sets kept per process (one per user and filter combination)
+FIGURE_CACHE_SIZE = int(os.getenv("FIGURE_CACHE_SIZE", "128"))
+
+WEEKDAY_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> np.ndarray:
+    """Indexes of the points Largest-Triangle-Three-Buckets keeps
+
+    Keeps the first and last point and, from each of threshold - 2 equal
+    buckets in between, the point forming the largest triangle with the
+    point kept before it and the mean of the next bucket, so peaks and
+    dips survive the reduction.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    kept = np.empty(threshold, dtype=np.int64)
+    kept[0], kept[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x, next_y = x[end:edges[i + 2]].mean(), y[end:edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(areas))
+        kept[i + 1] = a
+    return kept
+
+def dwell_labels(bins) -> list:
+    """Dwell-time bin labels from their upper edges in seconds"""
+    def seconds(n):
+        return f"{n // 60}m" if n % 60 == 0 else f"{n}s"
+    return [f"≤{seconds(n)}" for n in bins] + [f">{seconds(bins[-1])}"]
+
+def analytics_figures(analytics: Dict, transitions: Dict = None,
+                      max_points: int = CHART_MAX_POINTS) -> Dict[str, Any]:
+    """Figures for one get_emotion_analytics (and get_emotion_transitions) result, keyed by chart name
+
+    Also returns 'payload_bytes' (serialized size per figure) and
+    'daily_points' (points plotted, points in the full series).
+    """
+    figures = {}
+    emotion_counts = pd.Series(analytics['emotion_counts'])
+    figures['emotions'] = px.pie(values=emotion_counts.values, names=emotion_counts.index,
+                                 title="Distribution of Detected Emotions")
+
+    daily = pd.Series(dict(analytics['daily_counts']))
+    daily.index = pd.to_datetime(daily.index)
+    # Fill days without detections, as resample('D') did
+    daily = daily.asfreq('D', fill_value=0)
+    kept = lttb(daily.index.asi8, daily.to_numpy(), max_points)
+    sampled = daily.iloc[kept].reset_index()
+    sampled.columns = ['Date', 'Count']
+    figures['daily'] = px.line(sampled, x='Date', y='Count', title="Daily Emotion Detections")
+
+    hourly = pd.DataFrame(analytics['hourly']).sort_values('hour')
+    figures['hourly'] = px.bar(hourly, x='hour', y='count', color='emotion',
+                               title="Emotion Detection by Hour of Day")
+    weekly = pd.DataFrame(analytics['weekday'])
+    figures['weekday'] = px.bar(weekly, x='weekday', y='count', color='emotion',
+                                title="Emotion Detection by Day of Week",
+                                category_orders={'weekday': WEEKDAY_ORDER})
+
+    if analytics['language_counts'] or analytics['singer_counts']:
+        languages = pd.Series(analytics['language_counts'], dtype='int64')
+        figures['languages'] = px.bar(x=languages.index, y=languages.values, title="Most Searched Languages")
+        singers = pd.Series(analytics['singer_counts'], dtype='int64')
+        figures['singers'] = px.bar(x=singers.index, y=singers.values, title="Most Searched Artists")
+
+    if transitions and any(map(any, transitions['counts'])):
+        probabilities = transition_probabilities(transitions['counts'])
+        figures['transitions'] = px.imshow(probabilities, text_auto='.2f', zmin=0, zmax=1,
+                                           labels={'x': 'Next emotion', 'y': 'Emotion', 'color': 'P'},
+                                           title="Emotion Transition Probabilities")
+        dwell = pd.DataFrame(transitions['dwell'], index=transitions['emotions'],
+                             columns=dwell_labels(transitions['dwell_bins']))
+        dwell = dwell.rename_axis('emotion').reset_index().melt(
+            id_vars='emotion', var_name='dwell', value_name='spans')
+        figures['dwell'] = px.bar(dwell, x='emotion', y='spans', color='dwell',
+                                  title="Time Spent in an Emotion Before It Changes")
+
+    payload = {name: len(fig.to_json()) for name, fig in figures.items()}
+    figures['payload_bytes'] = payload
+    figures['daily_points'] = (len(kept), len(daily))
+    return figures
+
+def admin_figures(stats: Dict, max_points: int = CHART_MAX_POINTS) -> Dict[str, Any]:
+    """Figures for one get_global_analytics result, keyed by chart name"""
+    figures = {}
+    daily = pd.DataFrame(stats['daily'])
+    kept = lttb(np.arange(len(daily)), daily['active_users'].to_numpy(), max_points)
+    sampled = daily.iloc[kept].assign(day=lambda frame: pd.to_datetime(frame['day']))
+    figures['active_users'] = px.line(sampled, x='day', y='active_users', title="Active Users per Day (estimated)")
+    figures['activity'] = px.line(sampled.melt(id_vars='day', value_vars=['detections', 'games', 'clicks']),
+                                  x='day', y='value', color='variable', title="Daily Activity")
+
+    emotions = pd.Series(stats['emotion_counts'], dtype='int64')
+    figures['emotions'] = px.pie(values=emotions.values, names=emotions.index, title="Emotion Mix")
+    hourly = pd.Series(stats['hourly'], dtype='int64').reindex(range(24), fill_value=0)
+    figures['hourly'] = px.bar(x=hourly.index, y=hourly.values, labels={'x': 'hour (UTC)', 'y': 'detections'},
+                               title="Detections by Hour of Day")
+    platforms = pd.Series(stats['platform_clicks'], dtype='int64')
+    figures['platforms'] = px.bar(x=platforms.index, y=platforms.values, labels={'x': 'platform', 'y': 'clicks'},
+                                  title="Platform Clicks")
+    return figures
+
+class FigureCache:
+    """LRU of built figure sets, keyed by (user, data version, filters)"""
+
+    def __init__(self, max_entries: int = FIGURE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key: Any, build: Callable[[], Optional[Dict]]) -> Optional[Dict]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        figures = build()
+        if figures is None:
+            return None
+        with self._lock:
+            self._entries[key] = figures
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return figures
+
+figure_cache = FigureCache()
@@ -0,0 +1,243 @@
+"""Collaborative filtering over music_recommendations clicks
+
+Items are (artist, language, emotion) triples, so "listeners like you"
+depends on the mood being served. interaction_matrix aggregates clicks
+into a sparse user x item matrix (CSR arrays) with confidence
+1 + CF_ALPHA * log1p(clicks), and train factorizes it with
+implicit-feedback ALS (Hu, Koren and Volinsky). Each half-step solves
+every row with a few conjugate gradient steps warm-started from the
+previous solution, vectorized over blocks of about CF_BLOCK_NNZ
+interactions that a thread pool solves in parallel.
+
+save_model writes the factors as .npy files (users sorted, so a
+username is found by binary search) that CFModel memory-maps. Serving a
+user is a dot product of their factors with the item factors of the
+current emotion and language; users without factors get the most
+clicked items.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from catalog import CATALOG_DIR, file_version, normalize
+
+CF_DIR = os.getenv("CF_DIR", os.path.join(CATALOG_DIR, "cf"))
+CF_FACTORS = int(os.getenv("CF_FACTORS", "32"))
+CF_ITERATIONS = int(os.getenv("CF_ITERATIONS", "15"))
+CF_REGULARIZATION = float(os.getenv("CF_REGULARIZATION", "0.1"))
+CF_ALPHA = float(os.getenv("CF_ALPHA", "10"))
+CF_CG_STEPS = int(os.getenv("CF_CG_STEPS", "3"))
+CF_WORKERS = int(os.getenv("CF_WORKERS", str(os.cpu_count() or 1)))
+# Interactions per solve block; bounds the (block, factors) temporaries
+CF_BLOCK_NNZ = int(os.getenv("CF_BLOCK_NNZ", "262144"))
+
+ITEM_FIELDS = ["artist", "language", "emotion"]
+
+def interaction_matrix(frames: Iterable[pd.DataFrame]) -> Dict:
+    """Codes and click counts of each distinct (user, item), from batches of
+    username/artist/language/emotion/clicks rows
+
+    Users are numbered in sorted order; items keep the most common spelling
+    of their artist for display.
+    """
+    frames = list(frames)
+    frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if frame.empty:
+        return {"user_codes": np.zeros(0, np.int64), "item_codes": np.zeros(0, np.int64),
+                "clicks": np.zeros(0, np.float32), "users": np.zeros(0, dtype=str),
+                "items": pd.DataFrame(columns=ITEM_FIELDS + ["display"])}
+    frame["display"] = frame["artist"].astype(str).str.strip()
+    for field in ITEM_FIELDS:
+        frame[field] = frame[field].fillna("").astype(str).str.strip().str.casefold()
+    frame = frame[frame["artist"] != ""]
+
+    item_codes, item_keys = pd.MultiIndex.from_frame(frame[ITEM_FIELDS]).factorize()
+    user_codes, users = pd.factorize(frame["username"].astype(str), sort=True)
+    frame["item"], frame["user"] = item_codes, user_codes
+    pairs = frame.groupby(["user", "item"], sort=False)["clicks"].sum().reset_index()
+
+    items = item_keys.to_frame(index=False, name=ITEM_FIELDS)
+    displays = frame.groupby(["item", "display"])["clicks"].sum().reset_index() \
+        .sort_values("clicks", ascending=False).drop_duplicates("item").set_index("item")["display"]
+    items["display"] = displays.reindex(range(len(items))).to_numpy()
+    return {"user_codes": pairs["user"].to_numpy(np.int64), "item_codes": pairs["item"].to_numpy(np.int64),
+            "clicks": pairs["clicks"].to_numpy(np.float32), "users": np.asarray(users, dtype=str),
+            "items": items}
+
+def _csr(rows: np.ndarray, columns: np.ndarray, values: np.ndarray,
+         n_rows: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, columns[order].astype(np.int32), values[order]
+
+def _blocks(indptr: np.ndarray, block_nnz: int) -> List[Tuple[int, int]]:
+    """Row ranges holding about block_nnz interactions each"""
+    cuts = np.searchsorted(indptr, np.arange(block_nnz, indptr[-1], block_nnz))
+    bounds = np.unique(np.concatenate([[0], cuts, [len(indptr) - 1]]))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def _solve_block(lo: int, hi: int, indptr: np.ndarray, indices: np.ndarray, confidence: np.ndarray,
+                 X: np.ndarray, Y: np.ndarray, gram: np.ndarray, steps: int):
+    """Conjugate gradient steps on (Y'C_uY + reg I) x_u = Y'C_u p_u for rows lo..hi of X, in place"""
+    start, end = indptr[lo], indptr[hi]
+    lengths = np.diff(indptr[lo:hi + 1])
+    keep = lengths > 0
+    offsets = (indptr[lo:hi] - start)[keep]
+    rows = np.repeat(np.arange(hi - lo), lengths)
+    factors = Y[indices[start:end]]
+    c = confidence[start:end]
+
+    def segment_sum(values):
+        sums = np.zeros((hi - lo, values.shape[1]), dtype=values.dtype)
+        if len(offsets):
+            sums[keep] = np.add.reduceat(values, offsets, axis=0)
+        return sums
+
+    def product(v):
+        # Y'Y v + Y'(C_u - I)Y v, with Y'Y precomputed and the second term over the row's interactions
+        weights = (c - 1) * np.einsum('ij,ij->i', factors, v[rows])
+        return v @ gram + segment_sum(factors * weights[:, None])
+
+    x = X[lo:hi]
+    r = segment_sum(factors * c[:, None]) - product(x)
+    p = r.copy()
+    rs = np.einsum('ij,ij->i', r, r)
+    for _ in range(steps):
+        ap = product(p)
+        alpha = rs / np.maximum(np.einsum('ij,ij->i', p, ap), 1e-20)
+        x += alpha[:, None] * p
+        r -= alpha[:, None] * ap
+        new_rs = np.einsum('ij,ij->i', r, r)
+        p = r + (new_rs / np.maximum(rs, 1e-20))[:, None] * p
+        rs = new_rs
+
+def _half_step(csr, X: np.ndarray, Y: np.ndarray, regularization: float, steps: int, pool, block_nnz: int):
+    indptr, indices, confidence = csr
+    gram = Y.T @ Y + regularization * np.eye(Y.shape[1], dtype=Y.dtype)
+    list(pool.map(lambda bounds: _solve_block(*bounds, indptr, indices, confidence, X, Y, gram, steps),
+                  _blocks(indptr, block_nnz)))
+
+def train(user_codes: np.ndarray, item_codes: np.ndarray, clicks: np.ndarray, n_users: int, n_items: int,
+          factors: int = CF_FACTORS, iterations: int = CF_ITERATIONS, regularization: float = CF_REGULARIZATION,
+          alpha: float = CF_ALPHA, steps: int = CF_CG_STEPS, workers: int = CF_WORKERS,
+          block_nnz: int = CF_BLOCK_NNZ, seed: int = 0,
+          progress: Callable[[int, float], None] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """User and item factors of the click matrix; progress(iteration, seconds) after each iteration"""
+    confidence = (1 + alpha * np.log1p(clicks)).astype(np.float32)
+    by_user = _csr(user_codes, item_codes, confidence, n_users)
+    by_item = _csr(item_codes, user_codes, confidence, n_items)
+    rng = np.random.default_rng(seed)
+    X = (rng.standard_normal((n_users, factors)) * 0.01).astype(np.float32)
+    Y = (rng.standard_normal((n_items, factors)) * 0.01).astype(np.float32)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for iteration in range(iterations):
+            started = time.perf_counter()
+            _half_step(by_user, X, Y, regularization, steps, pool, block_nnz)
+            _half_step(by_item, Y, X, regularization, steps, pool, block_nnz)
+            if progress:
+                progress(iteration + 1, time.perf_counter() - started)
+    return X, Y
+
+def _save_npy(path: str, array: np.ndarray):
+    with open(path + ".partial", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".partial", path)
+
+def save_model(matrix: Dict, user_factors: np.ndarray, item_factors: np.ndarray, directory: str = CF_DIR) -> Dict:
+    """Write the factors, usernames and item keys; meta.json last, so its version marks a complete model"""
+    os.makedirs(directory, exist_ok=True)
+    _save_npy(os.path.join(directory, "users.npy"), matrix["users"])
+    _save_npy(os.path.join(directory, "user_factors.npy"), user_factors.astype(np.float32))
+    _save_npy(os.path.join(directory, "item_factors.npy"), item_factors.astype(np.float32))
+    items = matrix["items"]
+    meta = {
+        "trained_at": datetime.utcnow().isoformat(),
+        "factors": int(user_factors.shape[1]),
+        "users": len(matrix["users"]),
+        "interactions": int(len(matrix["clicks"])),
+        "clicks": float(matrix["clicks"].sum()),
+        "items": items[ITEM_FIELDS + ["display"]].values.tolist(),
+        "popularity": np.bincount(matrix["item_codes"], weights=matrix["clicks"],
+                                  minlength=len(items)).tolist()
+    }
+    with open(os.path.join(directory, "meta.json.partial"), "w") as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(directory, "meta.json.partial"), os.path.join(directory, "meta.json"))
+    return meta
+
+class CFModel:
+    def __init__(self, directory: str = CF_DIR):
+        self.version = file_version(os.path.join(directory, "meta.json"))
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.trained_at = meta["trained_at"]
+        self.items = meta["items"]
+        self.popularity = np.asarray(meta["popularity"], dtype=np.float32)
+        self.users = np.load(os.path.join(directory, "users.npy"), mmap_mode='r')
+        self.user_factors = np.load(os.path.join(directory, "user_factors.npy"), mmap_mode='r')
+        self.item_factors = np.load(os.path.join(directory, "item_factors.npy"), mmap_mode='r')
+        # Item rows per (emotion, language), and per emotion across languages
+        contexts = {}
+        for row, (_, language, emotion, _) in enumerate(self.items):
+            contexts.setdefault((emotion, language), []).append(row)
+            if language:
+                contexts.setdefault((emotion, ""), []).append(row)
+        self.contexts = {key: np.array(rows, dtype=np.int64) for key, rows in contexts.items()}
+
+    def user_row(self, username: str) -> Optional[int]:
+        row = int(np.searchsorted(self.users, username))
+        return row if row < len(self.users) and self.users[row] == username else None
+
+    def recommend_artists(self, username: str, emotion: str, language: str = None, limit: int = 5,
+                          exclude: Iterable[str] = ()) -> Tuple[List[Dict], bool]:
+        """Best scored artists for the user in this emotion and language
+
+        Returns the artists ({artist, language, score}) and whether they
+        were personalized (False: most clicked, for users without factors).
+        """
+        rows = self.contexts.get((normalize(emotion), normalize(language or "")))
+        if rows is None:
+            rows = self.contexts.get((normalize(emotion), ""))
+        if rows is None:
+            return [], False
+        excluded = {normalize(artist) for artist in exclude if artist}
+        if excluded:
+            rows = rows[[self.items[row][0] not in excluded for row in rows]]
+        user = self.user_row(username)
+        scores = self.popularity[rows] if user is None else self.item_factors[rows] @ self.user_factors[user]
+        # Across languages an artist can hold several rows; keep enough to fill limit with distinct artists
+        k = min(len(rows), 4 * limit)
+        if k == 0:
+            return [], user is not None
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        artists = {}
+        for i in top:
+            artist, language, _, display = self.items[rows[i]]
+            if artist not in artists and len(artists) < limit:
+                artists[artist] = {"artist": display, "language": language, "score": float(scores[i])}
+        return list(artists.values()), user is not None
+
+_models = {}
+_model_lock = threading.Lock()
+
+def get_cf_model(directory: str = CF_DIR) -> Optional[CFModel]:
+    """The trained model, mapped once per process and again when it is retrained; None if never trained"""
+    version = file_version(os.path.join(directory, "meta.json"))
+    with _model_lock:
+        cached = _models.get(directory)
+        if cached is None or cached[0] != version:
+            try:
+                _models[directory] = (version, CFModel(directory) if version else None)
+            except Exception as e:
+                print(f"Error loading collaborative filtering model: {e}")
+                _models[directory] = (version, None)
+        return _models[directory][1]
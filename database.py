@@ -1,33 +1,128 @@
 import pymongo
 import os
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, time as dt_time, timedelta
+from typing import Dict, Iterable, List, Optional, Any, Callable, Tuple
 import json
+import bson
+import numpy as np
+import pandas as pd
 from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
+
+from analytics import ANALYTICS_FRAME_SCHEMA, AnalyticsState
+from archive import ARCHIVE_AFTER_DAYS, ARCHIVE_SCHEMA, frame_to_docs, history_archive, month_bounds, month_key
+from history_layout import EMOTION_HISTORY_LAYOUT, create_history_layout, insert_documents
+import hyperloglog
+from mood import MoodState
+from spool import EventSpool
+from transitions import (
+    close_spans, emotion_codes, empty_matrices, frame_day_matrices, matrices_by_day, transitions_result
+)
+from storage.base import (
+    HISTORY_FRAME_SCHEMA, STATS_COUNTERS_VERSION, WEEKDAY_NAMES, frame_from_batches, set_path
+)
+
+MONGODB_DATABASE = os.getenv("MONGODB_DATABASE", "enhanced_music_app")
+# Fail fast instead of waiting for pymongo's 30 s default server selection
+MONGODB_TIMEOUT_MS = int(os.getenv("MONGODB_TIMEOUT_MS", "500"))
+# Seconds between background health probes while the breaker is open
+MONGODB_PROBE_INTERVAL = float(os.getenv("MONGODB_PROBE_INTERVAL", "5"))
+# Seconds between drains of deferred writes from the local spool
+SPOOL_FLUSH_INTERVAL = float(os.getenv("SPOOL_FLUSH_INTERVAL", "1.0"))
+READ_CACHE_SIZE = 256
+# Seconds before cached per-user stats are re-read from MongoDB
+USER_STATS_TTL = float(os.getenv("USER_STATS_TTL", "300"))
+USER_STATS_CACHE_SIZE = 1024
+# Documents per raw BSON batch when building DataFrames from a cursor
+FRAME_BATCH_SIZE = int(os.getenv("FRAME_BATCH_SIZE", "5000"))
+# Seconds a detection may take to reach MongoDB (spool, other workers);
+# stored analytics states only hold detections older than this
+ANALYTICS_SETTLE_SECONDS = float(os.getenv("ANALYTICS_SETTLE_SECONDS", "300"))
+ANALYTICS_STATE_CACHE_SIZE = 256
+# Attempts at merging a day's distinct-user sketch before leaving it to a rebuild
+GLOBAL_SKETCH_RETRIES = 5
+GLOBAL_SKETCH_CACHE_SIZE = 64
+
+class CircuitBreaker:
+    """Connection-health breaker so callers skip MongoDB while it is down"""
+    
+    def __init__(self, probe_interval: float = MONGODB_PROBE_INTERVAL):
+        self.probe_interval = probe_interval
+        self.state = "closed"
+        self.opened_at = None
+        self.last_error = None
+        self._lock = threading.Lock()
+    
+    def is_open(self) -> bool:
+        return self.state == "open"
+    
+    def record_success(self):
+        """Close the breaker after a successful probe"""
+        with self._lock:
+            if self.state == "open":
+                print("Database connection restored")
+            self.state = "closed"
+            self.opened_at = None
+            self.last_error = None
+    
+    def record_failure(self, error: Exception) -> bool:
+        """Open the breaker; returns True if it was closed before"""
+        with self._lock:
+            self.last_error = error
+            if self.state == "open":
+                return False
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            return True
 
 class DatabaseManager:
     def __init__(self):
         self.mongodb_uri = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
         self.client = None
         self.db = None
+        self.breaker = CircuitBreaker()
+        self.spool = EventSpool()
+        self._read_cache = OrderedDict()
+        self._write_hooks = {}
+        # Collections whose documents are not stored one per detection (see history_layout.py)
+        self.layouts = {'emotion_history': create_history_layout(EMOTION_HISTORY_LAYOUT)}
+        self._collections_ready = False
+        self._maintenance_thread = None
+        self._maintenance_lock = threading.Lock()
         self._init_connection()
+        self._start_maintenance()
     
     def _init_connection(self):
         """Initialize MongoDB connection"""
         try:
-            self.client = pymongo.MongoClient(self.mongodb_uri)
-            self.db = self.client['enhanced_music_app']
-            
+            self.client = pymongo.MongoClient(
+                self.mongodb_uri,
+                serverSelectionTimeoutMS=MONGODB_TIMEOUT_MS,
+                connectTimeoutMS=MONGODB_TIMEOUT_MS
+            )
+            self.db = self.client[MONGODB_DATABASE]
+        except Exception as e:
+            # Invalid URI or options; nothing a probe could fix
+            print(f"Database connection failed: {e}")
+            self.client = None
+            self.db = None
+            self.breaker.record_failure(e)
+            return
+        
+        try:
             # Test connection
-            self.client.admin.command('ismaster')
+            self.client.admin.command('ping')
             
             # Initialize collections and indexes
             self._setup_collections()
             
         except Exception as e:
             print(f"Database connection failed: {e}")
-            self.client = None
-            self.db = None
+            self.report_failure(e, force=True)
     
     def _setup_collections(self):
         """Setup collections and create indexes"""
@@ -40,11 +135,28 @@ class DatabaseManager:
         users.create_index("email", unique=True)
         users.create_index("created_at")
         
-        # Emotion history collection
-        emotions = self.db['emotion_history']
-        emotions.create_index([("username", 1), ("timestamp", -1)])
-        emotions.create_index("emotion")
-        emotions.create_index("timestamp")
+        # Emotion history collection (layout may fall back, e.g. without time-series support)
+        self.layouts['emotion_history'] = self.layouts['emotion_history'].setup(self.db)
+        
+        # Daily rollups and the archive manifest (see archive_emotion_history)
+        self.db['emotion_daily'].create_index([("username", 1), ("day", 1)])
+        self.db['emotion_archive'].create_index([("username", 1), ("month", 1)])
+        
+        # Emotion transition matrices, per user and across users (see transitions.py)
+        self.db['emotion_transitions'].create_index([("username", 1), ("day", 1)])
+        self.db['emotion_transitions_global'].create_index("day")
+        
+        # Global daily rollups for the admin dashboard (see get_global_analytics)
+        self.db['global_daily'].create_index("day")
+        
+        # Mood alerts raised by the online detector (see mood.py)
+        self.db['mood_alerts'].create_index([("username", 1), ("acknowledged", 1), ("created_at", -1)])
+        
+        # Cache entries shared by every worker (see recommender.py), dropped once expired
+        self.db['shared_cache'].create_index("expires_at", expireAfterSeconds=0)
+        
+        # Backfill ranges and checkpoints (see backfill.py)
+        self.db['backfills'].create_index([("name", 1), ("status", 1)])
         
         # Games history collection
         games = self.db['games_history']
@@ -64,30 +176,896 @@ class DatabaseManager:
         # User preferences collection
         preferences = self.db['user_preferences']
         preferences.create_index("username", unique=True)
+        
+        self._collections_ready = True
+    
+    def is_available(self) -> bool:
+        """True when MongoDB is configured and the breaker is closed"""
+        return self.db is not None and not self.breaker.is_open()
+    
+    def report_failure(self, error: Exception, force: bool = False) -> bool:
+        """Trip the breaker on connectivity errors; returns True if it is open"""
+        if self.client is None:
+            return True
+        if not force and not isinstance(error, ConnectionFailure):
+            return False
+        if self.breaker.record_failure(error):
+            print(f"Database unavailable, switching to degraded mode: {error}")
+        self._start_maintenance()
+        return True
+    
+    def _start_maintenance(self):
+        """Start the background probe/spool drain thread if it is not running"""
+        if self.client is None:
+            return
+        with self._maintenance_lock:
+            if self._maintenance_thread is not None and self._maintenance_thread.is_alive():
+                return
+            self._maintenance_thread = threading.Thread(
+                target=self._maintenance_loop, name="mongodb-maintenance", daemon=True
+            )
+            self._maintenance_thread.start()
+    
+    def _probe(self) -> bool:
+        """Ping MongoDB and close the breaker if it answers"""
+        try:
+            self.client.admin.command('ping')
+            if not self._collections_ready:
+                self._setup_collections()
+        except Exception as e:
+            self.breaker.last_error = e
+            return False
+        self.breaker.record_success()
+        return True
+    
+    def _maintenance_loop(self):
+        """Probe MongoDB while the breaker is open and drain the spool while it is closed"""
+        while True:
+            if self.breaker.is_open():
+                time.sleep(self.breaker.probe_interval)
+                if not self._probe():
+                    continue
+            else:
+                time.sleep(SPOOL_FLUSH_INTERVAL)
+            
+            if self.spool.has_pending():
+                self.flush_pending_writes()
+    
+    def insert_one(self, collection_name: str, doc: Dict, defer: bool = False) -> bool:
+        """Insert a document, spooling it locally if MongoDB is unreachable
+        
+        With defer=True the document always goes to the spool and is bulk
+        inserted by the background drain, which suits high-rate telemetry.
+        """
+        # Client-side _id keeps a later replay idempotent
+        doc.setdefault('_id', ObjectId())
+        collection = None if defer else self.get_collection(collection_name)
+        if collection is None:
+            return self._spool_write(collection_name, doc)
+        
+        try:
+            if collection_name in self.layouts:
+                self._notify_written(collection_name,
+                                     self.layouts[collection_name].insert_documents(collection, [doc]))
+                return True
+            result = collection.insert_one(doc)
+        except DuplicateKeyError:
+            # Same client-side _id: this document is already stored
+            return True
+        except Exception as e:
+            if self.report_failure(e):
+                return self._spool_write(collection_name, doc)
+            print(f"Error inserting into {collection_name}: {e}")
+            return False
+        
+        self._notify_written(collection_name, [doc])
+        return result.inserted_id is not None
+    
+    def add_write_hook(self, collection_name: str, hook: Callable[[List[Dict]], None]):
+        """Call hook with each batch of documents once MongoDB has stored them"""
+        self._write_hooks.setdefault(collection_name, []).append(hook)
+    
+    def _notify_written(self, collection_name: str, docs: List[Dict]):
+        if not docs:
+            return
+        for hook in self._write_hooks.get(collection_name, []):
+            try:
+                hook(docs)
+            except Exception as e:
+                print(f"Error in write hook for {collection_name}: {e}")
+    
+    def _spool_write(self, collection_name: str, doc: Dict) -> bool:
+        if self.client is None:
+            return False
+        try:
+            self.spool.append(collection_name, doc)
+            return True
+        except Exception as e:
+            print(f"Error spooling write for {collection_name}: {e}")
+            return False
+    
+    def _write_batch(self, collection_name: str, docs: List[Dict]):
+        """Bulk insert spooled documents, treating duplicate keys as already written"""
+        collection = self.db[collection_name]
+        if collection_name in self.layouts:
+            stored = self.layouts[collection_name].insert_documents(collection, docs)
+        else:
+            stored = insert_documents(collection, docs)
+        # Only documents stored by this batch count as new writes
+        self._notify_written(collection_name, stored)
+    
+    def flush_pending_writes(self) -> int:
+        """Replay spooled writes; returns the number of documents written"""
+        if not self.is_available():
+            return 0
+        try:
+            return self.spool.replay(self._write_batch)
+        except Exception as e:
+            if not self.report_failure(e):
+                print(f"Error replaying spooled writes: {e}")
+            return 0
+    
+    def cached_read(self, key: Any, fetch: Callable[[], Any], default: Any = None) -> Any:
+        """Run a read, serving the last good result while MongoDB is down"""
+        if not self.is_available():
+            return self._read_cache.get(key, default)
+        try:
+            value = fetch()
+        except Exception as e:
+            if not self.report_failure(e):
+                raise
+            return self._read_cache.get(key, default)
+        
+        self._read_cache[key] = value
+        self._read_cache.move_to_end(key)
+        if len(self._read_cache) > READ_CACHE_SIZE:
+            self._read_cache.popitem(last=False)
+        return value
     
     def get_collection(self, collection_name: str):
-        """Get a MongoDB collection"""
-        if self.db is None:
+        """Get a MongoDB collection, or None while the database is unavailable"""
+        if not self.is_available():
             return None
         return self.db[collection_name]
+    
+    @property
+    def history(self):
+        """Layout of emotion_history; query it through this, never the raw collection"""
+        return self.layouts['emotion_history']
+
+class UserStatsCache:
+    """Per-user sidebar and profile stats kept current by the emotion write path
+    
+    Entries are updated in place as detections are persisted and re-read
+    from MongoDB after USER_STATS_TTL seconds to pick up writes made by
+    other workers.
+    """
+    
+    def __init__(self, ttl: float = USER_STATS_TTL, max_users: int = USER_STATS_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, username: str) -> Dict:
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and time.monotonic() - entry['loaded_at'] < self.ttl:
+                self._entries.move_to_end(username)
+                return dict(entry['stats'], emotions=sorted(entry['stats']['emotions']))
+        
+        stats = self._load(username)
+        if stats is None:
+            # Database unavailable: keep serving whatever we had
+            if entry is not None:
+                return dict(entry['stats'], emotions=sorted(entry['stats']['emotions']))
+            stats = self._empty_stats()
+        else:
+            self._store(username, stats)
+        return dict(stats, emotions=sorted(stats['emotions']))
+    
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+    
+    def record_detections(self, docs: List[Dict]):
+        """Fold newly persisted emotion_history documents into cached entries"""
+        with self._lock:
+            for doc in docs:
+                entry = self._entries.get(doc.get('username'))
+                if entry is None:
+                    continue
+                stats = entry['stats']
+                timestamp = doc.get('timestamp')
+                stats['total_detections'] += 1
+                stats['emotions'].add(doc.get('emotion'))
+                stats['unique_emotions'] = len(stats['emotions'])
+                if timestamp is None:
+                    continue
+                if stats['first_session'] is None or timestamp < stats['first_session']:
+                    stats['first_session'] = timestamp
+                if stats['last_session'] is None or timestamp >= stats['last_session']:
+                    stats['last_session'] = timestamp
+                    stats['last_emotion'] = doc.get('emotion')
+    
+    @staticmethod
+    def _empty_stats() -> Dict:
+        return {
+            "total_detections": 0,
+            "emotions": set(),
+            "unique_emotions": 0,
+            "first_session": None,
+            "last_session": None,
+            "last_emotion": None
+        }
+    
+    def _store(self, username: str, stats: Dict):
+        with self._lock:
+            self._entries[username] = {'stats': stats, 'loaded_at': time.monotonic()}
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+    
+    def _load(self, username: str) -> Optional[Dict]:
+        users = db_manager.get_collection('users')
+        if users is None:
+            return None
+        try:
+            user = users.find_one({"username": username}, {"stats": 1})
+            counters = (user or {}).get("stats") or {}
+            if counters.get("counters_version") == STATS_COUNTERS_VERSION:
+                # Complete counters, maintained by the write hooks
+                stats = self._empty_stats()
+                stats.update({
+                    "total_detections": counters.get("total_emotions", 0),
+                    "emotions": set(counters["emotions"]),
+                    "unique_emotions": len(counters["emotions"]),
+                    "first_session": counters.get("first_emotion_at"),
+                    "last_session": counters.get("last_emotion_at"),
+                    "last_emotion": counters.get("last_emotion")
+                })
+                return stats
+        except Exception as e:
+            db_manager.report_failure(e)
+            print(f"Error loading user stats: {e}")
+            return None
+        
+        return self._load_from_history(username)
+    
+    def _load_from_history(self, username: str) -> Optional[Dict]:
+        """Fallback for users whose counters have not been reconciled yet"""
+        emotions = db_manager.get_collection('emotion_history')
+        if emotions is None:
+            return None
+        try:
+            summary = next(db_manager.history.aggregate(emotions, [
+                {"$match": {"username": username}},
+                {"$sort": {"timestamp": 1}},
+                {"$group": {
+                    "_id": None,
+                    "total": {"$sum": 1},
+                    "emotions": {"$addToSet": "$emotion"},
+                    "first": {"$first": "$timestamp"},
+                    "last": {"$last": "$timestamp"},
+                    "last_emotion": {"$last": "$emotion"}
+                }}
+            ], hint=True), {})
+            stats = self._empty_stats()
+            stats.update({
+                "total_detections": summary.get("total", 0),
+                "emotions": {e for e in summary.get("emotions", []) if e is not None},
+                "first_session": summary.get("first"),
+                "last_session": summary.get("last"),
+                "last_emotion": summary.get("last_emotion")
+            })
+            stats["unique_emotions"] = len(stats["emotions"])
+            return stats
+        except Exception as e:
+            db_manager.report_failure(e)
+            print(f"Error loading user stats: {e}")
+            return None
+
+# users.stats counter maintenance
+def _day_key(timestamp: datetime) -> str:
+    return timestamp.strftime('%Y-%m-%d')
+
+def _day_union(field: str, day: str) -> Dict:
+    return {"$setUnion": [{"$ifNull": [f"${field}", []]}, [day]]}
+
+def active_day_update(username: str, day: str, login: bool = False) -> UpdateOne:
+    """Merge day into stats.active_days (and stats.login_days for a login), in any order"""
+    merged = {"stats.active_days": _day_union("stats.active_days", day)}
+    if login:
+        merged["stats.login_days"] = _day_union("stats.login_days", day)
+    return UpdateOne({"username": username}, [
+        {"$set": merged},
+        {"$set": {
+            "stats.days_active": {"$size": "$stats.active_days"},
+            "stats.last_active_day": {"$max": "$stats.active_days"}
+        }}
+    ])
+
+def _group_by_user(docs: List[Dict]) -> Dict[str, List[Dict]]:
+    per_user = {}
+    for doc in docs:
+        if doc.get('username') and doc.get('timestamp'):
+            per_user.setdefault(doc['username'], []).append(doc)
+    return per_user
+
+def _apply_user_updates(ops: List[UpdateOne]):
+    users = db_manager.get_collection('users')
+    if users is None or not ops:
+        # Drift is repaired by reconcile_user_stats
+        return
+    users.bulk_write(ops, ordered=False)
+
+def _update_emotion_counters(docs: List[Dict]):
+    """Keep users.stats in step with newly stored emotion_history documents"""
+    ops = []
+    for username, user_docs in _group_by_user(docs).items():
+        latest = max(user_docs, key=lambda doc: doc['timestamp'])
+        ops.append(UpdateOne(
+            {
+                "username": username,
+                "$or": [
+                    {"stats.last_emotion_at": None},
+                    {"stats.last_emotion_at": {"$lte": latest['timestamp']}}
+                ]
+            },
+            {"$set": {
+                "stats.last_emotion": latest.get('emotion'),
+                "stats.last_emotion_at": latest['timestamp']
+            }}
+        ))
+        ops.append(UpdateOne(
+            {"username": username},
+            {
+                "$inc": {"stats.total_emotions": len(user_docs)},
+                "$addToSet": {"stats.emotions": {"$each": sorted({doc.get('emotion') for doc in user_docs})}},
+                "$min": {"stats.first_emotion_at": min(doc['timestamp'] for doc in user_docs)}
+            }
+        ))
+        for day in sorted({_day_key(doc['timestamp']) for doc in user_docs}):
+            ops.append(active_day_update(username, day))
+    _apply_user_updates(ops)
+
+def _update_game_counters(docs: List[Dict]):
+    """Keep stats.games_played in step with newly stored games_history documents"""
+    ops = []
+    for username, user_docs in _group_by_user(docs).items():
+        ops.append(UpdateOne({"username": username}, {"$inc": {"stats.games_played": len(user_docs)}}))
+        for day in sorted({_day_key(doc['timestamp']) for doc in user_docs}):
+            ops.append(active_day_update(username, day))
+    _apply_user_updates(ops)
+
+# Daily rollups (emotion_daily): one document per user and UTC day holding
+# every breakdown the Analytics page needs, nested under the emotion
+def _rollup_key(value) -> str:
+    """A value as a safe field name (no dots, no leading $, never empty)"""
+    return "_" + str(value).replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+def _rollup_value(key: str) -> str:
+    return key[1:].replace('%2E', '.').replace('%24', '$').replace('%25', '%')
+
+def _rollup_increments(docs: Iterable[Dict]) -> Dict[Tuple[str, datetime], Dict[str, int]]:
+    """Per (username, day) counter increments for a batch of detections"""
+    increments = {}
+    for doc in docs:
+        timestamp = doc['timestamp']
+        day = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        inc = increments.setdefault((doc['username'], day), {})
+        prefix = f"emotions.{_rollup_key(doc.get('emotion'))}"
+        paths = ["total", f"{prefix}.total", f"{prefix}.hours.{timestamp.hour}"]
+        for field in ('language', 'singer'):
+            if doc.get(field) is not None:
+                paths.append(f"{prefix}.{field}s.{_rollup_key(doc[field])}")
+        for path in paths:
+            inc[path] = inc.get(path, 0) + 1
+    return increments
+
+def _rollup_id(username: str, day: datetime) -> str:
+    return f"{username}|{day.strftime('%Y-%m-%d')}"
+
+def _update_daily_rollups(docs: List[Dict]):
+    """Fold newly stored emotion_history documents into emotion_daily"""
+    ops = [
+        UpdateOne(
+            {"_id": _rollup_id(username, day)},
+            {"$inc": inc, "$setOnInsert": {"username": username, "day": day}},
+            upsert=True
+        )
+        for (username, day), inc in _rollup_increments(docs).items()
+    ]
+    if ops:
+        db_manager.db['emotion_daily'].bulk_write(ops, ordered=False)
+
+def _rollup_analytics(username: str, start_date: datetime = None, end_date: datetime = None,
+                      emotion_filter: List[str] = None) -> Dict:
+    """Analytics counters from daily rollups; whole days only"""
+    day_filter = {}
+    if start_date:
+        day_filter["$gte"] = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    if end_date:
+        day_filter["$lt"] = end_date
+    query = {"username": username}
+    if day_filter:
+        query["day"] = day_filter
+    
+    wanted = {_rollup_key(e) for e in emotion_filter} if emotion_filter else None
+    counters = {name: {} for name in ('emotions', 'daily', 'hourly', 'weekday', 'languages', 'singers')}
+    
+    def add(counts, key, n):
+        counts[key] = counts.get(key, 0) + n
+    
+    for rollup in db_manager.db['emotion_daily'].find(query):
+        day = rollup['day']
+        weekday = WEEKDAY_NAMES[(day.weekday() + 1) % 7]
+        for key, breakdown in rollup.get('emotions', {}).items():
+            if wanted is not None and key not in wanted:
+                continue
+            emotion = _rollup_value(key)
+            add(counters['emotions'], emotion, breakdown.get('total', 0))
+            add(counters['daily'], day.strftime('%Y-%m-%d'), breakdown.get('total', 0))
+            add(counters['weekday'], (weekday, emotion), breakdown.get('total', 0))
+            for hour, n in breakdown.get('hours', {}).items():
+                add(counters['hourly'], (int(hour), emotion), n)
+            for field in ('languages', 'singers'):
+                for value, n in breakdown.get(field, {}).items():
+                    add(counters[field], _rollup_value(value), n)
+    return counters
+
+# Emotion transitions (see transitions.py): emotion_spans holds each user's
+# open span; closed spans are added to emotion_transitions (one document per
+# user and UTC day) and emotion_transitions_global (one per day, all users)
+def _span_state(doc: Optional[Dict]) -> Optional[Dict]:
+    return {field: doc[field] for field in ('emotion', 'start', 'last')} if doc else None
+
+def _matrix_updates(doc_id: str, fields: Dict, counts: np.ndarray, dwell: np.ndarray) -> List[UpdateOne]:
+    """Create a zeroed matrix document if needed, then add counts and dwell to it"""
+    inc = {}
+    for name, matrix in (('counts', counts), ('dwell', dwell)):
+        for i, j in zip(*np.nonzero(matrix)):
+            inc[f"{name}.{i}.{j}"] = int(matrix[i, j])
+    if not inc:
+        return []
+    zero_counts, zero_dwell = empty_matrices()
+    return [
+        UpdateOne({"_id": doc_id},
+                  {"$setOnInsert": dict(fields, counts=zero_counts.tolist(), dwell=zero_dwell.tolist())},
+                  upsert=True),
+        UpdateOne({"_id": doc_id}, {"$inc": inc})
+    ]
+
+def _global_updates(totals: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> List[UpdateOne]:
+    ops = []
+    for day, (counts, dwell) in sorted(totals.items()):
+        ops += _matrix_updates(day, {"day": datetime.strptime(day, '%Y-%m-%d')}, counts, dwell)
+    return ops
+
+def _add_matrices(totals: Dict, day: str, counts: np.ndarray, dwell: np.ndarray):
+    if day in totals:
+        totals[day] = (totals[day][0] + counts, totals[day][1] + dwell)
+    else:
+        totals[day] = (counts, dwell)
+
+def _update_emotion_transitions(docs: List[Dict]):
+    """Close spans with newly stored emotion_history documents and count them
+    
+    Detections older than the user's open span are not re-sequenced;
+    rebuild_emotion_transitions recounts a user from history.
+    """
+    per_user = _group_by_user(docs)
+    if not per_user:
+        return
+    spans = db_manager.db['emotion_spans']
+    open_spans = {doc['_id']: _span_state(doc) for doc in spans.find({"_id": {"$in": list(per_user)}})}
+    user_ops, span_ops, global_totals = [], [], {}
+    for username, user_docs in per_user.items():
+        open_span = open_spans.get(username)
+        times = np.array([doc['timestamp'] for doc in user_docs], dtype='datetime64[ms]').astype(np.int64)
+        codes = emotion_codes(doc.get('emotion') for doc in user_docs)
+        order = np.argsort(times, kind='stable')
+        times, codes = times[order], codes[order]
+        if open_span is not None:
+            in_order = times >= open_span['last']
+            times, codes = times[in_order], codes[in_order]
+        if len(times) == 0:
+            continue
+        closed, still_open = close_spans(times, codes, open_span)
+        for day, (counts, dwell) in matrices_by_day(closed).items():
+            user_ops += _matrix_updates(f"{username}|{day}",
+                                        {"username": username, "day": datetime.strptime(day, '%Y-%m-%d')},
+                                        counts, dwell)
+            _add_matrices(global_totals, day, counts, dwell)
+        span_ops.append(ReplaceOne({"_id": username}, still_open, upsert=True))
+    # Ordered, so each $inc follows the upsert that creates its document
+    if user_ops:
+        db_manager.db['emotion_transitions'].bulk_write(user_ops, ordered=True)
+    global_ops = _global_updates(global_totals)
+    if global_ops:
+        db_manager.db['emotion_transitions_global'].bulk_write(global_ops, ordered=True)
+    if span_ops:
+        spans.bulk_write(span_ops, ordered=False)
+
+# Global daily rollups (global_daily): one document per UTC day across all
+# users for the admin dashboard. Distinct users are HyperLogLog sketches,
+# merged in with a compare-and-set on sketch_version
+_global_sketches = OrderedDict()
+_global_lock = threading.Lock()
+
+def _global_increments(docs: List[Dict], paths: Callable[[Dict], List[str]]) -> Tuple[Dict, Dict]:
+    """Per-day counter increments and the users seen on each day"""
+    increments, users = {}, {}
+    for doc in docs:
+        if not doc.get('timestamp'):
+            continue
+        day = _day_key(doc['timestamp'])
+        inc = increments.setdefault(day, {})
+        for path in paths(doc):
+            inc[path] = inc.get(path, 0) + 1
+        if doc.get('username'):
+            users.setdefault(day, set()).add(doc['username'])
+    return increments, users
+
+def _merge_global_sketch(day: str, name: str, added: np.ndarray):
+    """Fold a sketch into the day's stored one, unless it adds nothing"""
+    with _global_lock:
+        known = _global_sketches.get((day, name))
+    if known is not None and (added <= known).all():
+        return
+    collection = db_manager.db['global_daily']
+    for _ in range(GLOBAL_SKETCH_RETRIES):
+        doc = collection.find_one({"_id": day}, {f"sketches.{name}": 1, "sketch_version": 1})
+        if doc is None:
+            return
+        stored = hyperloglog.from_bytes(doc.get('sketches', {}).get(name))
+        merged = np.maximum(stored, added)
+        if (merged != stored).any():
+            result = collection.update_one(
+                {"_id": day, "sketch_version": doc.get('sketch_version', 0)},
+                {
+                    "$set": {f"sketches.{name}": bson.Binary(hyperloglog.to_bytes(merged))},
+                    "$inc": {"sketch_version": 1}
+                }
+            )
+            if result.matched_count == 0:
+                # Another writer merged first; merge into its sketch
+                continue
+        with _global_lock:
+            _global_sketches[(day, name)] = merged
+            _global_sketches.move_to_end((day, name))
+            while len(_global_sketches) > GLOBAL_SKETCH_CACHE_SIZE:
+                _global_sketches.popitem(last=False)
+        return
+    print(f"Gave up merging the {name} sketch of {day}; rebuild_global_daily repairs it")
+
+def _update_global_daily(docs: List[Dict], paths: Callable[[Dict], List[str]], sketches: Tuple[str, ...]):
+    increments, users = _global_increments(docs, paths)
+    ops = [
+        UpdateOne({"_id": day},
+                  {"$inc": inc, "$setOnInsert": {"day": datetime.strptime(day, '%Y-%m-%d'), "sketch_version": 0}},
+                  upsert=True)
+        for day, inc in increments.items()
+    ]
+    if not ops:
+        return
+    db_manager.db['global_daily'].bulk_write(ops, ordered=False)
+    for day, day_users in users.items():
+        added = hyperloglog.sketch(day_users)
+        for name in sketches:
+            _merge_global_sketch(day, name, added)
+
+def _global_detection_paths(doc: Dict) -> List[str]:
+    return ["detections", f"emotions.{_rollup_key(doc.get('emotion'))}", f"hours.{doc['timestamp'].hour}"]
+
+def _global_game_paths(doc: Dict) -> List[str]:
+    return ["games"]
+
+def _global_click_paths(doc: Dict) -> List[str]:
+    return ["clicks", f"platforms.{_rollup_key(doc.get('platform'))}"]
+
+def _update_global_detections(docs: List[Dict]):
+    _update_global_daily(docs, _global_detection_paths, ("active",))
+
+def _update_global_games(docs: List[Dict]):
+    _update_global_daily(docs, _global_game_paths, ("active",))
+
+def _update_global_clicks(docs: List[Dict]):
+    _update_global_daily(docs, _global_click_paths, ("active", "clickers"))
+
+# Mood monitoring (see mood.py): one fixed-size MoodState per user in
+# mood_state; alerts go to mood_alerts for users with profile.emotion_alerts
+def _update_mood_states(docs: List[Dict]):
+    """Feed newly stored emotion_history documents to the users' mood detectors"""
+    per_user = _group_by_user(docs)
+    if not per_user:
+        return
+    states = db_manager.db['mood_state']
+    stored = {doc['_id']: doc for doc in states.find({"_id": {"$in": list(per_user)}})}
+    ops, alerts = [], []
+    for username, user_docs in per_user.items():
+        state = MoodState.from_document(stored.get(username))
+        for doc in sorted(user_docs, key=lambda doc: doc['timestamp']):
+            for alert in state.add(doc['timestamp'], doc.get('emotion')):
+                alerts.append(dict(alert, username=username))
+        ops.append(ReplaceOne({"_id": username}, state.to_document(), upsert=True))
+    states.bulk_write(ops, ordered=False)
+    
+    if alerts:
+        subscribed = {user['username'] for user in db_manager.db['users'].find(
+            {"username": {"$in": list({alert['username'] for alert in alerts})}, "profile.emotion_alerts": True},
+            {"username": 1}
+        )}
+        now = datetime.utcnow()
+        wanted = [dict(alert, created_at=now, acknowledged=False)
+                  for alert in alerts if alert['username'] in subscribed]
+        if wanted:
+            db_manager.db['mood_alerts'].insert_many(wanted)
+
+# Incremental analytics (analytics_state): one AnalyticsState per user, keyed
+# by username, with a revision bumped on every save and a dirty_from mark
+# set by late writes that land behind the state's high-water mark.
+# history_revision changes with every write, archive run, backfill or
+# import touching the user's history, for keying caches of derived data
+_analytics_states = OrderedDict()
+_analytics_lock = threading.Lock()
+
+def _mark_late_detections(docs: List[Dict]):
+    """Give each user a new history revision, and flag states that may be past detections written late"""
+    settled = datetime.utcnow() - timedelta(seconds=ANALYTICS_SETTLE_SECONDS)
+    ops = []
+    for username, user_docs in _group_by_user(docs).items():
+        update = {"$set": {"history_revision": ObjectId()}}
+        oldest = min(doc['timestamp'] for doc in user_docs)
+        if oldest < settled:
+            update["$min"] = {"dirty_from": oldest}
+        ops.append(UpdateOne({"_id": username}, update, upsert=True))
+    if ops:
+        db_manager.db['analytics_state'].bulk_write(ops, ordered=False)
+
+def get_history_revision(username: str) -> Optional[ObjectId]:
+    """The user's current history revision; None before their first write"""
+    states = db_manager.get_collection('analytics_state')
+    if states is None:
+        return None
+    doc = states.find_one({"_id": username}, {"history_revision": 1})
+    return doc.get("history_revision") if doc else None
+
+def _fold_history(state: AnalyticsState, username: str, until: datetime = None):
+    """Fold the user's detections after the state's high-water mark (and before until)"""
+    query = {"username": username}
+    if state.high_water:
+        timestamp, last_id = state.high_water
+        query["timestamp"] = {"$gte": timestamp}
+        if last_id is not None:
+            query["$nor"] = [{"timestamp": timestamp, "_id": {"$lte": last_id}}]
+    if until:
+        query.setdefault("timestamp", {})["$lt"] = until
+    state.fold(find_frame('emotion_history', query, ANALYTICS_FRAME_SCHEMA,
+                          sort=[("timestamp", 1), ("_id", 1)]))
+
+def _analytics_state(username: str) -> AnalyticsState:
+    """The user's analytics state with every detection folded in
+    
+    Only settled detections are saved; newer ones are folded into the copy
+    that is returned.
+    """
+    states = db_manager.db['analytics_state']
+    settled = datetime.utcnow() - timedelta(seconds=ANALYTICS_SETTLE_SECONDS)
+    with _analytics_lock:
+        # Clear the mark before reading history: late writes from now on mark again
+        marker = states.find_one_and_update({"_id": username}, {"$unset": {"dirty_from": ""}},
+                                            {"dirty_from": 1, "revision": 1}) or {}
+        cached = _analytics_states.get(username)
+        if cached is not None and cached[0] == marker.get("revision"):
+            revision, state = cached
+        else:
+            revision = marker.get("revision")
+            state = AnalyticsState.from_document(states.find_one({"_id": username}) if marker else None)
+        
+        saved_mark = state.high_water
+        dirty_from = marker.get("dirty_from")
+        if dirty_from and state.high_water and dirty_from <= state.high_water[0]:
+            day = _day_key(dirty_from)
+            state.truncate(day)
+            # Refold from the start of that day; no earlier detection shares a day with it
+            state.high_water = (datetime.strptime(day, '%Y-%m-%d'), None)
+        _fold_history(state, username, until=settled)
+        
+        if state.high_water != saved_mark:
+            try:
+                saved = states.find_one_and_update(
+                    {"_id": username, "revision": revision},
+                    {"$set": dict(state.to_document(), updated_at=datetime.utcnow()), "$inc": {"revision": 1}},
+                    {"revision": 1}, upsert=True, return_document=pymongo.ReturnDocument.AFTER
+                )
+                revision = saved["revision"]
+            except DuplicateKeyError:
+                # Another worker saved first; reload its state next time
+                revision = None
+        _analytics_states[username] = (revision, state)
+        _analytics_states.move_to_end(username)
+        while len(_analytics_states) > ANALYTICS_STATE_CACHE_SIZE:
+            _analytics_states.popitem(last=False)
+        snapshot = state.copy()
+    
+    _fold_history(snapshot, username)
+    return snapshot
+
+def invalidate_analytics_state(username: str):
+    """Drop the stored analytics state after history changed outside the write path"""
+    with _analytics_lock:
+        _analytics_states.pop(username, None)
+    states = db_manager.get_collection('analytics_state')
+    if states is not None:
+        # Drops the state but not the revision, which moves on so derived caches rebuild
+        states.replace_one({"_id": username}, {"history_revision": ObjectId()}, upsert=True)
+
+def _whole_days(start_date: Optional[datetime], end_date: Optional[datetime]) -> bool:
+    return ((start_date is None or start_date.time() == dt_time.min)
+            and (end_date is None or end_date.time() == dt_time.max))
+
+def reconcile_user_stats(batch_size: int = 500, usernames: List[str] = None) -> int:
+    """Recompute users.stats counters from emotion_history and games_history
+    
+    Walks users (all of them, or only usernames) in _id order, aggregating
+    history for one batch of usernames at a time. Returns the number of
+    users updated. total_sessions is left
+    alone since logins are not kept as history. days_active counts the same
+    days as the live updates: days with detections or games plus the login
+    days kept in stats.login_days. Archived months count through their daily
+    rollups and the emotion_archive manifest.
+    """
+    users = db_manager.get_collection('users')
+    if users is None:
+        print("Database connection not available")
+        return 0
+    
+    emotions = db_manager.db['emotion_history']
+    games = db_manager.db['games_history']
+    day_expr = {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}
+    selection = {"username": {"$in": list(usernames)}} if usernames is not None else {}
+    updated = 0
+    last_id = None
+    
+    while True:
+        query = dict(selection, _id={"$gt": last_id}) if last_id is not None else dict(selection)
+        batch = list(users.find(query, {"username": 1, "stats.login_days": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+        usernames = [user["username"] for user in batch]
+        login_days = {user["username"]: (user.get("stats") or {}).get("login_days", []) for user in batch}
+        
+        emotion_stats = {
+            doc["_id"]: doc for doc in db_manager.history.aggregate(emotions, [
+                {"$match": {"username": {"$in": usernames}}},
+                {"$sort": {"username": 1, "timestamp": -1}},
+                {"$group": {
+                    "_id": "$username",
+                    "total": {"$sum": 1},
+                    "emotions": {"$addToSet": "$emotion"},
+                    "first": {"$min": "$timestamp"},
+                    "last": {"$max": "$timestamp"},
+                    "last_emotion": {"$first": "$emotion"},
+                    "days": {"$addToSet": day_expr}
+                }}
+            ], allowDiskUse=True)
+        }
+        archived_stats = {
+            doc["_id"]: doc for doc in db_manager.db['emotion_daily'].aggregate([
+                {"$match": {"username": {"$in": usernames}, "archived": True}},
+                {"$group": {
+                    "_id": "$username",
+                    "total": {"$sum": "$total"},
+                    "emotions": {"$push": {"$map": {
+                        "input": {"$objectToArray": "$emotions"}, "in": "$$this.k"
+                    }}},
+                    "days": {"$addToSet": {"$dateToString": {"format": "%Y-%m-%d", "date": "$day"}}}
+                }}
+            ])
+        }
+        for doc in db_manager.db['emotion_archive'].aggregate([
+            {"$match": {"username": {"$in": usernames}}},
+            {"$sort": {"month": 1}},
+            {"$group": {
+                "_id": "$username",
+                "first": {"$first": "$first"},
+                "last": {"$last": "$last"},
+                "last_emotion": {"$last": "$last_emotion"}
+            }}
+        ]):
+            archived_stats.setdefault(doc["_id"], {}).update(doc)
+        
+        game_stats = {
+            doc["_id"]: doc for doc in games.aggregate([
+                {"$match": {"username": {"$in": usernames}}},
+                {"$group": {
+                    "_id": "$username",
+                    "total": {"$sum": 1},
+                    "days": {"$addToSet": day_expr}
+                }}
+            ], allowDiskUse=True)
+        }
+        
+        ops = []
+        for username in usernames:
+            emotion_doc = dict(emotion_stats.get(username, {}))
+            game_doc = game_stats.get(username, {})
+            archived_doc = archived_stats.get(username)
+            if archived_doc:
+                emotion_doc["total"] = emotion_doc.get("total", 0) + archived_doc.get("total", 0)
+                emotion_doc["emotions"] = set(emotion_doc.get("emotions", [])) | {
+                    _rollup_value(key) for keys in archived_doc.get("emotions", []) for key in keys
+                }
+                emotion_doc["days"] = set(emotion_doc.get("days", [])) | set(archived_doc.get("days", []))
+                if "first" in archived_doc:
+                    emotion_doc["first"] = min(filter(None, [emotion_doc.get("first"), archived_doc["first"]]))
+                    if "last" not in emotion_doc or archived_doc["last"] > emotion_doc["last"]:
+                        emotion_doc["last"] = archived_doc["last"]
+                        emotion_doc["last_emotion"] = archived_doc.get("last_emotion")
+            days = set(emotion_doc.get("days", [])) | set(game_doc.get("days", [])) | set(login_days[username])
+            update = {
+                "stats.total_emotions": emotion_doc.get("total", 0),
+                "stats.emotions": sorted(e for e in emotion_doc.get("emotions", []) if e is not None),
+                "stats.games_played": game_doc.get("total", 0),
+                "stats.days_active": len(days),
+                "stats.active_days": sorted(days),
+                "stats.last_emotion": emotion_doc.get("last_emotion"),
+                "stats.counters_version": STATS_COUNTERS_VERSION
+            }
+            unset = {}
+            for field, key in (("stats.first_emotion_at", "first"), ("stats.last_emotion_at", "last")):
+                if key in emotion_doc:
+                    update[field] = emotion_doc[key]
+                else:
+                    unset[field] = ""
+            if days:
+                update["stats.last_active_day"] = max(days)
+            
+            change = {"$set": update}
+            if unset:
+                change["$unset"] = unset
+            ops.append(UpdateOne({"username": username}, change))
+        
+        if ops:
+            updated += users.bulk_write(ops, ordered=False).matched_count
+    
+    return updated
 
 # Initialize database manager
 db_manager = DatabaseManager()
+user_stats_cache = UserStatsCache()
+db_manager.add_write_hook('emotion_history', user_stats_cache.record_detections)
+db_manager.add_write_hook('emotion_history', _update_emotion_counters)
+db_manager.add_write_hook('emotion_history', _update_daily_rollups)
+db_manager.add_write_hook('emotion_history', _mark_late_detections)
+db_manager.add_write_hook('emotion_history', _update_emotion_transitions)
+db_manager.add_write_hook('emotion_history', _update_global_detections)
+db_manager.add_write_hook('emotion_history', _update_mood_states)
+db_manager.add_write_hook('games_history', _update_game_counters)
+db_manager.add_write_hook('games_history', _update_global_games)
+db_manager.add_write_hook('music_recommendations', _update_global_clicks)
 
 # User Profile Functions
+def get_user_quick_stats(username: str) -> Dict:
+    """Total detections, distinct emotions, first/last session and last emotion
+    
+    Served from user_stats_cache, so page renders do not query emotion_history.
+    """
+    return user_stats_cache.get(username)
+
 def get_user_profile(username: str) -> Optional[Dict]:
     """Get user profile information"""
     try:
-        users = db_manager.get_collection('users')
-        if users is None:
-            return None
-        
-        user = users.find_one({"username": username})
-        if user:
-            # Convert ObjectId to string for JSON serialization
-            user['_id'] = str(user['_id'])
+        def fetch():
+            user = db_manager.db['users'].find_one({"username": username})
+            if user:
+                # Convert ObjectId to string for JSON serialization
+                user['_id'] = str(user['_id'])
             return user
-        return None
+        
+        return db_manager.cached_read(('profile', username), fetch)
         
     except Exception as e:
         print(f"Error getting user profile: {e}")
@@ -104,10 +1082,10 @@ def update_user_preferences(username: str, preferences: Dict) -> bool:
         result = users.update_one(
             {"username": username},
             {
-                "$set": {
-                    f"profile.{key}": value for key, value in preferences.items()
-                },
-                "$set": {"updated_at": datetime.utcnow()}
+                "$set": dict(
+                    {f"profile.{key}": value for key, value in preferences.items()},
+                    updated_at=datetime.utcnow()
+                )
             }
         )
         
@@ -119,25 +1097,20 @@ def update_user_preferences(username: str, preferences: Dict) -> bool:
 
 # Emotion Detection Functions
 def save_emotion_detection(username: str, emotion: str, language: str = "", 
-                         artist: str = "", confidence: float = 0.0) -> bool:
+                         singer: str = "", confidence: float = 0.0) -> bool:
     """Save emotion detection result"""
     try:
-        emotions = db_manager.get_collection('emotion_history')
-        if emotions is None:
-            return False
-        
         emotion_doc = {
             "username": username,
             "emotion": emotion,
             "language": language,
-            "artist": artist,
+            "singer": singer,
             "confidence": confidence,
             "timestamp": datetime.utcnow(),
             "session_id": f"{username}_{datetime.now().strftime('%Y%m%d')}"
         }
         
-        result = emotions.insert_one(emotion_doc)
-        return result.inserted_id is not None
+        return db_manager.insert_one('emotion_history', emotion_doc)
         
     except Exception as e:
         print(f"Error saving emotion detection: {e}")
@@ -145,38 +1118,24 @@ def save_emotion_detection(username: str, emotion: str, language: str = "",
 
 def get_emotion_history(username: str, start_date: datetime = None, 
                        end_date: datetime = None, 
-                       emotion_filter: List[str] = None) -> List[Dict]:
+                       emotion_filter: List[str] = None,
+                       limit: int = 1000) -> List[Dict]:
     """Get emotion detection history for a user"""
     try:
-        emotions = db_manager.get_collection('emotion_history')
-        if emotions is None:
-            return []
-        
-        # Build query
-        query = {"username": username}
-        
-        # Add date range filter
-        if start_date or end_date:
-            date_filter = {}
-            if start_date:
-                date_filter["$gte"] = start_date
-            if end_date:
-                date_filter["$lte"] = end_date
-            query["timestamp"] = date_filter
-        
-        # Add emotion filter
-        if emotion_filter:
-            query["emotion"] = {"$in": emotion_filter}
-        
-        # Execute query
-        cursor = emotions.find(query).sort("timestamp", -1).limit(1000)
+        query = build_history_match(username, start_date, end_date, emotion_filter)
         
-        history = []
-        for doc in cursor:
-            doc['_id'] = str(doc['_id'])  # Convert ObjectId to string
-            history.append(doc)
+        def fetch():
+            cursor = db_manager.history.find(db_manager.db['emotion_history'], query,
+                                             sort=[("timestamp", -1)], limit=limit)
+            
+            history = []
+            for doc in cursor:
+                doc['_id'] = str(doc['_id'])  # Convert ObjectId to string
+                history.append(doc)
+            return history
         
-        return history
+        key = ('history', username, start_date, end_date, tuple(emotion_filter or ()), limit)
+        return db_manager.cached_read(key, fetch, [])
         
     except Exception as e:
         print(f"Error getting emotion history: {e}")
@@ -185,10 +1144,6 @@ def get_emotion_history(username: str, start_date: datetime = None,
 def get_emotion_statistics(username: str, days: int = 30) -> Dict:
     """Get emotion statistics for a user"""
     try:
-        emotions = db_manager.get_collection('emotion_history')
-        if emotions is None:
-            return {}
-        
         # Date range for the last N days
         end_date = datetime.utcnow()
         start_date = end_date - timedelta(days=days)
@@ -212,7 +1167,11 @@ def get_emotion_statistics(username: str, days: int = 30) -> Dict:
             }
         ]
         
-        results = list(emotions.aggregate(pipeline))
+        results = db_manager.cached_read(
+            ('statistics', username, days),
+            lambda: list(db_manager.history.aggregate(db_manager.db['emotion_history'], pipeline)),
+            []
+        )
         
         # Format results
         stats = {
@@ -229,39 +1188,657 @@ def get_emotion_statistics(username: str, days: int = 30) -> Dict:
     except Exception as e:
         print(f"Error getting emotion statistics: {e}")
         return {}
-def save_music_recommendation(username: str, platform: str, query: str, 
-                            emotion: str, language: str = "", artist: str = "") -> bool:
-    """Save music recommendation activity"""
+
+def build_history_match(username: str, start_date: datetime = None,
+                        end_date: datetime = None,
+                        emotion_filter: List[str] = None) -> Dict:
+    """Build an emotion_history filter that can use the (username, timestamp) index"""
+    match = {"username": username}
+    if start_date or end_date:
+        date_filter = {}
+        if start_date:
+            date_filter["$gte"] = start_date
+        if end_date:
+            date_filter["$lte"] = end_date
+        match["timestamp"] = date_filter
+    if emotion_filter:
+        match["emotion"] = {"$in": list(emotion_filter)}
+    return match
+
+def find_frame(collection_name: str, query: Dict, schema: Dict[str, str],
+               sort: List = None, limit: int = 0) -> pd.DataFrame:
+    """Run a find straight into a typed DataFrame (see storage.base.frame_from_batches)
+
+    Only the schema's fields are projected, and the cursor is read as raw
+    BSON batches decoded in one C call each, so no per-document dicts with
+    _id and unused fields pile up before pandas sees them.
+    """
+    projection = {field: 1 for field in schema}
+    if '_id' not in schema:
+        projection['_id'] = 0
+    collection = db_manager.db[collection_name]
+    if collection_name in db_manager.layouts:
+        cursor = db_manager.layouts[collection_name].find_raw_batches(
+            collection, query, projection, sort=sort, limit=limit, batch_size=FRAME_BATCH_SIZE
+        )
+    else:
+        cursor = collection.find_raw_batches(
+            query, projection, sort=sort, limit=limit, batch_size=FRAME_BATCH_SIZE
+        )
+    return frame_from_batches((bson.decode_all(batch) for batch in cursor), schema)
+
+def get_emotion_page(username: str, before: Tuple[datetime, Any] = None,
+                     page_size: int = 20, emotion_filter: List[str] = None,
+                     language_filter: List[str] = None,
+                     include_archive: bool = False) -> Tuple[List[Dict], Optional[Tuple]]:
+    """One page of history older than the (timestamp, _id) cursor; see StorageBackend.get_emotion_page"""
     try:
-        recommendations = db_manager.get_collection('music_recommendations')
-        if recommendations is None:
-            return False
+        query = build_history_match(username, emotion_filter=emotion_filter)
+        if language_filter:
+            query["language"] = {"$in": list(language_filter)}
+        if before:
+            timestamp, last_id = before
+            if isinstance(last_id, str) and ObjectId.is_valid(last_id):
+                # Cursor taken from an archived row, which keeps _id as hex
+                last_id = ObjectId(last_id)
+            if last_id is None:
+                query["timestamp"] = {"$lt": timestamp}
+            else:
+                # One index range (timestamp <= cursor) minus the ties already shown
+                query["timestamp"] = {"$lte": timestamp}
+                query["$nor"] = [{"timestamp": timestamp, "_id": {"$gte": last_id}}]
         
-        rec_doc = {
-            "username": username,
-            "platform": platform,
-            "query": query,
-            "emotion": emotion,
-            "language": language,
-            "artist": artist,
-            "timestamp": datetime.utcnow()
+        def fetch():
+            cursor = db_manager.history.find(db_manager.db['emotion_history'], query,
+                                             sort=[("timestamp", -1), ("_id", -1)],
+                                             limit=page_size + 1, hint=True)
+            return list(cursor)
+        
+        key = ('history_page', username, before, page_size,
+               tuple(emotion_filter or ()), tuple(language_filter or ()))
+        docs = db_manager.cached_read(key, fetch, [])
+        archived = _archived_filter(username) if include_archive else None
+        if archived is not None:
+            # Late writes can leave hot documents among archived ones, so merge both sides,
+            # keeping only the archive's copy of detections that are in both
+            docs = [doc for doc in docs if not archived(doc)]
+            docs = docs + history_archive.page(username, before, page_size, emotion_filter, language_filter)
+            docs.sort(key=lambda doc: (doc['timestamp'], str(doc['_id'])), reverse=True)
+        
+        page = docs[:page_size]
+        # The cursor keeps the native _id so the next range query compares like with like
+        next_cursor = (page[-1]['timestamp'], page[-1]['_id']) if len(docs) > page_size else None
+        return [dict(doc, _id=str(doc['_id'])) for doc in page], next_cursor
+        
+    except Exception as e:
+        print(f"Error getting emotion history page: {e}")
+        return [], None
+
+def get_emotion_frame(username: str, start_date: datetime = None,
+                      end_date: datetime = None,
+                      emotion_filter: List[str] = None,
+                      limit: int = 1000) -> pd.DataFrame:
+    """Emotion history as a typed DataFrame, newest first"""
+    try:
+        query = build_history_match(username, start_date, end_date, emotion_filter)
+        
+        def fetch():
+            return find_frame('emotion_history', query, HISTORY_FRAME_SCHEMA,
+                              sort=[("timestamp", -1)], limit=limit)
+        
+        key = ('history_frame', username, start_date, end_date, tuple(emotion_filter or ()), limit)
+        return db_manager.cached_read(key, fetch, frame_from_batches([], HISTORY_FRAME_SCHEMA))
+        
+    except Exception as e:
+        print(f"Error getting emotion history frame: {e}")
+        return frame_from_batches([], HISTORY_FRAME_SCHEMA)
+
+def iter_emotion_frames(username: str, start_date: datetime = None,
+                        end_date: datetime = None,
+                        emotion_filter: List[str] = None,
+                        batch_size: int = FRAME_BATCH_SIZE,
+                        include_archive: bool = False):
+    """Stream the complete matching history as DataFrame chunks, oldest first"""
+    archived = None
+    if include_archive:
+        for frame in history_archive.iter_frames(username, start_date, end_date, emotion_filter):
+            yield frame[list(HISTORY_FRAME_SCHEMA)]
+        archived = _archived_filter(username)
+    
+    query = build_history_match(username, start_date, end_date, emotion_filter)
+    projection = {field: 1 for field in HISTORY_FRAME_SCHEMA}
+    if archived is None:
+        projection['_id'] = 0
+    cursor = db_manager.history.find_raw_batches(
+        db_manager.db['emotion_history'], query, projection,
+        sort=[("timestamp", 1)], batch_size=batch_size
+    )
+    for batch in cursor:
+        docs = bson.decode_all(batch)
+        if archived is not None:
+            docs = [doc for doc in docs if not archived(doc)]
+        yield frame_from_batches([docs], HISTORY_FRAME_SCHEMA)
+
+def get_emotion_analytics(username: str, start_date: datetime = None,
+                          end_date: datetime = None,
+                          emotion_filter: List[str] = None,
+                          include_archive: bool = False) -> Dict:
+    """Compute the Analytics page breakdowns
+    
+    Whole-day ranges (as the Analytics page asks for) are answered from the
+    user's incremental analytics state, which only reads detections newer
+    than its high-water mark. Other ranges run one $facet aggregation, so
+    only the grouped results come back. With include_archive, days before
+    the user's archive boundary are counted from the emotion_daily rollups.
+    """
+    try:
+        boundary = get_archive_boundary(username) if include_archive else None
+        use_rollups = boundary is not None and (start_date is None or start_date < boundary)
+        # Rollups cover everything before the boundary, emotion_history the rest
+        hot_start = boundary if use_rollups else start_date
+        match = build_history_match(username, hot_start, end_date, emotion_filter)
+        
+        def top_values(field):
+            stages = [
+                {"$match": {field: {"$exists": True, "$ne": None}}},
+                {"$sortByCount": f"${field}"}
+            ]
+            # Merging with rollups needs every value before taking the top 10
+            return stages if use_rollups else stages + [{"$limit": 10}]
+        
+        pipeline = [
+            {"$match": match},
+            {"$project": {"_id": 0, "emotion": 1, "timestamp": 1, "language": 1, "singer": 1}},
+            {
+                "$facet": {
+                    "emotions": [{"$sortByCount": "$emotion"}],
+                    "daily": [
+                        {"$group": {
+                            "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}},
+                            "count": {"$sum": 1}
+                        }},
+                        {"$sort": {"_id": 1}}
+                    ],
+                    "hourly": [
+                        {"$group": {
+                            "_id": {"hour": {"$hour": "$timestamp"}, "emotion": "$emotion"},
+                            "count": {"$sum": 1}
+                        }}
+                    ],
+                    "weekday": [
+                        {"$group": {
+                            "_id": {"weekday": {"$dayOfWeek": "$timestamp"}, "emotion": "$emotion"},
+                            "count": {"$sum": 1}
+                        }}
+                    ],
+                    "languages": top_values("language"),
+                    "singers": top_values("singer")
+                }
+            }
+        ]
+        
+        def fetch():
+            if _whole_days(hot_start, end_date):
+                return _analytics_state(username).counters(
+                    _day_key(hot_start) if hot_start else None,
+                    _day_key(end_date) if end_date else None,
+                    emotion_filter
+                )
+            
+            cursor = db_manager.history.aggregate(
+                db_manager.db['emotion_history'], pipeline, hint=True, allowDiskUse=True
+            )
+            result = next(cursor, {})
+            return {
+                "emotions": {doc["_id"]: doc["count"] for doc in result.get("emotions", [])},
+                "daily": {doc["_id"]: doc["count"] for doc in result.get("daily", [])},
+                "hourly": {(doc["_id"]["hour"], doc["_id"]["emotion"]): doc["count"]
+                           for doc in result.get("hourly", [])},
+                "weekday": {(WEEKDAY_NAMES[doc["_id"]["weekday"] - 1], doc["_id"]["emotion"]): doc["count"]
+                            for doc in result.get("weekday", [])},
+                "languages": {doc["_id"]: doc["count"] for doc in result.get("languages", [])},
+                "singers": {doc["_id"]: doc["count"] for doc in result.get("singers", [])}
+            }
+        
+        key = ('analytics', username, hot_start, end_date, tuple(emotion_filter or ()), use_rollups)
+        empty = {name: {} for name in ('emotions', 'daily', 'hourly', 'weekday', 'languages', 'singers')}
+        # Copied, since rollup counts are merged in below
+        counters = {name: dict(counts) for name, counts in db_manager.cached_read(key, fetch, empty).items()}
+        if use_rollups:
+            archived_end = min(end_date, boundary) if end_date else boundary
+            for name, counts in _rollup_analytics(username, start_date, archived_end, emotion_filter).items():
+                for k, n in counts.items():
+                    counters[name][k] = counters[name].get(k, 0) + n
+        
+        def top(counts, n=None):
+            return dict(sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:n])
+        
+        return {
+            "total_detections": sum(counters["emotions"].values()),
+            "emotion_counts": top(counters["emotions"]),
+            "daily_counts": sorted(counters["daily"].items()),
+            "hourly": [{"hour": h, "emotion": e, "count": c} for (h, e), c in counters["hourly"].items()],
+            "weekday": [{"weekday": w, "emotion": e, "count": c} for (w, e), c in counters["weekday"].items()],
+            "language_counts": top(counters["languages"], 10),
+            "singer_counts": top(counters["singers"], 10)
         }
         
-        result = recommendations.insert_one(rec_doc)
-        return result.inserted_id is not None
+    except Exception as e:
+        print(f"Error getting emotion analytics: {e}")
+        return {}
+
+def get_emotion_transitions(username: Optional[str], start_date: datetime = None,
+                            end_date: datetime = None) -> Dict:
+    """Emotion transition counts and dwell-time histograms over whole days
+    
+    username None answers for all users from emotion_transitions_global,
+    one document per day, so no per-user data is read.
+    
+    Counts are kept as detections arrive, and a detection older than the
+    user's open span is skipped, so the counts can be approximate after
+    out-of-order writes (late spool replays, imports) until
+    rebuild_emotion_transitions recounts the user.
+    """
+    try:
+        query = {}
+        if start_date or end_date:
+            query["day"] = {}
+            if start_date:
+                query["day"]["$gte"] = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            if end_date:
+                query["day"]["$lt"] = end_date
+        if username is None:
+            collection = db_manager.db['emotion_transitions_global']
+        else:
+            collection = db_manager.db['emotion_transitions']
+            query["username"] = username
+        
+        def fetch():
+            counts, dwell = empty_matrices()
+            for doc in collection.find(query, {"_id": 0, "counts": 1, "dwell": 1}):
+                counts += np.asarray(doc['counts'], dtype=np.int64)
+                dwell += np.asarray(doc['dwell'], dtype=np.int64)
+            return transitions_result(counts, dwell)
+        
+        return db_manager.cached_read(('transitions', username, start_date, end_date), fetch, {})
         
     except Exception as e:
-        print(f"Error saving music recommendation: {e}")
-        return False
+        print(f"Error getting emotion transitions: {e}")
+        return {}
+
+def get_global_analytics(start_date: datetime = None, end_date: datetime = None) -> Dict:
+    """Admin dashboard breakdowns across all users, from global_daily
+    
+    Reads one document per day: counters are summed by a $facet pipeline
+    and the per-day distinct-user sketches are merged for the whole range,
+    so user counts are estimates (about 1.6% standard error).
+    """
+    try:
+        match = {}
+        if start_date or end_date:
+            match["day"] = {}
+            if start_date:
+                match["day"]["$gte"] = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            if end_date:
+                match["day"]["$lt"] = end_date
+        
+        def breakdown(field):
+            return [
+                {"$project": {"kv": {"$objectToArray": {"$ifNull": [f"${field}", {}]}}}},
+                {"$unwind": "$kv"},
+                {"$group": {"_id": "$kv.k", "count": {"$sum": "$kv.v"}}}
+            ]
+        
+        pipeline = [
+            {"$match": match},
+            {
+                "$facet": {
+                    "totals": [{"$group": {
+                        "_id": None,
+                        "detections": {"$sum": "$detections"},
+                        "games": {"$sum": "$games"},
+                        "clicks": {"$sum": "$clicks"}
+                    }}],
+                    "emotions": breakdown("emotions"),
+                    "hours": breakdown("hours"),
+                    "platforms": breakdown("platforms")
+                }
+            }
+        ]
+        
+        def fetch():
+            collection = db_manager.db['global_daily']
+            result = next(collection.aggregate(pipeline), {})
+            totals = (result.get("totals") or [{}])[0]
+            
+            # Sketches are read separately so the $facet result stays small
+            days = list(collection.find(match, {"detections": 1, "games": 1, "clicks": 1, "sketches": 1},
+                                        sort=[("day", 1)]))
+            sketches = {name: np.stack([hyperloglog.from_bytes(day.get('sketches', {}).get(name))
+                                        for day in days]) if days else np.zeros((0, hyperloglog.HLL_REGISTERS))
+                        for name in ('active', 'clickers')}
+            daily_active = hyperloglog.estimate(sketches['active']) if days else []
+            active = float(hyperloglog.estimate(sketches['active'].max(axis=0))) if days else 0.0
+            clickers = float(hyperloglog.estimate(sketches['clickers'].max(axis=0))) if days else 0.0
+            hours = {int(doc["_id"]): doc["count"] for doc in result.get("hours", [])}
+            return {
+                "days": len(days),
+                "detections": totals.get("detections", 0),
+                "games": totals.get("games", 0),
+                "clicks": totals.get("clicks", 0),
+                "active_users": round(active),
+                "clicking_users": round(clickers),
+                "click_through": clickers / active if active else 0.0,
+                "daily": [
+                    {"day": day["_id"], "active_users": round(float(users)),
+                     "detections": day.get("detections", 0), "games": day.get("games", 0),
+                     "clicks": day.get("clicks", 0)}
+                    for day, users in zip(days, daily_active)
+                ],
+                "emotion_counts": {_rollup_value(doc["_id"]): doc["count"]
+                                   for doc in sorted(result.get("emotions", []), key=lambda d: -d["count"])},
+                "hourly": dict(sorted(hours.items())),
+                "peak_hour": max(hours, key=hours.get) if hours else None,
+                "platform_clicks": {_rollup_value(doc["_id"]): doc["count"]
+                                    for doc in sorted(result.get("platforms", []), key=lambda d: -d["count"])}
+            }
+        
+        return db_manager.cached_read(('global_analytics', start_date, end_date), fetch, {})
+        
+    except Exception as e:
+        print(f"Error getting global analytics: {e}")
+        return {}
+
+def get_mood_alerts(username: str, include_acknowledged: bool = False, limit: int = 20) -> List[Dict]:
+    """A user's mood alerts, newest first"""
+    try:
+        query = {"username": username}
+        if not include_acknowledged:
+            query["acknowledged"] = False
+        
+        def fetch():
+            return list(db_manager.db['mood_alerts'].find(query).sort("created_at", -1).limit(limit))
+        
+        return db_manager.cached_read(('mood_alerts', username, include_acknowledged, limit), fetch, [])
+        
+    except Exception as e:
+        print(f"Error getting mood alerts: {e}")
+        return []
+
+def acknowledge_mood_alerts(username: str) -> int:
+    """Mark a user's open mood alerts as seen; returns how many there were"""
+    alerts = db_manager.get_collection('mood_alerts')
+    if alerts is None:
+        return 0
+    try:
+        result = alerts.update_many(
+            {"username": username, "acknowledged": False},
+            {"$set": {"acknowledged": True, "acknowledged_at": datetime.utcnow()}}
+        )
+        return result.modified_count
+        
+    except Exception as e:
+        db_manager.report_failure(e)
+        print(f"Error acknowledging mood alerts: {e}")
+        return 0
+
+# Archive Functions
+def get_archive_manifest(username: str) -> List[Dict]:
+    """Archived months of a user, oldest first"""
+    try:
+        def fetch():
+            return list(db_manager.db['emotion_archive'].find({"username": username}).sort("month", 1))
+        
+        return db_manager.cached_read(('archive_manifest', username), fetch, [])
+        
+    except Exception as e:
+        print(f"Error getting archive manifest: {e}")
+        return []
+
+def get_archive_boundary(username: str) -> Optional[datetime]:
+    """End of the user's last archived month, or None if nothing is archived"""
+    manifest = get_archive_manifest(username)
+    return month_bounds(manifest[-1]['month'])[1] if manifest else None
+
+def _archived_filter(username: str) -> Optional[Callable[[Dict], bool]]:
+    """Predicate for emotion_history documents that are also in the user's archive; None without one
+    
+    Archived detections stay in emotion_history when an archive run stops
+    before deleting them, or on servers that cannot delete them; readers
+    merging both sides use this to count them once.
+    """
+    manifest = get_archive_manifest(username)
+    if not manifest:
+        return None
+    # Months without the flag were archived before it existed and may still hold rows
+    archived_months = {item['month'] for item in manifest if item.get('pending_delete', True)}
+    if not archived_months:
+        return None
+    boundary = month_bounds(manifest[-1]['month'])[1]
+    ids = {}
+    
+    def archived(doc: Dict) -> bool:
+        if doc['timestamp'] >= boundary:
+            return False
+        month = month_key(doc['timestamp'])
+        if month not in archived_months:
+            return False
+        if month not in ids:
+            ids[month] = history_archive.month_ids(username, month)
+        return str(doc['_id']) in ids[month]
+    
+    return archived
+
+def _replace_rollups(username: str, docs: Iterable[Dict], archived: bool = False):
+    """Overwrite the emotion_daily documents of the days these detections fall on"""
+    ops = []
+    for (_, day), inc in _rollup_increments(dict(doc, username=username) for doc in docs).items():
+        rollup = {"_id": _rollup_id(username, day), "username": username, "day": day}
+        if archived:
+            rollup["archived"] = True
+        for path, n in inc.items():
+            set_path(rollup, path, n)
+        ops.append(ReplaceOne({"_id": rollup["_id"]}, rollup, upsert=True))
+    if ops:
+        db_manager.db['emotion_daily'].bulk_write(ops, ordered=False)
+
+def _replace_month_rollups(username: str, frame: pd.DataFrame):
+    """Rebuild the emotion_daily documents of an archived month from its archive file"""
+    _replace_rollups(username, frame_to_docs(frame), archived=True)
+
+def get_first_detection_time(username: str) -> Optional[datetime]:
+    """Timestamp of the user's oldest detection still in emotion_history; None if there is none"""
+    try:
+        docs = list(db_manager.history.find(db_manager.db['emotion_history'], {"username": username},
+                                            {"_id": 0, "timestamp": 1}, sort=[("timestamp", 1)],
+                                            limit=1, hint=True))
+        return docs[0]['timestamp'] if docs else None
+    except Exception as e:
+        db_manager.report_failure(e)
+        print(f"Error finding first detection: {e}")
+        return None
+
+def rebuild_daily_rollups(username: str, start_date: datetime, end_date: datetime):
+    """Rebuild emotion_daily for the days from start_date to end_date from emotion_history
+    
+    Days in archived months are left to archive_emotion_history, which
+    rebuilds them from the archive files.
+    """
+    start = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    boundary = get_archive_boundary(username)
+    if boundary and boundary > start:
+        start = boundary
+    end = end_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    if start >= end:
+        return
+    docs = db_manager.history.find(
+        db_manager.db['emotion_history'],
+        {"username": username, "timestamp": {"$gte": start, "$lt": end}},
+        {"_id": 0, "timestamp": 1, "emotion": 1, "language": 1, "singer": 1},
+        hint=True, batch_size=FRAME_BATCH_SIZE
+    )
+    _replace_rollups(username, docs)
+
+def rebuild_emotion_transitions(username: str):
+    """Recount a user's emotion_transitions (archive included) and open span from history
+    
+    The day totals in emotion_transitions_global are moved by the
+    difference, so a second run changes nothing.
+    """
+    days, open_span = frame_day_matrices(iter_emotion_frames(username, include_archive=True))
+    user_docs = db_manager.db['emotion_transitions']
+    deltas = {day: (counts.copy(), dwell.copy()) for day, (counts, dwell) in days.items()}
+    for doc in user_docs.find({"username": username}):
+        day = _day_key(doc['day'])
+        _add_matrices(deltas, day, -np.asarray(doc['counts'], dtype=np.int64),
+                      -np.asarray(doc['dwell'], dtype=np.int64))
+    
+    # The user's documents first: if the global step is interrupted,
+    # the global totals undercount rather than count twice
+    user_docs.delete_many({"username": username})
+    if days:
+        user_docs.insert_many([
+            {"_id": f"{username}|{day}", "username": username,
+             "day": datetime.strptime(day, '%Y-%m-%d'),
+             "counts": counts.tolist(), "dwell": dwell.tolist()}
+            for day, (counts, dwell) in sorted(days.items())
+        ])
+    global_ops = _global_updates(deltas)
+    if global_ops:
+        db_manager.db['emotion_transitions_global'].bulk_write(global_ops, ordered=True)
+    if open_span is not None:
+        db_manager.db['emotion_spans'].replace_one({"_id": username}, open_span, upsert=True)
+    else:
+        db_manager.db['emotion_spans'].delete_one({"_id": username})
+
+def rebuild_global_daily(start_date: datetime, end_date: datetime) -> int:
+    """Rebuild global_daily for the days from start_date to end_date; returns days rebuilt
+    
+    Detections are counted from the emotion_daily rollups (so archived
+    days are included), games and clicks from their collections, and each
+    day's sketches from the users seen. Increments written while a day is
+    being rebuilt may be lost, so run it when traffic is low.
+    """
+    day = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = end_date.replace(hour=0, minute=0, second=0, microsecond=0)
+    rebuilt = 0
+    while day <= end:
+        next_day = day + timedelta(days=1)
+        doc = {"_id": _day_key(day), "day": day, "detections": 0, "games": 0, "clicks": 0,
+               "emotions": {}, "hours": {}, "platforms": {}, "sketch_version": 0}
+        active, clickers = set(), set()
+        
+        def add(counts, key, n):
+            counts[key] = counts.get(key, 0) + n
+        
+        for rollup in db_manager.db['emotion_daily'].find({"day": day}, {"_id": 0, "username": 1, "total": 1,
+                                                                         "emotions": 1}):
+            active.add(rollup['username'])
+            doc["detections"] += rollup.get('total', 0)
+            for key, emotion in rollup.get('emotions', {}).items():
+                add(doc["emotions"], key, emotion.get('total', 0))
+                for hour, n in emotion.get('hours', {}).items():
+                    add(doc["hours"], hour, n)
+        
+        window = {"timestamp": {"$gte": day, "$lt": next_day}}
+        games = db_manager.db['games_history'].aggregate([
+            {"$match": window},
+            {"$group": {"_id": "$username", "count": {"$sum": 1}}}
+        ], allowDiskUse=True)
+        for group in games:
+            doc["games"] += group["count"]
+            active.add(group["_id"])
+        clicks = db_manager.db['music_recommendations'].aggregate([
+            {"$match": window},
+            {"$group": {"_id": {"username": "$username", "platform": "$platform"}, "count": {"$sum": 1}}}
+        ], allowDiskUse=True)
+        for group in clicks:
+            doc["clicks"] += group["count"]
+            add(doc["platforms"], _rollup_key(group["_id"].get("platform")), group["count"])
+            clickers.add(group["_id"].get("username"))
+        active |= clickers
+        
+        doc["sketches"] = {name: bson.Binary(hyperloglog.to_bytes(hyperloglog.sketch(users - {None})))
+                           for name, users in (("active", active), ("clickers", clickers))}
+        db_manager.db['global_daily'].replace_one({"_id": doc["_id"]}, doc, upsert=True)
+        with _global_lock:
+            for name in ('active', 'clickers'):
+                _global_sketches.pop((doc["_id"], name), None)
+        rebuilt += 1
+        day = next_day
+    return rebuilt
+
+def archive_emotion_history(older_than_days: int = ARCHIVE_AFTER_DAYS) -> int:
+    """Move whole months older than older_than_days into the columnar archive
+    
+    Per user and month: merge the detections into the month's archive file,
+    rebuild that month's daily rollups from the file, record the month in
+    emotion_archive, and only then delete the detections. Every step is
+    idempotent, so an interrupted run is finished by running it again; until
+    then readers skip the live detections the archive already holds.
+    Returns the number of detections removed from emotion_history.
+    """
+    if not db_manager.is_available():
+        print("Database connection not available")
+        return 0
+    
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    emotions = db_manager.db['emotion_history']
+    layout = db_manager.history
+    months = list(layout.aggregate(emotions, [
+        {"$match": {"timestamp": {"$lt": cutoff}}},
+        {"$group": {"_id": {
+            "username": "$username",
+            "month": {"$dateToString": {"format": "%Y-%m", "date": "$timestamp"}}
+        }}},
+        {"$sort": {"_id.username": 1, "_id.month": 1}}
+    ], allowDiskUse=True))
+    
+    projection = {field: 1 for field in ARCHIVE_SCHEMA}
+    removed = 0
+    for item in months:
+        username, month = item['_id']['username'], item['_id']['month']
+        start, end = month_bounds(month)
+        docs = list(layout.find(emotions, {"username": username, "timestamp": {"$gte": start, "$lt": end}},
+                                projection, sort=[("timestamp", 1)], hint=True))
+        if not docs:
+            continue
+        
+        frame = history_archive.write_month(username, month, frame_from_batches([docs], ARCHIVE_SCHEMA))
+        _replace_month_rollups(username, frame)
+        first, last = frame_to_docs(frame.iloc[[0, -1]])
+        db_manager.db['emotion_archive'].update_one(
+            {"_id": f"{username}|{month}"},
+            {"$set": {
+                "username": username,
+                "month": month,
+                "rows": len(frame),
+                "first": first['timestamp'],
+                "last": last['timestamp'],
+                "last_emotion": last.get('emotion'),
+                "first_id": first['_id'],
+                "last_id": last['_id'],
+                "pending_delete": True,
+                "archived_at": datetime.utcnow()
+            }},
+            upsert=True
+        )
+        deleted = layout.delete_documents(emotions, username, start, end, [doc['_id'] for doc in docs])
+        if deleted == len(docs):
+            db_manager.db['emotion_archive'].update_one(
+                {"_id": f"{username}|{month}"}, {"$set": {"pending_delete": False}}
+            )
+        removed += deleted
+        invalidate_analytics_state(username)
+    return removed
+
 # Games Functions
 def track_game_play(username: str, game_name: str, game_url: str = "", 
                    play_duration: int = 0) -> bool:
     """Track game play activity"""
     try:
-        games = db_manager.get_collection('games_history')
-        if games is None:
-            return False
-        
         game_doc = {
             "username": username,
             "game_name": game_name,
@@ -271,17 +1848,8 @@ def track_game_play(username: str, game_name: str, game_url: str = "",
             "session_id": f"{username}_{datetime.now().strftime('%Y%m%d')}"
         }
         
-        result = games.insert_one(game_doc)
-        
-        # Update user stats
-        users = db_manager.get_collection('users')
-        if users:
-            users.update_one(
-                {"username": username},
-                {"$inc": {"stats.games_played": 1}}
-            )
-        
-        return result.inserted_id is not None
+        # stats.games_played is bumped by the games_history write hook
+        return db_manager.insert_one('games_history', game_doc)
         
     except Exception as e:
         print(f"Error tracking game play: {e}")
@@ -290,18 +1858,16 @@ def track_game_play(username: str, game_name: str, game_url: str = "",
 def get_games_history(username: str, limit: int = 100) -> List[Dict]:
     """Get games play history for a user"""
     try:
-        games = db_manager.get_collection('games_history')
-        if games is None:
-            return []
-        
-        cursor = games.find({"username": username}).sort("timestamp", -1).limit(limit)
-        
-        history = []
-        for doc in cursor:
-            doc['_id'] = str(doc['_id'])
-            history.append(doc)
+        def fetch():
+            cursor = db_manager.db['games_history'].find({"username": username}).sort("timestamp", -1).limit(limit)
+            
+            history = []
+            for doc in cursor:
+                doc['_id'] = str(doc['_id'])
+                history.append(doc)
+            return history
         
-        return history
+        return db_manager.cached_read(('games', username, limit), fetch, [])
         
     except Exception as e:
         print(f"Error getting games history: {e}")
@@ -312,10 +1878,6 @@ def save_music_recommendation(username: str, platform: str, query: str,
                             emotion: str, language: str = "", artist: str = "") -> bool:
     """Save music recommendation activity"""
     try:
-        recommendations = db_manager.get_collection('music_recommendations')
-        if recommendations is None:
-            return False
-        
         rec_doc = {
             "username": username,
             "platform": platform,
@@ -326,10 +1888,29 @@ def save_music_recommendation(username: str, platform: str, query: str,
             "timestamp": datetime.utcnow()
         }
         
-        result = recommendations.insert_one(rec_doc)
-        return result.inserted_id is not None
+        return db_manager.insert_one('music_recommendations', rec_doc)
         
     except Exception as e:
         print(f"Error saving music recommendation: {e}")
         return False
 
+
+def iter_recommendation_interactions(batch_size: int = FRAME_BATCH_SIZE) -> Iterable[pd.DataFrame]:
+    """Clicks per (username, artist, language, emotion) across all users, in DataFrame batches
+    
+    Grouped by the server, so the trainer reads one row per distinct
+    interaction rather than one per click.
+    """
+    cursor = db_manager.db['music_recommendations'].aggregate([
+        {"$match": {"artist": {"$nin": [None, ""]}}},
+        {"$group": {"_id": {"username": "$username", "artist": "$artist", "language": "$language",
+                            "emotion": "$emotion"}, "clicks": {"$sum": 1}}}
+    ], allowDiskUse=True, batchSize=batch_size)
+    batch = []
+    for doc in cursor:
+        batch.append(dict(doc["_id"], clicks=doc["clicks"]))
+        if len(batch) >= batch_size:
+            yield pd.DataFrame(batch)
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch)
@@ -0,0 +1,111 @@
+import csv
+import gzip
+import os
+import re
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from storage.base import HISTORY_FRAME_SCHEMA, StorageBackend
+
+# Optional Parquet support
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PARQUET_AVAILABLE = True
+except Exception:
+    PARQUET_AVAILABLE = False
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", tempfile.gettempdir())
+# Documents per cursor batch; bounds memory regardless of history size
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+# Seconds before an export file left behind is removed
+EXPORT_MAX_AGE = float(os.getenv("EXPORT_MAX_AGE", "3600"))
+EXPORT_PREFIX = "emotion_export_"
+
+# format -> (file suffix, MIME type)
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+    "parquet": (".parquet", "application/vnd.apache.parquet")
+}
+
+HEADER = ['Date & Time', 'Emotion', 'Language', 'Singer']
+
+def available_formats() -> List[str]:
+    return [fmt for fmt in EXPORT_FORMATS if fmt != "parquet" or PARQUET_AVAILABLE]
+
+def export_history(storage: StorageBackend, username: str, fmt: str = "csv",
+                   start_date: datetime = None, end_date: datetime = None,
+                   emotion_filter: List[str] = None,
+                   include_archive: bool = False) -> Optional[str]:
+    """Write a user's complete matching history to a temp file and return its path"""
+    if fmt not in available_formats():
+        print(f"Unsupported export format: {fmt}")
+        return None
+
+    cleanup_exports()
+    suffix = EXPORT_FORMATS[fmt][0]
+    # OAuth usernames can contain path separators
+    safe_name = re.sub(r'[^A-Za-z0-9_-]', '_', username)
+    fd, path = tempfile.mkstemp(prefix=f"{EXPORT_PREFIX}{safe_name}_", suffix=suffix, dir=EXPORT_DIR)
+    os.close(fd)
+
+    frames = storage.iter_emotion_frames(username, start_date, end_date, emotion_filter,
+                                         batch_size=EXPORT_BATCH_SIZE, include_archive=include_archive)
+    try:
+        if fmt == "parquet":
+            _write_parquet(frames, path)
+        elif fmt == "csv.gz":
+            with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+                _write_csv(frames, f)
+        else:
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                _write_csv(frames, f)
+        return path
+    except Exception as e:
+        print(f"Error exporting history for {username}: {e}")
+        _remove(path)
+        return None
+
+def _write_csv(frames, f):
+    writer = csv.writer(f)
+    writer.writerow(HEADER)
+    for frame in frames:
+        frame = _as_text(frame).fillna('')
+        timestamps = frame['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
+        writer.writerows(zip(timestamps, frame['emotion'], frame['language'], frame['singer']))
+
+def _write_parquet(frames, path):
+    schema = pa.schema([
+        ('timestamp', pa.timestamp('ms')),
+        ('emotion', pa.string()),
+        ('language', pa.string()),
+        ('singer', pa.string())
+    ])
+    # One row group per cursor batch, so only one batch is ever held in memory
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for frame in frames:
+            writer.write_table(pa.Table.from_pandas(_as_text(frame), schema=schema, preserve_index=False))
+
+def _as_text(frame):
+    """Categorical columns back to plain strings (each chunk has its own categories)"""
+    return frame.astype({field: object for field, kind in HISTORY_FRAME_SCHEMA.items()
+                         if kind == 'category'})
+
+def cleanup_exports(max_age: float = EXPORT_MAX_AGE):
+    """Remove export files older than max_age seconds"""
+    cutoff = time.time() - max_age
+    try:
+        for entry in os.scandir(EXPORT_DIR):
+            if entry.name.startswith(EXPORT_PREFIX) and entry.stat().st_mtime < cutoff:
+                _remove(entry.path)
+    except OSError as e:
+        print(f"Error cleaning up exports: {e}")
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
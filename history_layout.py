@@ -0,0 +1,329 @@
+"""Physical layouts for the emotion_history collection
+
+plain       one document per detection (the original layout)
+timeseries  a MongoDB time-series collection, timestamp as time field and
+            username as metadata; falls back to buckets before MongoDB 5.0
+buckets     app-managed documents holding up to EMOTION_BUCKET_MAX_EVENTS
+            detections of one user and hour
+
+Every layout reads and writes the same per-detection documents, so callers
+query with ordinary emotion_history filters and pipelines. Jobs that walk
+the stored documents themselves (backfill.py) translate their filter with
+stored_query and unpack what they read with unpack_documents.
+"""
+import os
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
+
+EMOTION_HISTORY_LAYOUT = os.getenv("EMOTION_HISTORY_LAYOUT", "plain")
+EMOTION_BUCKET_MAX_EVENTS = int(os.getenv("EMOTION_BUCKET_MAX_EVENTS", "1000"))
+DELETE_BATCH_SIZE = 1000
+
+# Serves per-user time-range scans and keyset pagination over (timestamp, _id)
+HISTORY_INDEX = [("username", 1), ("timestamp", -1), ("_id", -1)]
+
+def server_version(db) -> Tuple[int, ...]:
+    """MongoDB server version as a tuple, e.g. (6, 0, 5); (0,) if it cannot be read"""
+    try:
+        return tuple(db.client.server_info().get('versionArray', [0])[:3])
+    except Exception:
+        return (0,)
+
+def insert_documents(collection, docs: List[Dict]) -> List[Dict]:
+    """Bulk insert, treating duplicate keys as already written; returns the documents stored"""
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        return _stored(collection, docs, e)
+    return docs
+
+def _update_spec(fields: Dict, unset: Iterable[str], prefix: str = "") -> Dict:
+    spec = {}
+    if fields:
+        spec["$set"] = {prefix + field: value for field, value in fields.items()}
+    if unset:
+        spec["$unset"] = {prefix + field: "" for field in unset}
+    return spec
+
+def _stored(collection, docs: List[Dict], error: BulkWriteError) -> List[Dict]:
+    errors = error.details.get('writeErrors', [])
+    rejected = [err for err in errors if err.get('code') != 11000]
+    if rejected:
+        # Retrying would fail the same way, so drop them rather than block the spool
+        print(f"Dropping {len(rejected)} documents rejected by {collection.name}: "
+              f"{rejected[0].get('errmsg')}")
+    failed = {err['index'] for err in errors}
+    return [doc for i, doc in enumerate(docs) if i not in failed]
+
+class PlainLayout:
+    """One document per detection"""
+
+    name = "plain"
+    hint = HISTORY_INDEX
+
+    def setup(self, db) -> "PlainLayout":
+        emotions = db['emotion_history']
+        emotions.create_index(HISTORY_INDEX)
+        emotions.create_index("emotion")
+        emotions.create_index("timestamp")
+        return self
+
+    def insert_documents(self, collection, docs: List[Dict]) -> List[Dict]:
+        return insert_documents(collection, docs)
+
+    def delete_documents(self, collection, username: str, start: datetime, end: datetime,
+                         ids: List) -> int:
+        """Delete the given detections of one user within [start, end)"""
+        deleted = 0
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            deleted += collection.delete_many({
+                "username": username,
+                "timestamp": {"$gte": start, "$lt": end},
+                "_id": {"$in": ids[i:i + DELETE_BATCH_SIZE]}
+            }).deleted_count
+        return deleted
+
+    def supports_updates(self, db) -> bool:
+        """Whether update_documents can change detection fields on this server"""
+        return True
+
+    def update_documents(self, collection, updates: List[Tuple]) -> int:
+        """Apply (_id, fields to set, fields to unset) to single detections; returns detections changed"""
+        ops = [UpdateOne({"_id": doc_id}, _update_spec(fields, unset))
+               for doc_id, fields, unset in updates]
+        return collection.bulk_write(ops, ordered=False).modified_count if ops else 0
+
+    def stored_query(self, query: Dict) -> Dict:
+        """Filter on stored documents holding a detection that matches query"""
+        return dict(query)
+
+    def stored_projection(self, projection: Dict = None) -> Dict:
+        return projection
+
+    def unpack_documents(self, docs: List[Dict]) -> List[Dict]:
+        """Detections of stored documents read with stored_query and stored_projection"""
+        return docs
+
+    def find(self, collection, query: Dict, projection: Dict = None, sort: List = None,
+             limit: int = 0, hint: bool = False, batch_size: int = 0):
+        cursor = collection.find(query, projection, sort=sort, limit=limit, batch_size=batch_size)
+        return cursor.hint(self.hint) if hint and self.hint else cursor
+
+    def find_raw_batches(self, collection, query: Dict, projection: Dict = None,
+                         sort: List = None, limit: int = 0, batch_size: int = 0):
+        return collection.find_raw_batches(query, projection, sort=sort, limit=limit,
+                                           batch_size=batch_size)
+
+    def aggregate(self, collection, pipeline: List[Dict], hint: bool = False, **kwargs):
+        if hint and self.hint:
+            kwargs['hint'] = self.hint
+        return collection.aggregate(pipeline, **kwargs)
+
+class TimeSeriesLayout(PlainLayout):
+    """MongoDB time-series collection; MongoDB groups detections into compressed buckets
+
+    Time-series collections have no unique _id index, so batches skip
+    documents that are already stored to keep spool replays idempotent.
+    """
+
+    name = "timeseries"
+    hint = [("username", 1), ("timestamp", -1)]
+
+    def setup(self, db):
+        try:
+            db.create_collection('emotion_history', timeseries={
+                "timeField": "timestamp",
+                "metaField": "username",
+                "granularity": "minutes"
+            })
+        except CollectionInvalid:
+            options = db['emotion_history'].options()
+            if 'timeseries' not in options:
+                print("emotion_history already exists as a plain collection; "
+                      "keeping the plain layout until it is migrated")
+                return PlainLayout().setup(db)
+        except OperationFailure as e:
+            print(f"Time-series collections unavailable ({e}); using hourly buckets")
+            return BucketLayout().setup(db)
+
+        emotions = db['emotion_history']
+        # Indexes on the metaField and timeField are supported from 5.0, on
+        # measurements (emotion) only from 6.0; older servers scan for emotion filters
+        emotions.create_index(self.hint)
+        if server_version(db) >= (6, 0):
+            try:
+                emotions.create_index("emotion")
+            except OperationFailure as e:
+                print(f"Skipping the emotion index on the time-series collection: {e}")
+        return self
+
+    def delete_documents(self, collection, username: str, start: datetime, end: datetime,
+                         ids: List) -> int:
+        # Before 7.0 deletes on time-series collections may only filter on the
+        # metaField; the detections stay and readers skip the archived ones
+        if server_version(collection.database) < (7, 0):
+            print(f"Keeping {len(ids)} archived detections of {username}: "
+                  "time-series deletes by _id need MongoDB 7.0")
+            return 0
+        return super().delete_documents(collection, username, start, end, ids)
+
+    def supports_updates(self, db) -> bool:
+        # Before 7.0 updates on time-series collections may only change the metaField
+        return server_version(db) >= (7, 0)
+
+    def update_documents(self, collection, updates: List[Tuple]) -> int:
+        # Time-series collections take multi-document updates only
+        ops = [UpdateMany({"_id": doc_id}, _update_spec(fields, unset))
+               for doc_id, fields, unset in updates]
+        return collection.bulk_write(ops, ordered=False).modified_count if ops else 0
+
+    def insert_documents(self, collection, docs: List[Dict]) -> List[Dict]:
+        existing = set()
+        for doc in collection.find({
+            "username": {"$in": list({doc['username'] for doc in docs})},
+            "timestamp": {"$gte": min(doc['timestamp'] for doc in docs),
+                          "$lte": max(doc['timestamp'] for doc in docs)},
+            "_id": {"$in": [doc['_id'] for doc in docs]}
+        }, {"_id": 1}).hint(self.hint):
+            existing.add(doc['_id'])
+        new_docs = [doc for doc in docs if doc['_id'] not in existing]
+        return insert_documents(collection, new_docs) if new_docs else []
+
+class BucketLayout(PlainLayout):
+    """App-managed buckets: {username, hour, count, events: [detection, ...]}
+
+    Reads unwind the buckets that can overlap the requested time range and
+    then run the caller's query on the detections, so sorts happen in memory
+    over that range rather than from an index.
+    """
+
+    name = "buckets"
+    hint = [("username", 1), ("hour", -1)]
+
+    def setup(self, db):
+        emotions = db['emotion_history']
+        emotions.create_index(self.hint)
+        # One entry per detection; keeps writes idempotent across buckets
+        emotions.create_index("events._id", unique=True)
+        return self
+
+    @staticmethod
+    def _hour(timestamp: datetime) -> datetime:
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    def insert_documents(self, collection, docs: List[Dict]) -> List[Dict]:
+        ops = []
+        for doc in docs:
+            # A detection that is already stored fails the filter, and the
+            # upserted bucket then collides on events._id
+            ops.append(UpdateOne(
+                {
+                    "username": doc['username'],
+                    "hour": self._hour(doc['timestamp']),
+                    "count": {"$lt": EMOTION_BUCKET_MAX_EVENTS},
+                    "events._id": {"$ne": doc['_id']}
+                },
+                {"$push": {"events": doc}, "$inc": {"count": 1}},
+                upsert=True
+            ))
+        try:
+            collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            return _stored(collection, docs, e)
+        return docs
+
+    def delete_documents(self, collection, username: str, start: datetime, end: datetime,
+                         ids: List) -> int:
+        deleted = 0
+        bucket_filter = {"username": username, "hour": {"$gte": self._hour(start), "$lt": end}}
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            chunk = ids[i:i + DELETE_BATCH_SIZE]
+            before = sum(doc['count'] for doc in collection.find(bucket_filter, {"count": 1}))
+            collection.update_many(dict(bucket_filter, **{"events._id": {"$in": chunk}}), [
+                {"$set": {"events": {"$filter": {
+                    "input": "$events",
+                    "cond": {"$not": [{"$in": ["$$this._id", chunk]}]}
+                }}}},
+                {"$set": {"count": {"$size": "$events"}}}
+            ])
+            collection.delete_many(dict(bucket_filter, count=0))
+            deleted += before - sum(doc['count'] for doc in collection.find(bucket_filter, {"count": 1}))
+        return deleted
+
+    def update_documents(self, collection, updates: List[Tuple]) -> int:
+        ops = [UpdateOne({"events._id": doc_id}, _update_spec(fields, unset, "events.$[e]."),
+                         array_filters=[{"e._id": doc_id}])
+               for doc_id, fields, unset in updates]
+        return collection.bulk_write(ops, ordered=False).modified_count if ops else 0
+
+    def stored_query(self, query: Dict) -> Dict:
+        return {"events": {"$elemMatch": query}} if query else {}
+
+    def stored_projection(self, projection: Dict = None) -> Dict:
+        if not projection:
+            return {"events": 1}
+        fields = {f"events.{field}": value for field, value in projection.items() if field != "_id"}
+        return dict(fields, **{"events._id": 1})
+
+    def unpack_documents(self, docs: List[Dict]) -> List[Dict]:
+        return [event for doc in docs for event in doc.get("events", [])]
+
+    def _unpack(self, match: Dict) -> List[Dict]:
+        """Stages turning the buckets that can hold matches into detection documents"""
+        bucket_match = {}
+        if 'username' in match:
+            bucket_match['username'] = match['username']
+        timestamp = match.get('timestamp')
+        if isinstance(timestamp, dict):
+            hour = {}
+            for op in ('$gte', '$gt'):
+                if op in timestamp:
+                    hour['$gte'] = self._hour(timestamp[op])
+            for op in ('$lte', '$lt'):
+                if op in timestamp:
+                    hour['$lte'] = timestamp[op]
+            if hour:
+                bucket_match['hour'] = hour
+        elif isinstance(timestamp, datetime):
+            bucket_match['hour'] = self._hour(timestamp)
+        return [{"$match": bucket_match}, {"$unwind": "$events"}, {"$replaceWith": "$events"}]
+
+    def _pipeline(self, query: Dict, projection: Dict = None, sort: List = None,
+                  limit: int = 0) -> List[Dict]:
+        pipeline = self._unpack(query) + [{"$match": query}]
+        if sort:
+            pipeline.append({"$sort": dict(sort)})
+        if limit:
+            pipeline.append({"$limit": limit})
+        if projection:
+            pipeline.append({"$project": projection})
+        return pipeline
+
+    def find(self, collection, query: Dict, projection: Dict = None, sort: List = None,
+             limit: int = 0, hint: bool = False, batch_size: int = 0):
+        kwargs = {"allowDiskUse": True}
+        if batch_size:
+            kwargs['batchSize'] = batch_size
+        return collection.aggregate(self._pipeline(query, projection, sort, limit), **kwargs)
+
+    def find_raw_batches(self, collection, query: Dict, projection: Dict = None,
+                         sort: List = None, limit: int = 0, batch_size: int = 0):
+        kwargs = {"allowDiskUse": True}
+        if batch_size:
+            kwargs['batchSize'] = batch_size
+        return collection.aggregate_raw_batches(self._pipeline(query, projection, sort, limit), **kwargs)
+
+    def aggregate(self, collection, pipeline: List[Dict], hint: bool = False, **kwargs):
+        # Callers' pipelines start with a $match on detection fields
+        match = pipeline[0].get('$match', {}) if pipeline else {}
+        return collection.aggregate(self._unpack(match) + list(pipeline), **kwargs)
+
+LAYOUTS = {layout.name: layout for layout in (PlainLayout, TimeSeriesLayout, BucketLayout)}
+
+def create_history_layout(name: str = EMOTION_HISTORY_LAYOUT) -> PlainLayout:
+    if name not in LAYOUTS:
+        raise ValueError(f"Unknown EMOTION_HISTORY_LAYOUT {name!r}; expected one of {', '.join(LAYOUTS)}")
+    return LAYOUTS[name]()
@@ -0,0 +1,57 @@
+"""HyperLogLog sketches for approximate distinct counts
+
+A sketch is HLL_REGISTERS one-byte registers, so it is stored as a small
+Binary, merged with an element-wise maximum (the union of the counted
+sets) and estimated without the values it counted. The standard error
+is about 1.04 / sqrt(HLL_REGISTERS): 1.6% with the default 4096.
+"""
+import hashlib
+import os
+from typing import Iterable
+
+import numpy as np
+
+HLL_PRECISION = int(os.getenv("HLL_PRECISION", "12"))
+HLL_REGISTERS = 1 << HLL_PRECISION
+
+def empty_sketch() -> np.ndarray:
+    return np.zeros(HLL_REGISTERS, dtype=np.uint8)
+
+def _register(value: str):
+    """Register index and rank (position of the first 1 bit after the index bits) of a value"""
+    h = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+    bits = 64 - HLL_PRECISION
+    rest = h & ((1 << bits) - 1)
+    return h >> bits, bits - rest.bit_length() + 1
+
+def sketch(values: Iterable[str]) -> np.ndarray:
+    """Sketch of a set of strings"""
+    registers = empty_sketch()
+    pairs = [_register(value) for value in set(values)]
+    if pairs:
+        index, rank = np.array(pairs, dtype=np.int64).T
+        np.maximum.at(registers, index, rank.astype(np.uint8))
+    return registers
+
+def merge(sketches: Iterable[np.ndarray]) -> np.ndarray:
+    merged = empty_sketch()
+    for registers in sketches:
+        np.maximum(merged, registers, out=merged)
+    return merged
+
+def estimate(registers: np.ndarray) -> float:
+    """Estimated distinct count of one sketch, or of each row of a 2-D array of sketches"""
+    registers = np.asarray(registers, dtype=np.float64)
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.sum(np.exp2(-registers), axis=-1)
+    zeros = np.sum(registers == 0, axis=-1)
+    # Linear counting is more accurate while many registers are still empty
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+def to_bytes(registers: np.ndarray) -> bytes:
+    return registers.astype(np.uint8).tobytes()
+
+def from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.uint8).copy() if data else empty_sketch()
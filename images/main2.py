@@ -16,6 +16,7 @@ import pandas as pd
 
 # Import auth functions
 from images.auth import is_authenticated, show_auth_page, logout, get_database
+from storage import get_storage
 
 # Optional speech recognition
 try:
@@ -32,6 +33,8 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+store = get_storage()
+
 # Ultra-modern CSS styling inspired by latest design trends
 st.markdown("""
 <style>
@@ -1146,27 +1149,14 @@ if st.session_state.current_page == 'Home':
         # Quick stats
         st.markdown('<div class="glass-card">', unsafe_allow_html=True)
         st.markdown("### 📊 Quick Stats")
-        col = get_history_collection()
-        if col:
-            try:
-                total_sessions = col.count_documents({'username': username})
-                recent_emotions = list(col.find({'username': username}).sort('timestamp', -1).limit(5))
-                
-                st.metric("Total Sessions", total_sessions, delta=None)
-                
-                if recent_emotions:
-                    recent_emotion = recent_emotions[0]['emotion']
-                    st.metric("Last Emotion", recent_emotion, delta=None)
-                    
-                    unique_emotions = len(set([e['emotion'] for e in recent_emotions]))
-                    st.metric("Recent Variety", f"{unique_emotions} emotions", delta=None)
-                else:
-                    st.info("Start using emotion detection to see your stats!")
-                    
-            except Exception as e:
-                st.info("Stats will appear after using the app")
+        user_stats = store.get_user_quick_stats(username)
+        st.metric("Total Sessions", user_stats['total_detections'], delta=None)
+        
+        if user_stats['last_emotion']:
+            st.metric("Last Emotion", user_stats['last_emotion'], delta=None)
+            st.metric("Variety", f"{user_stats['unique_emotions']} emotions", delta=None)
         else:
-            st.info("Database connection needed for stats")
+            st.info("Start using emotion detection to see your stats!")
         st.markdown('</div>', unsafe_allow_html=True)
 
 # ------------------ GAMES PAGE ------------------
@@ -1843,13 +1833,11 @@ elif st.session_state.current_page == 'Profile':
             col = get_history_collection()
             if col:
                 try:
-                    total_sessions = col.count_documents({'username': username})
-                    first_session = col.find_one({'username': username}, sort=[('timestamp', 1)])
-                    last_session = col.find_one({'username': username}, sort=[('timestamp', -1)])
-                    
-                    # Calculate streaks and additional stats
-                    recent_sessions = list(col.find({'username': username}).sort('timestamp', -1).limit(30))
-                    unique_emotions_30d = len(set([s['emotion'] for s in recent_sessions])) if recent_sessions else 0
+                    user_stats = store.get_user_quick_stats(username)
+                    total_sessions = user_stats['total_detections']
+                    first_session = user_stats['first_session']
+                    last_session = user_stats['last_session']
+                    unique_emotions = user_stats['unique_emotions']
                     
                     st.markdown('<div class="stats-grid">', unsafe_allow_html=True)
                     col1, col2, col3, col4 = st.columns(4)
@@ -1864,7 +1852,7 @@ elif st.session_state.current_page == 'Profile':
                     
                     with col2:
                         if first_session:
-                            days_using = (datetime.utcnow() - first_session['timestamp']).days + 1
+                            days_using = (datetime.utcnow() - first_session).days + 1
                             st.markdown(f"""
                             <div class="stat-card">
                                 <div class="stat-value">{days_using}</div>
@@ -1881,7 +1869,7 @@ elif st.session_state.current_page == 'Profile':
                     
                     with col3:
                         if last_session:
-                            last_used = last_session['timestamp'].strftime('%m/%d')
+                            last_used = last_session.strftime('%m/%d')
                             st.markdown(f"""
                             <div class="stat-card">
                                 <div class="stat-value">{last_used}</div>
@@ -1899,8 +1887,8 @@ elif st.session_state.current_page == 'Profile':
                     with col4:
                         st.markdown(f"""
                         <div class="stat-card">
-                            <div class="stat-value">{unique_emotions_30d}</div>
-                            <div class="stat-label">Emotions (30d)</div>
+                            <div class="stat-value">{unique_emotions}</div>
+                            <div class="stat-label">Distinct Emotions (all time)</div>
                         </div>
                         """, unsafe_allow_html=True)
                     
@@ -1919,8 +1907,8 @@ elif st.session_state.current_page == 'Profile':
                         achievements.append({"name": "Enthusiast", "icon": "🌟", "desc": "Reached 50 sessions milestone"})
                     if total_sessions >= 100:
                         achievements.append({"name": "Master", "icon": "🎓", "desc": "Achieved 100 sessions - emotion detection master!"})
-                    if unique_emotions_30d >= 5:
-                        achievements.append({"name": "Emotional Range", "icon": "🎭", "desc": "Expressed 5+ different emotions in 30 days"})
+                    if unique_emotions >= 5:
+                        achievements.append({"name": "Emotional Range", "icon": "🎭", "desc": "Expressed 5+ different emotions"})
                     if days_using >= 7:
                         achievements.append({"name": "Week Warrior", "icon": "📅", "desc": "Used the app for a full week"})
                     if days_using >= 30:
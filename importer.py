@@ -0,0 +1,311 @@
+"""Bulk import of emotion history and recommendation activity
+
+Reads CSV, JSONL or collections of an older MongoDB deployment (such as the
+oldmusicapp music_app database) in chunks, validates and normalizes each
+chunk with vectorized pandas operations, and writes unordered insert_many
+batches from a pool of worker threads. Write hooks are bypassed; daily
+rollups and users.stats are rebuilt once, for the affected users, when the
+import finishes.
+
+Every document gets an _id derived from its content and its position in
+the source (or keeps the source _id), and progress is checkpointed under IMPORT_CHECKPOINT_DIR, so an
+interrupted import is resumed by running it again.
+"""
+import hashlib
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+import pandas as pd
+from bson import ObjectId, decode_all, json_util
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "10000"))
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", "4"))
+IMPORT_CHECKPOINT_DIR = os.getenv("IMPORT_CHECKPOINT_DIR", "import_checkpoints")
+
+# kind -> (target collection, text fields besides username and emotion)
+IMPORT_KINDS = {
+    "emotions": ("emotion_history", ["language", "singer"]),
+    "recommendations": ("music_recommendations", ["platform", "query", "language", "artist"])
+}
+
+# Source column names (lowercased) accepted for our field names
+COLUMN_ALIASES = {
+    "emotions": {"user": "username", "date & time": "timestamp", "date": "timestamp",
+                 "time": "timestamp", "artist": "singer"},
+    "recommendations": {"user": "username", "date & time": "timestamp", "date": "timestamp",
+                        "time": "timestamp", "singer": "artist"}
+}
+
+class CSVSource:
+    """Rows of a CSV file; position is the number of data rows consumed"""
+
+    start = 0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.key = f"csv:{os.path.abspath(path)}"
+
+    def chunks(self, position: int, batch_size: int) -> Iterable[Tuple[pd.DataFrame, int]]:
+        reader = pd.read_csv(self.path, chunksize=batch_size, dtype=str, keep_default_na=False,
+                             skiprows=range(1, position + 1) if position else None)
+        with reader:
+            for frame in reader:
+                position += len(frame)
+                yield frame, position
+
+class JSONLSource:
+    """Objects of a JSON Lines file; position is the number of lines consumed"""
+
+    start = 0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.key = f"jsonl:{os.path.abspath(path)}"
+
+    def chunks(self, position: int, batch_size: int) -> Iterable[Tuple[pd.DataFrame, int]]:
+        with open(self.path, encoding="utf-8") as f:
+            for _ in range(position):
+                f.readline()
+            while True:
+                lines = [f.readline() for _ in range(batch_size)]
+                lines = [line for line in lines if line]
+                if not lines:
+                    return
+                position += len(lines)
+                records = []
+                for line in lines:
+                    try:
+                        record = json_util.loads(line) if line.strip() else {}
+                    except ValueError:
+                        record = {}
+                    records.append(record if isinstance(record, dict) else {})
+                yield pd.DataFrame.from_records(records), position
+
+class MongoSource:
+    """Documents of a collection on another MongoDB; position is the last _id consumed"""
+
+    start = None
+
+    def __init__(self, uri: str, database: str, collection: str):
+        import pymongo
+        self.collection = pymongo.MongoClient(uri, serverSelectionTimeoutMS=5000)[database][collection]
+        self.key = f"mongo:{uri}/{database}/{collection}"
+
+    def chunks(self, position: Any, batch_size: int) -> Iterable[Tuple[pd.DataFrame, Any]]:
+        query = {"_id": {"$gt": position}} if position is not None else {}
+        buffer = []
+        for batch in self.collection.find_raw_batches(query, sort=[("_id", 1)], batch_size=batch_size):
+            buffer.extend(decode_all(batch))
+            while len(buffer) >= batch_size:
+                chunk, buffer = buffer[:batch_size], buffer[batch_size:]
+                yield pd.DataFrame.from_records(chunk), chunk[-1]["_id"]
+        if buffer:
+            yield pd.DataFrame.from_records(buffer), buffer[-1]["_id"]
+
+def normalize_frame(frame: pd.DataFrame, kind: str = "emotions", username: str = None,
+                    allowed_emotions: List[str] = None, origin: str = "",
+                    first_row: int = 0) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    """Validated, normalized rows of a source chunk and rejected row counts by reason
+
+    origin (the source key) and first_row (the position of the chunk's
+    first row in the source) identify each row, so repeated identical rows
+    keep separate documents.
+    """
+    text_fields = IMPORT_KINDS[kind][1]
+    frame = frame.rename(columns=lambda c: str(c).strip().lower())
+    frame = frame.rename(columns={c: t for c, t in COLUMN_ALIASES[kind].items()
+                                  if c in frame.columns and t not in frame.columns})
+    if username:
+        frame = frame.assign(username=username)
+
+    def text(field, lower=False):
+        if field not in frame.columns:
+            return pd.Series('', index=frame.index, dtype=object)
+        values = frame[field].astype(object).where(frame[field].notna(), '').astype(str).str.strip()
+        return (values.str.lower() if lower else values).astype(object)
+
+    # Source _ids identify rows where present (MongoSource always has them), else the row position
+    if "_id" in frame.columns:
+        row_keys = frame["_id"].astype(str)
+    else:
+        row_keys = pd.Series(np.arange(first_row, first_row + len(frame)).astype(str), index=frame.index)
+    row_keys = (origin + "#" + row_keys).astype(object)
+
+    out = pd.DataFrame({"username": text("username"), "emotion": text("emotion", lower=True)})
+    if "timestamp" in frame.columns:
+        timestamps = pd.to_datetime(frame["timestamp"], errors="coerce", utc=True)
+        out["timestamp"] = timestamps.dt.tz_localize(None).astype("datetime64[ms]")
+    else:
+        out["timestamp"] = pd.Series(pd.NaT, index=frame.index, dtype="datetime64[ms]")
+    for field in text_fields:
+        out[field] = text(field)
+
+    checks = [
+        ("missing username", out["username"] == ''),
+        ("bad timestamp", out["timestamp"].isna()),
+        ("missing emotion", out["emotion"] == '')
+    ]
+    if allowed_emotions:
+        checks.append(("unknown emotion", ~out["emotion"].isin([e.lower() for e in allowed_emotions])))
+    valid = np.ones(len(out), dtype=bool)
+    rejected = {}
+    for reason, bad in checks:
+        # Count each row under the first check it fails
+        bad = bad.to_numpy() & valid
+        if bad.any():
+            rejected[reason] = int(bad.sum())
+        valid &= ~bad
+    out = out[valid]
+
+    ids = frame.loc[valid, "_id"] if "_id" in frame.columns else None
+    out["_id"] = _document_ids(out, ids, row_keys[valid])
+    return out.reset_index(drop=True), rejected
+
+def _document_ids(frame: pd.DataFrame, source_ids: pd.Series = None,
+                  row_keys: pd.Series = None) -> List[ObjectId]:
+    """Source ObjectIds where present, else ObjectIds built from the row and where it came from
+
+    Generated ids keep re-runs idempotent: the first four bytes are the
+    detection time, as in any ObjectId, and the rest a hash of the row's
+    content and its key in the source (source and row position).
+    """
+    seconds = (frame["timestamp"].to_numpy().astype("datetime64[s]").astype(np.int64)
+               .clip(0, 2**32 - 1).astype(">u4"))
+    keyed = frame if row_keys is None else frame.assign(_row=row_keys.to_numpy())
+    hashes = pd.util.hash_pandas_object(keyed, index=False).to_numpy().astype(">u8")
+    raw = np.empty(len(frame), dtype=[("t", ">u4"), ("h", ">u8")])
+    raw["t"], raw["h"] = seconds, hashes
+    data = raw.tobytes()
+    ids = [ObjectId(data[i * 12:(i + 1) * 12]) for i in range(len(frame))]
+    if source_ids is not None:
+        ids = [source if isinstance(source, ObjectId) else generated
+               for source, generated in zip(source_ids, ids)]
+    return ids
+
+def frame_documents(frame: pd.DataFrame) -> List[Dict]:
+    """Rows as BSON-ready documents with native datetimes"""
+    columns = [frame[c].tolist() if c != "timestamp" else list(frame[c].dt.to_pydatetime())
+               for c in frame.columns]
+    return [dict(zip(frame.columns, row)) for row in zip(*columns)]
+
+class ImportCheckpoint:
+    """Progress of one import, saved as JSON after every completed chunk"""
+
+    def __init__(self, key: str, directory: str = IMPORT_CHECKPOINT_DIR):
+        self.path = os.path.join(directory, hashlib.sha1(key.encode()).hexdigest() + ".json")
+        self.state = {"key": key, "position": None, "users": {}, "stored": 0,
+                      "rejected": {}, "finished": False}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.state.update(json_util.loads(f.read()))
+
+    def record(self, position: Any, users: Dict[str, List[datetime]], stored: int,
+               rejected: Dict[str, int]):
+        state = self.state
+        state["position"] = position
+        state["stored"] += stored
+        for reason, n in rejected.items():
+            state["rejected"][reason] = state["rejected"].get(reason, 0) + n
+        for username, (first, last) in users.items():
+            seen = state["users"].setdefault(username, [first, last])
+            seen[0], seen[1] = min(seen[0], first), max(seen[1], last)
+        self.save()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(json_util.dumps(self.state))
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.__init__(self.state["key"], os.path.dirname(self.path))
+
+def _user_ranges(frame: pd.DataFrame) -> Dict[str, List[datetime]]:
+    ranges = frame.groupby("username")["timestamp"].agg(["min", "max"])
+    return {username: [row["min"].to_pydatetime(), row["max"].to_pydatetime()]
+            for username, row in ranges.iterrows()}
+
+def import_history(source, kind: str = "emotions", username: str = None,
+                   allowed_emotions: List[str] = None, batch_size: int = IMPORT_BATCH_SIZE,
+                   workers: int = IMPORT_WORKERS, restart: bool = False) -> Dict:
+    """Import a source into MongoDB; returns stored, rejected and skipped counts"""
+    from database import (
+        db_manager, invalidate_analytics_state, rebuild_daily_rollups, rebuild_emotion_transitions,
+        rebuild_global_daily, reconcile_user_stats, user_stats_cache
+    )
+    from history_layout import insert_documents
+
+    if not db_manager.is_available():
+        print("Database connection not available")
+        return {}
+
+    checkpoint = ImportCheckpoint(f"{kind}|{username or ''}|{source.key}")
+    if restart:
+        checkpoint.reset()
+    state = checkpoint.state
+    if state["finished"]:
+        print(f"{source.key} was already imported; pass restart to import it again")
+        return {"stored": 0, "rejected": {}, "skipped": True}
+
+    collection_name = IMPORT_KINDS[kind][0]
+    collection = db_manager.db[collection_name]
+    layout = db_manager.layouts.get(collection_name)
+    write = layout.insert_documents if layout else insert_documents
+
+    def write_chunk(docs):
+        return len(write(collection, docs)) if docs else 0
+
+    # Chunks complete out of order; the checkpoint only advances past a
+    # chunk once every chunk before it is stored
+    pending = deque()
+
+    def complete_oldest():
+        future, position, users, rejected = pending.popleft()
+        checkpoint.record(position, users, future.result(), rejected)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            start = state["position"] if state["position"] is not None else source.start
+            for frame, position in source.chunks(start, batch_size):
+                # File positions count rows; Mongo rows are identified by their _id instead
+                first_row = start if isinstance(start, int) else 0
+                rows, rejected = normalize_frame(frame, kind, username, allowed_emotions,
+                                                 origin=source.key, first_row=first_row)
+                start = position
+                pending.append((pool.submit(write_chunk, frame_documents(rows)), position,
+                                _user_ranges(rows), rejected))
+                while len(pending) > workers * 2 or (pending and pending[0][0].done()):
+                    complete_oldest()
+            while pending:
+                complete_oldest()
+        except Exception as e:
+            for future, *_ in pending:
+                future.cancel()
+            print(f"Import stopped at position {state['position']}: {e}")
+            return {"stored": state["stored"], "rejected": state["rejected"], "skipped": False}
+
+    if kind == "emotions" and state["users"]:
+        for name, (first, last) in state["users"].items():
+            rebuild_daily_rollups(name, first, last)
+            rebuild_emotion_transitions(name)
+            user_stats_cache.invalidate(name)
+            invalidate_analytics_state(name)
+        reconcile_user_stats(usernames=list(state["users"]))
+    if state["users"]:
+        # Imported detections and clicks count on the admin dashboard too;
+        # after the daily rollups, which global_daily is counted from
+        rebuild_global_daily(min(first for first, _ in state["users"].values()),
+                             max(last for _, last in state["users"].values()))
+
+    state["finished"] = True
+    checkpoint.save()
+    return {"stored": state["stored"], "rejected": state["rejected"], "skipped": False}
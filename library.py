@@ -0,0 +1,249 @@
+"""Persistent index of the local music library
+
+scan_library walks a music directory with os.scandir from a pool of
+threads and compares every audio file's inode, mtime and size with the
+index (a SQLite file, LIBRARY_INDEX). Only new or changed files are read:
+a content hash (of the size and three LIBRARY_HASH_SAMPLE byte samples,
+so large files cost three reads) and their tags. A file that disappeared
+and reappeared elsewhere, with the same inode or the same content hash,
+is recorded as a move and keeps its tags.
+
+Each scan returns its deltas ({op: add/update/move/remove, path,
+old_path}) and passes them to the hooks registered with
+add_library_hook, so downstream indexes update without rescanning.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+from catalog import CATALOG_DIR
+
+# Optional tag reading (pydub shells out to ffprobe)
+try:
+    from pydub.utils import mediainfo
+    PYDUB_AVAILABLE = True
+except Exception:
+    PYDUB_AVAILABLE = False
+
+LIBRARY_DIR = os.getenv("LIBRARY_DIR", "music")
+LIBRARY_INDEX = os.getenv("LIBRARY_INDEX", os.path.join(CATALOG_DIR, "library.db"))
+LIBRARY_SCAN_WORKERS = int(os.getenv("LIBRARY_SCAN_WORKERS", "8"))
+LIBRARY_HASH_SAMPLE = 64 * 1024
+AUDIO_EXTENSIONS = {".mp3", ".wav", ".flac", ".ogg", ".m4a", ".aac", ".opus", ".wma"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    artist TEXT,
+    title TEXT,
+    album TEXT,
+    duration REAL,
+    scanned_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+"""
+
+FILE_COLUMNS = ["path", "inode", "mtime_ns", "size", "hash", "artist", "title", "album", "duration", "scanned_at"]
+
+_hooks: List[Callable[[List[Dict]], None]] = []
+
+def add_library_hook(fn: Callable[[List[Dict]], None]):
+    """Call fn with the deltas of every scan that changed something"""
+    _hooks.append(fn)
+
+def _scan_dir(path: str) -> Tuple[List[Tuple[str, int, int, int]], List[str]]:
+    """Audio files (path, inode, mtime_ns, size) and subdirectories of one directory"""
+    files, dirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS and entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_ino, stat.st_mtime_ns, stat.st_size))
+                except OSError:
+                    pass
+    except OSError as e:
+        print(f"Error scanning {path}: {e}")
+    return files, dirs
+
+def walk(directory: str, workers: int = LIBRARY_SCAN_WORKERS) -> Dict[str, Tuple[int, int, int]]:
+    """path -> (inode, mtime_ns, size) of the audio files under directory"""
+    found = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = {pool.submit(_scan_dir, directory)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                for path, inode, mtime_ns, size in files:
+                    found[path] = (inode, mtime_ns, size)
+                pending |= {pool.submit(_scan_dir, path) for path in dirs}
+    return found
+
+def content_hash(path: str, size: int) -> str:
+    """Hash of the size and the start, middle and end of the file"""
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, "rb") as f:
+        if size <= 3 * LIBRARY_HASH_SAMPLE:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - LIBRARY_HASH_SAMPLE) // 2, size - LIBRARY_HASH_SAMPLE):
+                f.seek(offset)
+                digest.update(f.read(LIBRARY_HASH_SAMPLE))
+    return digest.hexdigest()
+
+def read_tags(path: str) -> Dict:
+    """Artist, title, album and duration from the file's tags, else from an "Artist - Title" file name"""
+    tags, duration = {}, None
+    if PYDUB_AVAILABLE:
+        try:
+            info = mediainfo(path)
+            tags = {key.lower(): value for key, value in info.get("TAG", {}).items()}
+            duration = float(info["duration"]) if info.get("duration") else None
+        except Exception:
+            pass
+    artist, title = tags.get("artist", ""), tags.get("title", "")
+    if not (artist and title):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if " - " in stem:
+            artist, title = (part.strip() for part in stem.split(" - ", 1))
+        else:
+            title = title or stem
+    return {"artist": artist, "title": title, "album": tags.get("album", ""), "duration": duration}
+
+def _try_hash(path: str, size: int) -> Optional[str]:
+    try:
+        return content_hash(path, size)
+    except OSError as e:
+        print(f"Error reading {path}: {e}")
+        return None
+
+class LibraryIndex:
+    """The files table; one connection per thread, WAL so readers never wait on a scan"""
+
+    def __init__(self, path: str = LIBRARY_INDEX):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def stats_under(self, root: str) -> Dict[str, Tuple[int, int, int, str]]:
+        """path -> (inode, mtime_ns, size, hash) of the indexed files under root"""
+        prefix = os.path.join(root, "")
+        # Every path starting with prefix sorts between it and prefix with its last character bumped
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        rows = self._connect().execute(
+            "SELECT path, inode, mtime_ns, size, hash FROM files WHERE path >= ? AND path < ?", (prefix, upper))
+        return {path: (inode, mtime_ns, size, digest) for path, inode, mtime_ns, size, digest in rows}
+
+    def get(self, paths: List[str]) -> Dict[str, Dict]:
+        conn = self._connect()
+        result = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            rows = conn.execute(f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+            result.update({row[0]: dict(zip(FILE_COLUMNS, row)) for row in rows})
+        return result
+
+    def files(self) -> List[Dict]:
+        """Every indexed file, in path order"""
+        rows = self._connect().execute(f"SELECT {', '.join(FILE_COLUMNS)} FROM files ORDER BY path")
+        return [dict(zip(FILE_COLUMNS, row)) for row in rows]
+
+    def apply(self, upserts: List[Dict], removed: List[str]):
+        """Write a scan's rows and removals in one transaction"""
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+            conn.executemany(
+                f"INSERT OR REPLACE INTO files ({', '.join(FILE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(FILE_COLUMNS))})",
+                [tuple(row[column] for column in FILE_COLUMNS) for row in upserts]
+            )
+
+def scan_library(directory: str = LIBRARY_DIR, index_path: str = LIBRARY_INDEX,
+                 workers: int = LIBRARY_SCAN_WORKERS) -> Dict:
+    """Bring the index up to date with directory; returns the deltas and scan counts"""
+    started = time.perf_counter()
+    root = os.path.abspath(directory)
+    index = LibraryIndex(index_path)
+    found = walk(root, workers)
+    known = index.stats_under(root)
+
+    changed = [path for path, stat in found.items() if path in known and known[path][:3] != stat]
+    new = [path for path in found if path not in known]
+    gone = {path for path in known if path not in found}
+    now = time.time()
+    deltas, upserts, moved_from = [], [], {}
+
+    # Renames within the filesystem keep the inode, mtime and size: no need to read the file
+    by_stat = {known[path][:3]: path for path in gone}
+    unmatched = []
+    for path in new:
+        old_path = by_stat.pop(found[path], None)
+        if old_path is None:
+            unmatched.append(path)
+        else:
+            moved_from[path] = (old_path, known[old_path][3])
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        hashes = dict(zip(unmatched + changed, pool.map(
+            lambda path: _try_hash(path, found[path][2]), unmatched + changed)))
+        # Copies across filesystems get a new inode but keep their content
+        by_hash = {known[path][3]: path for path in by_stat.values()}
+        to_read = list(changed)
+        for path in unmatched:
+            old_path = by_hash.pop(hashes[path], None) if hashes[path] else None
+            if old_path is None:
+                to_read.append(path)
+            else:
+                moved_from[path] = (old_path, hashes[path])
+        tags = dict(zip(to_read, pool.map(read_tags, to_read)))
+
+    previous = index.get([old_path for old_path, _ in moved_from.values()])
+    for path, (old_path, digest) in moved_from.items():
+        inode, mtime_ns, size = found[path]
+        upserts.append(dict(previous[old_path], path=path, inode=inode, mtime_ns=mtime_ns, size=size,
+                            hash=digest, scanned_at=now))
+        deltas.append({"op": "move", "path": path, "old_path": old_path})
+    for path in to_read:
+        if hashes.get(path) is None:
+            continue
+        inode, mtime_ns, size = found[path]
+        upserts.append(dict(tags[path], path=path, inode=inode, mtime_ns=mtime_ns, size=size,
+                            hash=hashes[path], scanned_at=now))
+        deltas.append({"op": "update" if path in known else "add", "path": path, "old_path": None})
+    removed = sorted(gone - {old_path for old_path, _ in moved_from.values()})
+    deltas.extend({"op": "remove", "path": path, "old_path": None} for path in removed)
+
+    index.apply(upserts, removed + [old_path for old_path, _ in moved_from.values()])
+    if deltas:
+        for fn in _hooks:
+            try:
+                fn(deltas)
+            except Exception as e:
+                print(f"Error in library hook: {e}")
+
+    counts = {op: sum(1 for delta in deltas if delta["op"] == op) for op in ("add", "update", "move", "remove")}
+    return dict(counts, files=len(found), unchanged=len(found) - len(new) - len(changed),
+                deltas=deltas, seconds=time.perf_counter() - started)
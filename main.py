@@ -18,7 +18,14 @@ from urllib.parse import quote_plus
 
 # Import auth functions
 from auth import is_authenticated, show_auth_page, logout
-from database import db_manager
+from storage import DuplicateUserError, get_storage
+from export import EXPORT_FORMATS, available_formats, export_history
+from catalog import get_catalog
+from vectors import get_vector_index
+from collaborative import get_cf_model
+from recommender import (RECOMMEND_CACHE_SHARED, mood_candidates, recommendation_cache, rerank,
+                         similar_candidates)
+from charts import admin_figures, analytics_figures, figure_cache
 ## Removed: from music_recommendation import integrate_enhanced_recommendations
 
 # Optional speech recognition
@@ -28,6 +35,13 @@ try:
 except Exception:
     SPEECH_AVAILABLE = False
 
+# Catalog tracks listed next to the platform buttons
+CATALOG_RESULTS = int(os.getenv("CATALOG_RESULTS", "5"))
+# Weight of the newest frame in the smoothed emotion probabilities
+EMOTION_SMOOTHING = float(os.getenv("EMOTION_SMOOTHING", "0.3"))
+# Users who see the Admin page (comma-separated usernames)
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+
 # Page config
 st.set_page_config(
     page_title="AI Music Player + Games", 
@@ -176,14 +190,11 @@ hands = mp.solutions.hands
 holis = holistic.Holistic()
 drawing = mp.solutions.drawing_utils
 
-# Database collections
-def get_history_collection():
-    db = db_manager.db
-    return db['emotion_history'] if db is not None else None
-
-def get_user_preferences_collection():
-    db = db_manager.db
-    return db['user_preferences'] if db is not None else None
+# Data store (MongoDB, SQLite or in-memory, see STORAGE_BACKEND)
+store = get_storage()
+# Recommendation candidates computed by one worker are reused by the others
+if RECOMMEND_CACHE_SHARED:
+    recommendation_cache.shared = store
 
 # Emotion processor for WebRTC
 class EmotionProcessor:
@@ -216,23 +227,28 @@ class EmotionProcessor:
 
             lst = np.array(lst).reshape(1, -1)
             if model is not None:
-                pred = labels[np.argmax(model.predict(lst))]
+                probabilities = model.predict(lst)[0]
+                pred = labels[np.argmax(probabilities)]
                 cv2.putText(frm, pred, (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 0, 0), 2)
                 np.save("emotion.npy", np.array([pred]))
                 
-                # Save to database
+                # Smoothed probabilities drive the similarity recommendations
+                smoothed = getattr(self, 'probabilities', None)
+                self.probabilities = probabilities if smoothed is None else \
+                    EMOTION_SMOOTHING * probabilities + (1 - EMOTION_SMOOTHING) * smoothed
+                np.save("emotion_probs.npy", self.probabilities)
+                
+                # Save to database (spooled and bulk inserted in the background)
                 try:
-                    col = get_history_collection()
-                    if col is not None:
-                        username = st.session_state.get('username', 'anonymous')
-                        entry = {
-                            'username': username,
-                            'emotion': str(pred),
-                            'timestamp': datetime.utcnow(),
-                            'language': st.session_state.get('pref_lang', ''),
-                            'singer': st.session_state.get('pref_singer', ''),
-                        }
-                        col.insert_one(entry)
+                    username = st.session_state.get('username', 'anonymous')
+                    entry = {
+                        'username': username,
+                        'emotion': str(pred),
+                        'timestamp': datetime.utcnow(),
+                        'language': st.session_state.get('pref_lang', ''),
+                        'singer': st.session_state.get('pref_singer', ''),
+                    }
+                    store.save_emotion(entry, defer=True)
                 except Exception:
                     pass
 
@@ -266,6 +282,24 @@ def speech_to_text():
     except Exception as e:
         return None, f"Error: {str(e)}"
 
+# Catalog tracks as play buttons; opened tracks are ranked lower for the rest of the session
+def catalog_track_buttons(catalog, numbers, key_prefix, username, emotion, lang):
+    for number in numbers:
+        track = catalog.track(number)
+        label = f"▶️ {track['title']} — {track['artist']}"
+        if st.button(label, key=f"{key_prefix}_{track['number']}", use_container_width=True):
+            track_query = f"{track['title']} {track['artist']}"
+            webbrowser.open_new_tab(f"https://www.youtube.com/results?search_query={quote_plus(track_query)}")
+            st.session_state.setdefault('catalog_seen', set()).add(track['number'])
+            store.save_music_recommendation(
+                username=username,
+                platform="catalog",
+                query=track_query,
+                emotion=emotion,
+                language=track['language'] or lang,
+                artist=track['artist']
+            )
+
 # ------------------ Authentication Check ------------------
 if not is_authenticated():
     show_auth_page()
@@ -276,37 +310,35 @@ username = st.session_state.get('username', 'Unknown User')
 # ------------------ Sidebar Navigation ------------------
 with st.sidebar:
     st.markdown("### 🎵 Navigation")
-    nav = st.radio("", ["🏠 Home", "🎮 Games", "📜 History", "📊 Analytics", "👤 Profile"])
+    pages = ["🏠 Home", "🎮 Games", "📜 History", "📊 Analytics", "👤 Profile"]
+    if username in ADMIN_USERNAMES:
+        pages.append("🛠️ Admin")
+    nav = st.radio("", pages)
     
     st.markdown("---")
     st.markdown(f"### Welcome, **{username}**!")
     
-    # Quick stats in sidebar
-    try:
-        col = get_history_collection()
-        if col is not None:
-            total_detections = col.count_documents({'username': username})
-            unique_emotions = len(col.distinct('emotion', {'username': username}))
-            last_session = col.find_one({'username': username}, sort=[('timestamp', -1)])
-            
-            st.markdown(f"""
-            <div class="sidebar-metric">
-                <h4>📊 Your Stats</h4>
-                <p><strong>{total_detections}</strong> Total Detections</p>
-                <p><strong>{unique_emotions}</strong> Emotions Detected</p>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            if last_session:
-                last_emotion = last_session.get('emotion', 'Unknown')
-                st.markdown(f"""
-                <div class="sidebar-metric">
-                    <h4>🎭 Last Emotion</h4>
-                    <p><strong>{last_emotion}</strong></p>
-                </div>
-                """, unsafe_allow_html=True)
-    except:
-        pass
+    # Quick stats in sidebar (cached per user, no history queries)
+    user_stats = store.get_user_quick_stats(username)
+    st.markdown(f"""
+    <div class="sidebar-metric">
+        <h4>📊 Your Stats</h4>
+        <p><strong>{user_stats['total_detections']}</strong> Total Detections</p>
+        <p><strong>{user_stats['unique_emotions']}</strong> Emotions Detected</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    if user_stats['last_session']:
+        last_emotion = user_stats['last_emotion'] or 'Unknown'
+        st.markdown(f"""
+        <div class="sidebar-metric">
+            <h4>🎭 Last Emotion</h4>
+            <p><strong>{last_emotion}</strong></p>
+        </div>
+        """, unsafe_allow_html=True)
+    
+    if not store.is_available():
+        st.caption("⚠️ Database offline - showing limited data")
     
     st.markdown("---")
     if st.button("🚪 Logout", use_container_width=True):
@@ -489,8 +521,7 @@ if nav == "🏠 Home":
                     
                     # Save to database if available
                     try:
-                        from database import save_music_recommendation
-                        save_music_recommendation(
+                        store.save_music_recommendation(
                             username=st.session_state.get('username', 'anonymous'),
                             platform=name.split()[-1].lower(),
                             query=enhanced_query.replace('+', ' '),
@@ -506,6 +537,54 @@ if nav == "🏠 Home":
                     np.save("emotion.npy", np.array([""]))
                     st.rerun()
             
+            # Concrete tracks from the local catalog (manage.py ingest-catalog); candidates
+            # are cached per (emotion, language, artist) and reranked for this user
+            catalog = get_catalog()
+            if catalog is not None:
+                seen = st.session_state.get('catalog_seen', set())
+                mood = mood_candidates(catalog, current_emotion, lang, singer)
+                if mood['numbers']:
+                    st.markdown("#### 🎼 Tracks for Your Mood")
+                    if 'artist' not in mood['applied']:
+                        st.caption(f"No {current_emotion} tracks by {singer}; showing other artists")
+                    catalog_track_buttons(catalog, rerank(mood['numbers'], seen=seen, limit=CATALOG_RESULTS),
+                                          "track", username, current_emotion, lang)
+                
+                # Nearest tracks to the emotion and the preferred artist's sound, reranked
+                # against this user's smoothed emotion mix
+                index = get_vector_index(catalog=catalog)
+                if index is not None:
+                    similar = similar_candidates(catalog, index, current_emotion, lang, singer)
+                    query = None
+                    if os.path.exists("emotion_probs.npy"):
+                        query = index.query_vector(dict(zip(labels, np.load("emotion_probs.npy"))))
+                    numbers = rerank(similar['numbers'], similar['scores'], index, query, seen, CATALOG_RESULTS)
+                    if numbers:
+                        st.markdown("#### 🎧 Feels Like Your Mood")
+                        catalog_track_buttons(catalog, numbers, "similar", username, current_emotion, lang)
+            
+            # Artists clicked by listeners with similar taste in this mood (manage.py train-cf)
+            cf_model = get_cf_model()
+            if cf_model is not None:
+                artists, personalized = cf_model.recommend_artists(username, current_emotion, lang,
+                                                                   limit=CATALOG_RESULTS, exclude=[singer])
+                if artists:
+                    st.markdown("#### 👥 Listeners Like You")
+                    if not personalized:
+                        st.caption(f"Most played {current_emotion} artists; play a few to personalize")
+                    for pick in artists:
+                        if st.button(f"🎤 {pick['artist']}", key=f"cf_{pick['artist']}", use_container_width=True):
+                            cf_query = f"{lang} {current_emotion} song {pick['artist']}"
+                            webbrowser.open_new_tab(f"https://www.youtube.com/results?search_query={quote_plus(cf_query)}")
+                            store.save_music_recommendation(
+                                username=username,
+                                platform="cf",
+                                query=cf_query,
+                                emotion=current_emotion,
+                                language=lang,
+                                artist=pick['artist']
+                            )
+            
             # More platforms in expander
             with st.expander("🌟 More Platforms"):
                 more_platforms = [
@@ -643,19 +722,14 @@ elif nav == "📜 History":
     </div>
     """, unsafe_allow_html=True)
     
-    col = get_history_collection()
-    if col is None:
+    if not store.is_available():
         st.error("Database connection not available")
     else:
-        # Fetch recent history
-        docs = list(col.find({'username': username}).sort('timestamp', -1).limit(100))
+        latest, _ = store.get_emotion_page(username, page_size=1)
         
-        if not docs:
+        if not latest:
             st.info("No history found. Start using emotion detection to see your history here!")
         else:
-            # Convert to DataFrame
-            df = pd.DataFrame(docs)
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
             
             # Summary stats
             col1, col2, col3, col4 = st.columns(4)
@@ -693,21 +767,88 @@ elif nav == "📜 History":
                         webbrowser.open(f"https://www.youtube.com/results?search_query={search_query}")
                         st.success(f"🎉 Opening YouTube with {emotion} songs by {singer} in {lang}!")
             
-            # Recent history table
-            st.markdown("### 📋 Recent History")
-            display_df = df[['timestamp', 'emotion', 'language', 'singer']].head(20)
-            display_df['timestamp'] = display_df['timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S')
-            display_df.columns = ['Date & Time', 'Emotion', 'Language', 'Singer']
-            st.dataframe(display_df, use_container_width=True)
+            # History browser: keyset pagination over (timestamp, _id), one indexed query per page
+            st.markdown("### 📋 History")
+            page_col1, page_col2, page_col3, page_col4 = st.columns(4)
+            with page_col1:
+                page_size = st.selectbox("Rows per page", [20, 50, 100])
+            with page_col2:
+                jump_date = st.date_input("Jump to date", value=None)
+            with page_col3:
+                page_emotions = st.multiselect("Emotions", list(labels) if labels is not None else [],
+                                               key="page_emotions")
+            with page_col4:
+                page_languages = [l.strip() for l in st.text_input("Languages", placeholder="e.g., Hindi, English").split(',')
+                                  if l.strip()]
+            page_archive = st.checkbox("Include archived history", key="page_archive")
             
-            # Download option
-            csv = df.to_csv(index=False)
-            st.download_button(
-                label="📥 Download History (CSV)",
-                data=csv,
-                file_name=f"emotion_history_{username}_{datetime.now().strftime('%Y%m%d')}.csv",
-                mime="text/csv"
-            )
+            # Stack of page cursors; any change to the controls starts again from the first page
+            page_key = (page_size, jump_date, tuple(page_emotions), tuple(page_languages), page_archive)
+            if st.session_state.get('history_page_key') != page_key:
+                start = (datetime.combine(jump_date + timedelta(days=1), datetime.min.time()), None) \
+                    if jump_date else None
+                st.session_state['history_page_key'] = page_key
+                st.session_state['history_cursors'] = [start]
+            cursors = st.session_state['history_cursors']
+            
+            page, next_cursor = store.get_emotion_page(username, cursors[-1], page_size,
+                                                       page_emotions, page_languages, page_archive)
+            if not page:
+                st.info("No history matches these filters.")
+            else:
+                display_df = pd.DataFrame(page, columns=['timestamp', 'emotion', 'language', 'singer'])
+                display_df['timestamp'] = pd.to_datetime(display_df['timestamp']).dt.strftime('%Y-%m-%d %H:%M:%S')
+                display_df.columns = ['Date & Time', 'Emotion', 'Language', 'Singer']
+                st.dataframe(display_df, use_container_width=True, hide_index=True)
+            
+            nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+            with nav_col1:
+                if st.button("⬅️ Newer", disabled=len(cursors) == 1, use_container_width=True):
+                    cursors.pop()
+                    st.rerun()
+            with nav_col2:
+                st.caption(f"Page {len(cursors)}")
+            with nav_col3:
+                if st.button("Older ➡️", disabled=next_cursor is None, use_container_width=True):
+                    cursors.append(next_cursor)
+                    st.rerun()
+            
+            # Export the complete history; the file is only built on request
+            with st.expander("📥 Export Full History"):
+                export_col1, export_col2, export_col3 = st.columns(3)
+                with export_col1:
+                    export_format = st.selectbox("Format", available_formats())
+                with export_col2:
+                    export_range = st.date_input("Date range", value=(), key="export_range")
+                with export_col3:
+                    export_emotions = st.multiselect("Emotions", list(labels) if labels is not None else [],
+                                                     key="export_emotions")
+                export_archive = st.checkbox("Include archived history", key="export_archive")
+                
+                if st.button("Prepare Export", use_container_width=True):
+                    export_start = export_end = None
+                    if len(export_range) == 2:
+                        export_start = datetime.combine(export_range[0], datetime.min.time())
+                        export_end = datetime.combine(export_range[1], datetime.max.time())
+                    with st.spinner("Exporting history..."):
+                        path = export_history(store, username, export_format,
+                                              export_start, export_end, export_emotions, export_archive)
+                    if path:
+                        # Streamlit reads the file into memory for the button, so it is
+                        # offered on this run only and the file is removed right away
+                        suffix, mime = EXPORT_FORMATS[export_format]
+                        try:
+                            with open(path, 'rb') as f:
+                                st.download_button(
+                                    label=f"📥 Download History ({export_format.upper()})",
+                                    data=f,
+                                    file_name=f"emotion_history_{username}_{datetime.now().strftime('%Y%m%d')}{suffix}",
+                                    mime=mime
+                                )
+                        finally:
+                            os.remove(path)
+                    else:
+                        st.error("Export failed, please try again")
 
 # ------------------ ANALYTICS PAGE ------------------
 elif nav == "📊 Analytics":
@@ -718,71 +859,135 @@ elif nav == "📊 Analytics":
     </div>
     """, unsafe_allow_html=True)
     
-    col = get_history_collection()
-    if col is None:
+    # Filters are pushed down into the aggregation's $match stage
+    with st.expander("🔎 Filters"):
+        filter_col1, filter_col2 = st.columns(2)
+        with filter_col1:
+            date_range = st.date_input("Date range", value=())
+        with filter_col2:
+            emotion_options = list(labels) if labels is not None else []
+            emotion_filter = st.multiselect("Emotions", emotion_options)
+        include_archive = st.checkbox("Include archived history (from daily rollups)")
+    
+    start_date = end_date = None
+    if len(date_range) == 2:
+        start_date = datetime.combine(date_range[0], datetime.min.time())
+        end_date = datetime.combine(date_range[1], datetime.max.time())
+    
+    if not store.is_available():
         st.error("Database connection not available")
     else:
-        docs = list(col.find({'username': username}))
+        # Figures are rebuilt only when the user's history (writes, archiving,
+        # backfills, from any worker) or the filters change
+        figure_key = (username, store.get_history_revision(username), start_date, end_date, tuple(emotion_filter), include_archive)
+        
+        def build_figures():
+            analytics = store.get_emotion_analytics(username, start_date, end_date, emotion_filter,
+                                                    include_archive)
+            if not analytics.get('total_detections'):
+                return {}
+            return analytics_figures(analytics, store.get_emotion_transitions(username, start_date, end_date))
         
-        if not docs:
+        figures = figure_cache.get_or_build(figure_key, build_figures)
+        
+        if not figures:
             st.info("No data available for analytics. Start using the app to see insights!")
         else:
-            df = pd.DataFrame(docs)
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            
             # Time-based analysis
             col1, col2 = st.columns(2)
             
             with col1:
                 st.markdown("### 📈 Emotion Frequency")
-                emotion_counts = df['emotion'].value_counts()
-                fig = px.pie(values=emotion_counts.values, names=emotion_counts.index, 
-                           title="Distribution of Detected Emotions")
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(figures['emotions'], use_container_width=True)
             
             with col2:
                 st.markdown("### 📅 Daily Activity")
-                daily_counts = df.set_index('timestamp').resample('D').size().reset_index()
-                daily_counts.columns = ['Date', 'Count']
-                fig = px.line(daily_counts, x='Date', y='Count', 
-                            title="Daily Emotion Detections")
-                st.plotly_chart(fig, use_container_width=True)
+                st.plotly_chart(figures['daily'], use_container_width=True)
             
             # Hourly patterns
             st.markdown("### 🕐 Hourly Patterns")
-            df['hour'] = df['timestamp'].dt.hour
-            hourly_patterns = df.groupby(['hour', 'emotion']).size().reset_index(name='count')
-            fig = px.bar(hourly_patterns, x='hour', y='count', color='emotion',
-                        title="Emotion Detection by Hour of Day")
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figures['hourly'], use_container_width=True)
             
             # Weekly patterns
             st.markdown("### 📅 Weekly Patterns")
-            df['weekday'] = df['timestamp'].dt.day_name()
-            weekday_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-            weekly_patterns = df.groupby(['weekday', 'emotion']).size().reset_index(name='count')
-            fig = px.bar(weekly_patterns, x='weekday', y='count', color='emotion',
-                        title="Emotion Detection by Day of Week",
-                        category_orders={'weekday': weekday_order})
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(figures['weekday'], use_container_width=True)
             
             # Music preferences analysis
-            if 'language' in df.columns and 'singer' in df.columns:
+            if 'languages' in figures:
                 col1, col2 = st.columns(2)
                 
                 with col1:
                     st.markdown("### 🌍 Language Preferences")
-                    lang_counts = df['language'].value_counts().head(10)
-                    fig = px.bar(x=lang_counts.index, y=lang_counts.values,
-                               title="Most Searched Languages")
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(figures['languages'], use_container_width=True)
                 
                 with col2:
                     st.markdown("### 🎤 Favorite Artists")
-                    singer_counts = df['singer'].value_counts().head(10)
-                    fig = px.bar(x=singer_counts.index, y=singer_counts.values,
-                               title="Most Searched Artists")
-                    st.plotly_chart(fig, use_container_width=True)
+                    st.plotly_chart(figures['singers'], use_container_width=True)
+            
+            # Emotion transitions
+            if 'transitions' in figures:
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    st.markdown("### 🔀 Emotion Transitions")
+                    st.plotly_chart(figures['transitions'], use_container_width=True)
+                
+                with col2:
+                    st.markdown("### ⏱️ Emotion Dwell Times")
+                    st.plotly_chart(figures['dwell'], use_container_width=True)
+            
+            plotted, days = figures['daily_points']
+            st.caption(f"Chart payload: {sum(figures['payload_bytes'].values()) / 1024:.1f} KiB "
+                       f"(daily activity: {plotted} of {days} days plotted)")
+
+# ------------------ ADMIN PAGE ------------------
+elif nav == "🛠️ Admin" and username in ADMIN_USERNAMES:
+    st.markdown("""
+    <div class="main-header">
+        <h1>Admin Dashboard</h1>
+        <p>Activity across all users, from the global daily rollups</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    period = st.selectbox("Period", [7, 30, 90, 365], index=1, format_func=lambda days: f"Last {days} days")
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    
+    if not store.is_available():
+        st.error("Database connection not available")
+    else:
+        stats = store.get_global_analytics(today - timedelta(days=period - 1), today + timedelta(days=1))
+        if not stats.get('days'):
+            st.info("No global rollups for this period (see manage.py rebuild-global-daily)")
+        else:
+            col1, col2, col3, col4 = st.columns(4)
+            col1.metric("Active users (est.)", f"{stats['active_users']:,}")
+            col2.metric("Detections", f"{stats['detections']:,}")
+            col3.metric("Peak hour (UTC)", f"{stats['peak_hour']}:00" if stats['peak_hour'] is not None else "-")
+            col4.metric("Click-through", f"{stats['click_through']:.1%}",
+                        help="Share of active users who opened a music platform")
+            
+            figures = admin_figures(stats)
+            st.plotly_chart(figures['active_users'], use_container_width=True)
+            st.plotly_chart(figures['activity'], use_container_width=True)
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                st.plotly_chart(figures['emotions'], use_container_width=True)
+            with col2:
+                st.plotly_chart(figures['platforms'], use_container_width=True)
+            st.plotly_chart(figures['hourly'], use_container_width=True)
+    
+    # This worker's recommendation cache since it started
+    st.markdown("### ⚡ Recommendation Cache")
+    cache_stats = recommendation_cache.stats()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Hit rate", f"{cache_stats['hit_rate']:.1%}")
+    col2.metric("Lookups", f"{cache_stats['hits'] + cache_stats['misses']:,}")
+    col3.metric("Computed", f"{cache_stats['computed']:,}",
+                help=f"{cache_stats['shared_hits']:,} misses were served by the shared cache")
+    col4.metric("Entries", f"{cache_stats['entries']:,}",
+                help=f"{cache_stats['expired']:,} expired, {cache_stats['evicted']:,} evicted, "
+                     f"{cache_stats['invalidations']:,} replaced after a catalog rebuild")
 
 # ------------------ PROFILE PAGE ------------------
 elif nav == "👤 Profile":
@@ -793,14 +998,10 @@ elif nav == "👤 Profile":
     </div>
     """, unsafe_allow_html=True)
     
-    db = db_manager.db
-    if db is None:
+    if not store.is_available():
         st.error("Database connection not available")
     else:
-        users_collection = db['users']
-        prefs_collection = get_user_preferences_collection()
-        
-        user_doc = users_collection.find_one({'username': username})
+        user_doc = store.get_user(username)
         
         if not user_doc:
             st.error("User profile not found")
@@ -830,56 +1031,70 @@ elif nav == "👤 Profile":
                     favorite_artists = st.text_area("Favorite Artists", 
                                                     placeholder="List your favorite artists")
                     
+                    # Notification preferences
+                    st.markdown("#### 🔔 Notifications")
+                    emotion_alerts = st.checkbox(
+                        "Emotion Pattern Alerts",
+                        value=user_doc.get('profile', {}).get('emotion_alerts', False),
+                        help="Alert me when my mood stays low for several sessions or is unusual for the time of day"
+                    )
+                    
                     if st.form_submit_button("💾 Save Changes", use_container_width=True):
                         # Update user profile
-                        users_collection.update_one(
-                            {'username': username},
-                            {'$set': {
+                        try:
+                            store.update_user(username, {
                                 'email': new_email,
                                 'phone': new_phone,
+                                'profile.emotion_alerts': emotion_alerts,
                                 'updated_at': datetime.utcnow()
-                            }}
-                        )
-                        
-                        # Update preferences
-                        if prefs_collection is not None:
-                            prefs_collection.update_one(
-                                {'username': username},
-                                {'$set': {
-                                    'default_language': default_lang,
-                                    'favorite_genres': favorite_genres,
-                                    'favorite_artists': favorite_artists,
-                                    'updated_at': datetime.utcnow()
-                                }},
-                                upsert=True
-                            )
-                        
-                        st.success("Profile updated successfully!")
-                        st.rerun()
+                            })
+                        except DuplicateUserError:
+                            st.error("That email is already used by another account")
+                        else:
+                            # Update preferences
+                            store.save_preferences(username, {
+                                'default_language': default_lang,
+                                'favorite_genres': favorite_genres,
+                                'favorite_artists': favorite_artists
+                            })
+                            
+                            st.success("Profile updated successfully!")
+                            st.rerun()
             
             # Account statistics
             st.markdown("### 📊 Account Statistics")
-            col = get_history_collection()
-            if col is not None:
-                total_sessions = col.count_documents({'username': username})
-                first_session = col.find_one({'username': username}, sort=[('timestamp', 1)])
-                last_session = col.find_one({'username': username}, sort=[('timestamp', -1)])
-                
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    st.metric("Total Sessions", total_sessions)
-                with col2:
-                    if first_session:
-                        days_using = (datetime.utcnow() - first_session['timestamp']).days
-                        st.metric("Days Using App", days_using)
-                    else:
-                        st.metric("Days Using App", 0)
-                with col3:
-                    if last_session:
-                        last_used = last_session['timestamp'].strftime('%Y-%m-%d')
-                        st.metric("Last Used", last_used)
-                    else:
-                        st.metric("Last Used", "Never")
+            user_stats = store.get_user_quick_stats(username)
+            first_session = user_stats['first_session']
+            last_session = user_stats['last_session']
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Total Sessions", user_stats['total_detections'])
+            with col2:
+                if first_session:
+                    days_using = (datetime.utcnow() - first_session).days
+                    st.metric("Days Using App", days_using)
+                else:
+                    st.metric("Days Using App", 0)
+            with col3:
+                if last_session:
+                    last_used = last_session.strftime('%Y-%m-%d')
+                    st.metric("Last Used", last_used)
+                else:
+                    st.metric("Last Used", "Never")
+            
+            # Mood alerts from the online detector
+            if user_doc.get('profile', {}).get('emotion_alerts'):
+                st.markdown("### 🔔 Mood Alerts")
+                alerts = store.get_mood_alerts(username)
+                if not alerts:
+                    st.info("No new mood alerts")
+                else:
+                    for alert in alerts:
+                        st.warning(f"**{alert['session_end'].strftime('%Y-%m-%d %H:%M')}** — {alert['message']}")
+                    if st.button("✅ Dismiss alerts"):
+                        store.acknowledge_mood_alerts(username)
+                        st.rerun()
 
 # ------------------ Footer ------------------
 st.markdown("---")
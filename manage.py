@@ -0,0 +1,638 @@
+"""Maintenance commands for the music app data layer
+
+Usage: python manage.py <command> [options]
+"""
+import argparse
+import sys
+import time
+
+
+def replay_spool(args):
+    """Drain the local write spool into MongoDB"""
+    from database import db_manager
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable; spooled writes were left in place")
+        return 1
+    
+    start = time.perf_counter()
+    replayed = db_manager.flush_pending_writes()
+    elapsed = time.perf_counter() - start
+    rate = replayed / elapsed if elapsed > 0 else 0.0
+    print(f"Replayed {replayed} spooled writes in {elapsed:.2f}s ({rate:,.0f} docs/s)")
+    return 0
+
+
+def reconcile_stats(args):
+    """Recompute users.stats counters from history"""
+    from database import reconcile_user_stats
+    
+    start = time.perf_counter()
+    updated = reconcile_user_stats(batch_size=args.batch_size)
+    print(f"Reconciled stats for {updated} users in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+def archive_history(args):
+    """Move old emotion history into the columnar archive"""
+    from database import archive_emotion_history, db_manager
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    
+    start = time.perf_counter()
+    if args.older_than_days is None:
+        removed = archive_emotion_history()
+    else:
+        removed = archive_emotion_history(older_than_days=args.older_than_days)
+    print(f"Archived {removed} detections in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+def import_history(args):
+    """Bulk import emotion history or recommendation activity"""
+    from database import db_manager
+    from importer import CSVSource, JSONLSource, MongoSource, import_history as run_import
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    
+    if not args.mongo_uri and not args.path:
+        print("Give a file to import or --mongo-uri")
+        return 1
+    
+    if args.mongo_uri:
+        source = MongoSource(args.mongo_uri, args.mongo_database, args.mongo_collection)
+    elif args.path.endswith((".jsonl", ".json", ".ndjson")):
+        source = JSONLSource(args.path)
+    else:
+        source = CSVSource(args.path)
+    
+    start = time.perf_counter()
+    options = {name: value for name, value in (("batch_size", args.batch_size), ("workers", args.workers))
+               if value is not None}
+    result = run_import(source, kind=args.kind, username=args.username,
+                        allowed_emotions=args.emotions, restart=args.restart, **options)
+    elapsed = time.perf_counter() - start
+    if not result or result["skipped"]:
+        return 1 if not result else 0
+    rate = result["stored"] / elapsed if elapsed > 0 else 0.0
+    print(f"Stored {result['stored']} documents in {elapsed:.2f}s ({rate:,.0f} docs/s)")
+    for reason, count in sorted(result["rejected"].items()):
+        print(f"Rejected {count} rows: {reason}")
+    return 0
+
+
+def run_backfill(args):
+    """Run or resume a registered backfill"""
+    from backfill import BACKFILLS, reset_backfill, run_backfill as run
+    from database import db_manager
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    if args.name not in BACKFILLS:
+        print(f"Unknown backfill {args.name}; registered: {', '.join(sorted(BACKFILLS))}")
+        return 1
+    
+    if args.restart:
+        reset_backfill(args.name)
+    options = {name: value for name, value in (("parts", args.parts), ("batch_size", args.batch_size),
+                                               ("max_docs_per_sec", args.rate)) if value is not None}
+    start = time.perf_counter()
+    processed = run(args.name, workers=args.workers, **options)
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {processed} documents in {elapsed:.2f}s ({rate:,.0f} docs/s)")
+    return backfill_status(args)
+
+
+def backfill_status(args):
+    """Show the progress of backfills"""
+    from backfill import BACKFILLS, backfill_status as status
+    from database import db_manager
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    
+    for name in [args.name] if args.name else sorted(BACKFILLS):
+        progress = status(name)
+        ranges = ", ".join(f"{count} {state}" for state, count in sorted(progress["ranges"].items()))
+        print(f"{name}: {ranges or 'not started'}; {progress['processed']} processed, "
+              f"{progress['written']} writes")
+    return 0
+
+
+def rebuild_global_daily(args):
+    """Rebuild the global daily rollups behind the admin dashboard"""
+    from datetime import datetime, timedelta
+    from database import db_manager, rebuild_global_daily as rebuild
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    
+    end = datetime.strptime(args.end, '%Y-%m-%d') if args.end else datetime.utcnow()
+    first = datetime.strptime(args.start, '%Y-%m-%d') if args.start else end - timedelta(days=args.days - 1)
+    start = time.perf_counter()
+    rebuilt = rebuild(first, end)
+    print(f"Rebuilt {rebuilt} days of global rollups in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+def ingest_catalog(args):
+    """Build the local track catalog index from CSV/JSONL track files"""
+    import os
+    
+    from catalog import CATALOG_INDEX, Catalog, ingest_catalog as ingest
+    from vectors import build_ivf, build_vectors
+    
+    index = args.index or CATALOG_INDEX
+    start = time.perf_counter()
+    summary = ingest(args.paths, index)
+    print(f"Indexed {summary['tracks']:,} tracks ({summary['artists']:,} artists, "
+          f"{summary['languages']} languages, {summary['tags']} tags) in {time.perf_counter() - start:.2f}s")
+    for emotion, count in sorted(summary['emotions'].items()):
+        print(f"  {emotion or '(no mood)'}: {count:,}")
+    
+    # Feature vectors (and the IVF lists) live next to the index; building the
+    # vectors removes IVF lists of the previous catalog, so they exist only with --ivf
+    directory = os.path.dirname(index) or "."
+    start = time.perf_counter()
+    meta = build_vectors(Catalog.load(index), os.path.join(directory, "vectors.f32"))
+    print(f"Wrote {meta['rows']:,} x {len(meta['columns'])} feature vectors in {time.perf_counter() - start:.2f}s")
+    if args.ivf:
+        start = time.perf_counter()
+        ivf = build_ivf(os.path.join(directory, "vectors.f32"), os.path.join(directory, "ivf.npz"), lists=args.ivf)
+        print(f"Built {ivf['lists']} IVF lists (largest {ivf['largest']:,} tracks) "
+              f"in {time.perf_counter() - start:.2f}s")
+    return 0
+
+
+def scan_library(args):
+    """Index new, changed, moved and removed audio files; analyze the new ones if pydub is available"""
+    import audio_features
+    from catalog import get_catalog
+    from library import LIBRARY_DIR, scan_library as scan
+    from vectors import IVF_PATH, build_ivf, build_vectors, ivf_lists
+    
+    directory = args.directory or LIBRARY_DIR
+    if audio_features.PYDUB_AVAILABLE:
+        result = audio_features.scan_library(directory, workers=args.workers or audio_features.AUDIO_WORKERS,
+                                             full=args.full)
+        library = result["library"]
+    else:
+        result, library = None, scan(directory)
+    print(f"{library['files']:,} audio files: {library['unchanged']:,} unchanged, {library['add']:,} added, "
+          f"{library['update']:,} updated, {library['move']:,} moved, {library['remove']:,} removed "
+          f"({library['seconds']:.2f}s)")
+    if result is None:
+        print("pydub is not installed; skipped audio analysis")
+        return 0
+    print(f"Analyzed {result['analyzed']:,} of {result['files']:,} library files "
+          f"({result['failed']:,} undecodable) in {result['seconds']:.1f}s")
+    
+    catalog = get_catalog()
+    if catalog is not None:
+        # New audio columns change the vectors' width: the IVF lists are rebuilt with them
+        lists = ivf_lists(IVF_PATH)
+        meta = build_vectors(catalog)
+        print(f"Rebuilt {meta['rows']:,} x {len(meta['columns'])} feature vectors")
+        if lists:
+            ivf = build_ivf(lists=lists)
+            print(f"Rebuilt {ivf['lists']} IVF lists")
+    return 0
+
+
+def train_cf(args):
+    """Train the collaborative filtering model from music_recommendations clicks"""
+    from collaborative import CF_DIR, CF_FACTORS, CF_ITERATIONS, CF_WORKERS, interaction_matrix, save_model, train
+    from database import db_manager, iter_recommendation_interactions
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    
+    started = time.perf_counter()
+    matrix = interaction_matrix(iter_recommendation_interactions())
+    if not len(matrix["clicks"]):
+        print("No recommendation clicks to train on")
+        return 1
+    print(f"{len(matrix['users']):,} users x {len(matrix['items']):,} items, "
+          f"{len(matrix['clicks']):,} interactions ({matrix['clicks'].sum():,.0f} clicks) "
+          f"read in {time.perf_counter() - started:.2f}s")
+    
+    started = time.perf_counter()
+    user_factors, item_factors = train(
+        matrix["user_codes"], matrix["item_codes"], matrix["clicks"], len(matrix["users"]), len(matrix["items"]),
+        factors=args.factors or CF_FACTORS, iterations=args.iterations or CF_ITERATIONS,
+        workers=args.workers or CF_WORKERS,
+        progress=lambda iteration, seconds: print(f"  iteration {iteration}: {seconds:.2f}s"))
+    save_model(matrix, user_factors, item_factors, args.directory or CF_DIR)
+    print(f"Trained {user_factors.shape[1]} factors in {time.perf_counter() - started:.2f}s")
+    return 0
+
+
+def bench_vectors(args):
+    """Recall and latency of exact vs IVF track retrieval"""
+    import os
+    import tempfile
+    import numpy as np
+    
+    from vectors import VECTORS_PATH, VectorIndex, build_ivf, save_vectors
+    
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.synthetic:
+            # Clustered unit vectors, closer to real features than uniform noise
+            centres = rng.normal(size=(256, args.dims)).astype(np.float32)
+            rows = centres[rng.integers(0, 256, args.synthetic)] + \
+                0.5 * rng.normal(size=(args.synthetic, args.dims)).astype(np.float32)
+            rows /= np.linalg.norm(rows, axis=1, keepdims=True)
+            path = os.path.join(scratch, "vectors.f32")
+            save_vectors(rows, [f"f{i}" for i in range(args.dims)], path)
+            del rows
+        else:
+            path = VECTORS_PATH
+            if not os.path.exists(path + ".json"):
+                print("No catalog vectors; run ingest-catalog or pass --synthetic N")
+                return 1
+        ivf_path = os.path.join(scratch, "ivf.npz")
+        started = time.perf_counter()
+        build_ivf(path, ivf_path, lists=args.lists)
+        print(f"IVF with {args.lists} lists built in {time.perf_counter() - started:.2f}s")
+        
+        index = VectorIndex(path, ivf_path)
+        queries = np.asarray(index.vectors[rng.choice(len(index), args.queries, replace=False)])
+        queries = queries + 0.1 * rng.normal(size=queries.shape).astype(np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        print(f"{len(index):,} vectors x {len(index.columns)} dims, {args.queries} queries, k={args.k}")
+        
+        started = time.perf_counter()
+        _, exact = index.search(queries, args.k)
+        batched = (time.perf_counter() - started) / args.queries
+        started = time.perf_counter()
+        for query in queries[:10]:
+            index.search(query, args.k)
+        single = (time.perf_counter() - started) / min(10, args.queries)
+        print(f"{'exact':<14}{single * 1000:>9.2f} ms/query{batched * 1000:>9.2f} ms/query batched   recall 1.000")
+        
+        for probes in args.probes:
+            started = time.perf_counter()
+            _, approximate = index.search_ivf(queries, args.k, probes)
+            elapsed = (time.perf_counter() - started) / args.queries
+            # Ties make ids ambiguous, so a hit is any score reaching the exact k-th score
+            recall = np.mean((approximate >= exact[:, -1:] - 1e-6).sum(axis=1) / args.k)
+            print(f"{f'ivf probes={probes}':<14}{elapsed * 1000:>9.2f} ms/query{'':>27}recall {recall:.3f}")
+    return 0
+
+
+def bench_cf(args):
+    """Training time, hit rate and serving latency of the collaborative filtering model on synthetic clicks"""
+    import tempfile
+    import numpy as np
+    import pandas as pd
+    
+    from collaborative import CF_FACTORS, CF_ITERATIONS, CF_WORKERS, CFModel, save_model, train
+    
+    factors, iterations = args.factors or CF_FACTORS, args.iterations or CF_ITERATIONS
+    workers = args.workers or CF_WORKERS
+    rng = np.random.default_rng(0)
+    emotions = ['angry', 'disgust', 'fear', 'happy', 'neutral', 'sad', 'surprise']
+    languages = ['hindi', 'english', 'punjabi', 'tamil', 'telugu']
+    # Users belong to taste groups; each group favours its own items, with a Zipf-like rank preference
+    groups = rng.integers(0, args.groups, args.users)
+    group_items = np.stack([rng.choice(args.items, 2000, replace=False) for _ in range(args.groups)])
+    activity = rng.lognormal(0, 1, args.users)
+    users = rng.choice(args.users, args.clicks, p=activity / activity.sum())
+    ranks = np.minimum((2000 ** rng.random(args.clicks)).astype(np.int64) - 1, 1999)
+    items = group_items[groups[users], ranks]
+    noise = rng.random(args.clicks) < 0.2
+    items[noise] = np.minimum((args.items ** rng.random(noise.sum())).astype(np.int64) - 1, args.items - 1)
+    pairs, clicks = np.unique(users * args.items + items, return_counts=True)
+    user_codes, item_codes = pairs // args.items, pairs % args.items
+    
+    # Hold out one interaction of each sampled user with at least two
+    first = np.searchsorted(user_codes, np.arange(args.users))
+    counts = np.diff(np.append(first, len(pairs)))
+    candidates = np.flatnonzero(counts >= 2)
+    test_users = rng.choice(candidates, min(args.queries, len(candidates)), replace=False)
+    held_out = first[test_users] + rng.integers(0, counts[test_users])
+    train_mask = np.ones(len(pairs), dtype=bool)
+    train_mask[held_out] = False
+    print(f"{args.clicks:,} clicks -> {len(pairs):,} interactions, {args.users:,} users x {args.items:,} items, "
+          f"{factors} factors, {workers} workers")
+    
+    started = time.perf_counter()
+    X, Y = train(user_codes[train_mask], item_codes[train_mask], clicks[train_mask].astype(np.float32),
+                 args.users, args.items, factors=factors, iterations=iterations, workers=workers,
+                 progress=lambda iteration, seconds: print(f"  iteration {iteration}: {seconds:.2f}s"))
+    print(f"Trained in {time.perf_counter() - started:.2f}s")
+    
+    # Leave-one-out hit rate: is the held-out item in the top 10 of the items the user has not clicked?
+    popularity = np.bincount(item_codes[train_mask], weights=clicks[train_mask], minlength=args.items)
+    hits = np.zeros(2)
+    for user, row in zip(test_users, held_out):
+        seen = item_codes[first[user]:first[user] + counts[user]]
+        seen = seen[seen != item_codes[row]]
+        for method, scores in enumerate((Y @ X[user], popularity.copy())):
+            scores[seen] = -np.inf
+            hits[method] += item_codes[row] in np.argpartition(-scores, 10)[:10]
+    print(f"HR@10 {hits[0] / len(test_users):.3f} (most clicked: {hits[1] / len(test_users):.3f}) "
+          f"over {len(test_users):,} held-out interactions")
+    
+    with tempfile.TemporaryDirectory() as scratch:
+        # Serving: items spread over (emotion, language) contexts as in production
+        matrix = {
+            "users": np.array([f"user{i:08d}" for i in range(args.users)]),
+            "items": pd.DataFrame({"artist": [f"artist {i}" for i in range(args.items)],
+                                   "language": [languages[i % len(languages)] for i in range(args.items)],
+                                   "emotion": [emotions[(i // len(languages)) % len(emotions)]
+                                               for i in range(args.items)],
+                                   "display": [f"Artist {i}" for i in range(args.items)]}),
+            "item_codes": item_codes[train_mask], "clicks": clicks[train_mask].astype(np.float32)
+        }
+        save_model(matrix, X, Y, scratch)
+        started = time.perf_counter()
+        model = CFModel(scratch)
+        print(f"Model mapped in {(time.perf_counter() - started) * 1000:.1f} ms")
+        names = matrix["users"][rng.integers(0, args.users, args.queries)].tolist()
+        contexts = [(emotions[i % len(emotions)], languages[i % len(languages)]) for i in range(args.queries)]
+        for label, queried in (("known users", names), ("unknown users", [f"new{i}" for i in range(args.queries)])):
+            started = time.perf_counter()
+            for username, (emotion, language) in zip(queried, contexts):
+                model.recommend_artists(username, emotion, language, limit=10)
+            elapsed = (time.perf_counter() - started) / args.queries
+            print(f"{label:<16}{elapsed * 1e6:>9.1f} us/request")
+    return 0
+
+
+def show_transitions(args):
+    """Print emotion transition probabilities for one user or all users"""
+    from datetime import datetime, timedelta
+    from database import db_manager, get_emotion_transitions
+    from transitions import transition_probabilities
+    
+    if not db_manager.is_available():
+        print("MongoDB is not reachable")
+        return 1
+    
+    start = datetime.utcnow() - timedelta(days=args.days) if args.days else None
+    transitions = get_emotion_transitions(args.username, start)
+    if not transitions:
+        return 1
+    print(f"Transitions ({args.username or 'all users'}): {sum(map(sum, transitions['counts']))}")
+    print(transition_probabilities(transitions['counts']).round(2).to_string())
+    return 0
+
+
+def check_storage(args):
+    """Run the storage conformance suite against one backend, on scratch storage"""
+    import os
+    from storage.conformance import CHECKS, run_conformance, scratch_storage
+    
+    if args.backend == "mongo" and args.database == os.getenv("MONGODB_DATABASE", "enhanced_music_app"):
+        print(f"Refusing to run the checks against the app database {args.database}")
+        return 1
+    try:
+        with scratch_storage(args.backend, args.database) as storage:
+            failures = run_conformance(storage)
+    except Exception as e:
+        print(f"Could not set up scratch {args.backend} storage: {e}")
+        return 1
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"{args.backend}: {len(CHECKS) - len(failures)}/{len(CHECKS)} checks passed")
+    return 1 if failures else 0
+
+
+def bench_history_layout(args):
+    """Compare emotion_history layouts on a scratch database"""
+    import os
+    import random
+    from datetime import datetime, timedelta
+    
+    import pymongo
+    from bson import ObjectId
+    
+    from history_layout import LAYOUTS
+    
+    client = pymongo.MongoClient(os.getenv("MONGODB_URI", "mongodb://localhost:27017/"),
+                                 serverSelectionTimeoutMS=2000)
+    db = client[args.database]
+    emotions = ['angry', 'disgust', 'fear', 'happy', 'neutral', 'sad', 'surprise']
+    start = datetime.utcnow() - timedelta(days=30)
+    # Each user detects at ~1 Hz, so documents of one user arrive in time order
+    docs = [{
+        "username": f"bench_{i % args.users}",
+        "emotion": random.choice(emotions),
+        "timestamp": start + timedelta(seconds=i // args.users),
+        "language": "English",
+        "singer": "Arijit Singh"
+    } for i in range(args.docs)]
+    
+    print(f"{'layout':<12}{'inserts/s':>12}{'storage MiB':>14}{'index MiB':>12}{'read ms':>10}")
+    for name in args.layouts:
+        db.drop_collection('emotion_history')
+        layout = LAYOUTS[name]().setup(db)
+        collection = db['emotion_history']
+        
+        started = time.perf_counter()
+        for i in range(0, len(docs), args.batch_size):
+            batch = [dict(doc, _id=ObjectId()) for doc in docs[i:i + args.batch_size]]
+            layout.insert_documents(collection, batch)
+        rate = len(docs) / (time.perf_counter() - started)
+        
+        started = time.perf_counter()
+        list(layout.find(collection, {"username": "bench_0"}, sort=[("timestamp", -1)], limit=1000))
+        read_ms = (time.perf_counter() - started) * 1000
+        
+        stats = db.command('collStats', 'emotion_history')
+        label = name if layout.name == name else f"{name}->{layout.name}"
+        print(f"{label:<12}{rate:>12,.0f}{stats.get('storageSize', 0) / 2**20:>14.2f}"
+              f"{stats.get('totalIndexSize', 0) / 2**20:>12.2f}{read_ms:>10.1f}")
+    
+    db.drop_collection('emotion_history')
+    return 0
+
+
+def bench_analytics(args):
+    """Time the analytics kernels against the pandas groupby/resample path"""
+    import numpy as np
+    import pandas as pd
+    
+    from analytics import AnalyticsArrays
+    
+    rng = np.random.default_rng(0)
+    emotions = np.array(['angry', 'disgust', 'fear', 'happy', 'neutral', 'sad', 'surprise'], dtype=object)
+    languages = np.array(['Hindi', 'English', 'Punjabi', 'Tamil', 'Telugu', ''], dtype=object)
+    singers = np.array([f"Singer {i}" for i in range(500)], dtype=object)
+    start = np.datetime64('2022-01-01T00:00:00', 'ms').astype(np.int64)
+    timestamps = np.sort(start + rng.integers(0, 3 * 365 * 86400 * 1000, args.events)).astype('datetime64[ms]')
+    objects = pd.DataFrame({
+        'timestamp': timestamps,
+        'emotion': emotions[rng.integers(0, len(emotions), args.events)],
+        'language': languages[rng.integers(0, len(languages), args.events)],
+        'singer': singers[rng.integers(0, len(singers), args.events)]
+    })
+    categorical = objects.astype({field: 'category' for field in ('emotion', 'language', 'singer')})
+    
+    def pandas_path(df):
+        df = df.copy()
+        df['emotion'].value_counts()
+        df.set_index('timestamp').resample('D').size()
+        df['hour'] = df['timestamp'].dt.hour
+        df.groupby(['hour', 'emotion']).size()
+        df['weekday'] = df['timestamp'].dt.day_name()
+        df.groupby(['weekday', 'emotion']).size()
+        df['language'].value_counts().head(10)
+        df['singer'].value_counts().head(10)
+    
+    def kernels(df):
+        arrays = AnalyticsArrays()
+        for i in range(0, len(df), args.chunk_size):
+            arrays.add(df.iloc[i:i + args.chunk_size])
+        return arrays.to_result()
+    
+    print(f"{args.events:,} events")
+    for label, run, df in (("pandas groupby/resample (object columns)", pandas_path, objects),
+                           ("bincount kernels (categorical columns)", kernels, categorical),
+                           ("bincount kernels (object columns)", kernels, objects)):
+        started = time.perf_counter()
+        run(df)
+        print(f"{label:<44}{time.perf_counter() - started:>8.2f}s")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Music app maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    replay = subparsers.add_parser("replay-spool", help="Replay spooled writes into MongoDB")
+    replay.set_defaults(func=replay_spool)
+    
+    reconcile = subparsers.add_parser("reconcile-stats", help="Recompute users.stats from history")
+    reconcile.add_argument("--batch-size", type=int, default=500, help="Users per aggregation batch")
+    reconcile.set_defaults(func=reconcile_stats)
+    
+    archive = subparsers.add_parser("archive-history", help="Move old emotion history to archive files")
+    archive.add_argument("--older-than-days", type=int,
+                         help="Archive whole months older than this many days (default: ARCHIVE_AFTER_DAYS)")
+    archive.set_defaults(func=archive_history)
+    
+    importer = subparsers.add_parser("import-history",
+                                     help="Bulk import history from CSV, JSONL or another MongoDB")
+    importer.add_argument("path", nargs="?", help="CSV or JSONL (.jsonl/.json/.ndjson) file")
+    importer.add_argument("--mongo-uri", help="Import from this MongoDB instead of a file")
+    importer.add_argument("--mongo-database", default="music_app")
+    importer.add_argument("--mongo-collection", default="emotion_history")
+    importer.add_argument("--kind", choices=["emotions", "recommendations"], default="emotions")
+    importer.add_argument("--username", help="Owner of every row (for files without a username column)")
+    importer.add_argument("--emotions", nargs="+", help="Reject rows with any other emotion")
+    importer.add_argument("--batch-size", type=int, default=None, help="Rows per insert batch")
+    importer.add_argument("--workers", type=int, default=None, help="Parallel insert workers")
+    importer.add_argument("--restart", action="store_true", help="Ignore any saved checkpoint")
+    importer.set_defaults(func=import_history)
+    
+    backfill = subparsers.add_parser("backfill", help="Run or resume a registered backfill")
+    backfill.add_argument("name", help="Backfill name (see backfill-status)")
+    backfill.add_argument("--workers", type=int, default=1, help="Worker threads in this process")
+    backfill.add_argument("--parts", type=int, help="_id ranges to split a new backfill into")
+    backfill.add_argument("--batch-size", type=int, help="Documents per bulk_write")
+    backfill.add_argument("--rate", type=float, help="Maximum documents per second for this process")
+    backfill.add_argument("--restart", action="store_true", help="Discard saved progress first")
+    backfill.set_defaults(func=run_backfill)
+    
+    status = subparsers.add_parser("backfill-status", help="Show backfill progress")
+    status.add_argument("name", nargs="?", help="One backfill (default: all registered)")
+    status.set_defaults(func=backfill_status)
+    
+    global_daily = subparsers.add_parser("rebuild-global-daily",
+                                         help="Rebuild the admin dashboard's global daily rollups")
+    global_daily.add_argument("--days", type=int, default=30, help="Days to rebuild, ending at --end")
+    global_daily.add_argument("--start", help="First day to rebuild, YYYY-MM-DD (overrides --days)")
+    global_daily.add_argument("--end", help="Last day to rebuild, YYYY-MM-DD (default: today)")
+    global_daily.set_defaults(func=rebuild_global_daily)
+    
+    catalog = subparsers.add_parser("ingest-catalog", help="Build the local track catalog index")
+    catalog.add_argument("paths", nargs="+", help="CSV or JSONL files of track metadata")
+    catalog.add_argument("--index", help="Index file (default: CATALOG_DIR/index.npz)")
+    catalog.add_argument("--ivf", type=int, metavar="LISTS",
+                         help="Also build an IVF index with this many lists, for large catalogs")
+    catalog.set_defaults(func=ingest_catalog)
+    
+    library = subparsers.add_parser("scan-library",
+                                    help="Index a music directory and extract audio features (only new or changed files)")
+    library.add_argument("directory", nargs="?", help="Music directory (default: LIBRARY_DIR)")
+    library.add_argument("--workers", type=int, help="Decoding processes (default: AUDIO_WORKERS)")
+    library.add_argument("--full", action="store_true", help="Re-analyze the audio of every file")
+    library.set_defaults(func=scan_library)
+    
+    bench_retrieval = subparsers.add_parser("bench-vectors",
+                                            help="Benchmark exact vs IVF track retrieval (recall and latency)")
+    bench_retrieval.add_argument("--synthetic", type=int, metavar="N",
+                                 help="Use N synthetic vectors instead of the catalog's")
+    bench_retrieval.add_argument("--dims", type=int, default=48)
+    bench_retrieval.add_argument("--queries", type=int, default=200)
+    bench_retrieval.add_argument("--k", type=int, default=10)
+    bench_retrieval.add_argument("--lists", type=int, default=1024)
+    bench_retrieval.add_argument("--probes", type=int, nargs="+", default=[1, 4, 16, 64])
+    bench_retrieval.set_defaults(func=bench_vectors)
+
+    cf = subparsers.add_parser("train-cf", help="Train the collaborative filtering model from recommendation clicks")
+    cf.add_argument("--directory", help="Model directory (default: CF_DIR)")
+    cf.add_argument("--factors", type=int, help="Factors per user and item (default: CF_FACTORS)")
+    cf.add_argument("--iterations", type=int, help="ALS iterations (default: CF_ITERATIONS)")
+    cf.add_argument("--workers", type=int, help="Solver threads (default: CF_WORKERS)")
+    cf.set_defaults(func=train_cf)
+
+    bench_collaborative = subparsers.add_parser("bench-cf",
+                                                help="Benchmark collaborative filtering training and serving")
+    bench_collaborative.add_argument("--clicks", type=int, default=10_000_000)
+    bench_collaborative.add_argument("--users", type=int, default=200_000)
+    bench_collaborative.add_argument("--items", type=int, default=50_000)
+    bench_collaborative.add_argument("--groups", type=int, default=50, help="Synthetic taste groups")
+    bench_collaborative.add_argument("--factors", type=int)
+    bench_collaborative.add_argument("--iterations", type=int)
+    bench_collaborative.add_argument("--workers", type=int)
+    bench_collaborative.add_argument("--queries", type=int, default=1000)
+    bench_collaborative.set_defaults(func=bench_cf)
+    
+    transitions = subparsers.add_parser("transitions", help="Show emotion transition probabilities")
+    transitions.add_argument("--username", help="One user (default: all users)")
+    transitions.add_argument("--days", type=int, help="Only the last N days")
+    transitions.set_defaults(func=show_transitions)
+    
+    conformance = subparsers.add_parser("check-storage", help="Run the storage backend conformance checks")
+    conformance.add_argument("--backend", choices=["mongo", "sqlite", "memory"], default="memory")
+    conformance.add_argument("--database", default="enhanced_music_app_conformance",
+                             help="Scratch MongoDB database for --backend mongo (dropped afterwards)")
+    conformance.set_defaults(func=check_storage)
+    
+    bench = subparsers.add_parser("bench-history-layout",
+                                  help="Benchmark emotion_history layouts on a scratch database")
+    bench.add_argument("--database", default="enhanced_music_app_bench",
+                       help="Scratch database (its emotion_history is dropped)")
+    bench.add_argument("--docs", type=int, default=200000)
+    bench.add_argument("--users", type=int, default=50)
+    bench.add_argument("--batch-size", type=int, default=1000)
+    bench.add_argument("--layouts", nargs="+", choices=["plain", "timeseries", "buckets"],
+                       default=["plain", "timeseries", "buckets"])
+    bench.set_defaults(func=bench_history_layout)
+    
+    bench_kernels = subparsers.add_parser("bench-analytics",
+                                          help="Benchmark the analytics kernels on synthetic events")
+    bench_kernels.add_argument("--events", type=int, default=10_000_000)
+    bench_kernels.add_argument("--chunk-size", type=int, default=1_000_000,
+                               help="Events per AnalyticsArrays.add call")
+    bench_kernels.set_defaults(func=bench_analytics)
+    
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
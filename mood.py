@@ -0,0 +1,144 @@
+"""Online mood-anomaly detection over the emotion event stream
+
+Each user has one MoodState, updated in O(1) per detection and of fixed
+size: exponentially decayed emotion counts, the open session, the run of
+consecutive negative sessions and a per-hour-of-day baseline of the
+negative share. Sessions are split by gaps longer than
+MOOD_SESSION_GAP_MINUTES and judged when they close, i.e. when the next
+session starts.
+"""
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from transitions import TRANSITION_EMOTIONS
+
+MOOD_NEGATIVE_EMOTIONS = set(os.getenv("MOOD_NEGATIVE_EMOTIONS", "sad,fear").split(","))
+# Half-life of the decayed emotion counts
+MOOD_HALF_LIFE_HOURS = float(os.getenv("MOOD_HALF_LIFE_HOURS", "72"))
+MOOD_SESSION_GAP_MINUTES = float(os.getenv("MOOD_SESSION_GAP_MINUTES", "30"))
+# Shorter sessions neither extend nor break a run, nor move the baseline
+MOOD_MIN_SESSION_DETECTIONS = int(os.getenv("MOOD_MIN_SESSION_DETECTIONS", "5"))
+# A session at least this negative extends the run
+MOOD_NEGATIVE_SHARE = float(os.getenv("MOOD_NEGATIVE_SHARE", "0.6"))
+MOOD_SESSION_RUN = int(os.getenv("MOOD_SESSION_RUN", "3"))
+# Weight of one session in its hour-of-day baseline, and sessions needed before it is trusted
+MOOD_BASELINE_ALPHA = float(os.getenv("MOOD_BASELINE_ALPHA", "0.1"))
+MOOD_BASELINE_MIN_SESSIONS = int(os.getenv("MOOD_BASELINE_MIN_SESSIONS", "5"))
+# Alert when a session's negative share exceeds its hour's baseline by this much
+MOOD_BASELINE_DEVIATION = float(os.getenv("MOOD_BASELINE_DEVIATION", "0.4"))
+MOOD_ALERT_COOLDOWN_HOURS = float(os.getenv("MOOD_ALERT_COOLDOWN_HOURS", "24"))
+
+# Decayed counts slots: TRANSITION_EMOTIONS, then everything else
+MOOD_EMOTIONS = TRANSITION_EMOTIONS + ['other']
+_SLOTS = {emotion: i for i, emotion in enumerate(TRANSITION_EMOTIONS)}
+
+class MoodState:
+    def __init__(self):
+        self.updated_at: Optional[datetime] = None
+        self.counts = [0.0] * len(MOOD_EMOTIONS)
+        # Open session: start, last, detections, negative detections
+        self.session: Optional[Dict] = None
+        self.run = 0
+        self.baseline = [0.0] * 24
+        self.baseline_sessions = [0] * 24
+        self.last_alert: Dict[str, datetime] = {}
+
+    def add(self, timestamp: datetime, emotion: str) -> List[Dict]:
+        """Fold one detection in; returns the alerts it raises
+
+        Detections older than the last one folded are ignored.
+        """
+        if self.updated_at is not None and timestamp < self.updated_at:
+            return []
+        if self.updated_at is not None:
+            hours = (timestamp - self.updated_at).total_seconds() / 3600
+            decay = math.exp(-hours * math.log(2) / MOOD_HALF_LIFE_HOURS)
+            self.counts = [n * decay for n in self.counts]
+        self.counts[_SLOTS.get(emotion, len(TRANSITION_EMOTIONS))] += 1
+        self.updated_at = timestamp
+
+        alerts = []
+        session = self.session
+        if session and timestamp - session['last'] > timedelta(minutes=MOOD_SESSION_GAP_MINUTES):
+            alerts = self._close_session()
+            session = None
+        if session is None:
+            session = self.session = {"start": timestamp, "last": timestamp, "detections": 0, "negative": 0}
+        session['last'] = timestamp
+        session['detections'] += 1
+        session['negative'] += emotion in MOOD_NEGATIVE_EMOTIONS
+        return alerts
+
+    def shares(self) -> Dict[str, float]:
+        """Decayed share of each emotion"""
+        total = sum(self.counts)
+        return {emotion: n / total if total else 0.0 for emotion, n in zip(MOOD_EMOTIONS, self.counts)}
+
+    def _close_session(self) -> List[Dict]:
+        session, self.session = self.session, None
+        if session['detections'] < MOOD_MIN_SESSION_DETECTIONS:
+            return []
+        share = session['negative'] / session['detections']
+        hour = session['start'].hour
+        alerts = []
+
+        self.run = self.run + 1 if share >= MOOD_NEGATIVE_SHARE else 0
+        # Every session of a long run qualifies; the cooldown keeps it to one alert a period
+        if self.run >= MOOD_SESSION_RUN:
+            alerts.append(self._alert("negative_run", session, share,
+                                      f"Mostly {'/'.join(sorted(MOOD_NEGATIVE_EMOTIONS))} "
+                                      f"for {self.run} sessions in a row"))
+
+        baseline = self.baseline[hour]
+        if self.baseline_sessions[hour] >= MOOD_BASELINE_MIN_SESSIONS and \
+                share - baseline >= MOOD_BASELINE_DEVIATION:
+            alerts.append(self._alert("hour_deviation", session, share,
+                                      f"{share:.0%} negative around {hour}:00, usually {baseline:.0%}"))
+        if self.baseline_sessions[hour] == 0:
+            self.baseline[hour] = share
+        else:
+            self.baseline[hour] += MOOD_BASELINE_ALPHA * (share - baseline)
+        self.baseline_sessions[hour] = min(self.baseline_sessions[hour] + 1, MOOD_BASELINE_MIN_SESSIONS)
+
+        return [alert for alert in alerts if alert is not None]
+
+    def _alert(self, kind: str, session: Dict, share: float, message: str) -> Optional[Dict]:
+        last = self.last_alert.get(kind)
+        if last is not None and session['last'] - last < timedelta(hours=MOOD_ALERT_COOLDOWN_HOURS):
+            return None
+        self.last_alert[kind] = session['last']
+        return {
+            "kind": kind,
+            "message": message,
+            "session_start": session['start'],
+            "session_end": session['last'],
+            "negative_share": share,
+            "run": self.run,
+            "shares": self.shares()
+        }
+
+    def to_document(self) -> Dict:
+        return {
+            "updated_at": self.updated_at,
+            "counts": self.counts,
+            "session": self.session,
+            "run": self.run,
+            "baseline": self.baseline,
+            "baseline_sessions": self.baseline_sessions,
+            "last_alert": self.last_alert
+        }
+
+    @classmethod
+    def from_document(cls, doc: Optional[Dict]) -> "MoodState":
+        state = cls()
+        if doc:
+            state.updated_at = doc.get('updated_at')
+            state.counts = list(doc.get('counts', state.counts))
+            state.session = doc.get('session')
+            state.run = doc.get('run', 0)
+            state.baseline = list(doc.get('baseline', state.baseline))
+            state.baseline_sessions = list(doc.get('baseline_sessions', state.baseline_sessions))
+            state.last_alert = dict(doc.get('last_alert', {}))
+        return state
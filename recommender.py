@@ -0,0 +1,164 @@
+"""Cached recommendation candidates with a per-user rerank
+
+Catalog and vector queries depend only on (emotion, language, artist), so
+their results are shared by every user asking for the same combination.
+RecommendationCache keeps RECOMMEND_CANDIDATES candidates per combination
+in a size-bounded LRU whose entries expire after RECOMMEND_CACHE_TTL or
+as soon as the catalog or vector index version they were computed from
+changes. With
+RECOMMEND_CACHE_SHARED, misses also consult the storage backend's shared
+cache, so a combination is computed once across all workers.
+
+Personalization is a rerank of the cached candidates: similarity to the
+user's own smoothed emotion mix (a 50-row dot product) and a penalty for
+tracks they already opened in the session.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from catalog import normalize
+
+RECOMMEND_CACHE_SIZE = int(os.getenv("RECOMMEND_CACHE_SIZE", "2048"))
+RECOMMEND_CACHE_TTL = float(os.getenv("RECOMMEND_CACHE_TTL", "900"))
+RECOMMEND_CACHE_SHARED = os.getenv("RECOMMEND_CACHE_SHARED", "false").lower() == "true"
+# Candidates cached per combination; the rerank picks the shown tracks from these
+RECOMMEND_CANDIDATES = int(os.getenv("RECOMMEND_CANDIDATES", "50"))
+# Score taken off tracks the user already opened this session
+RECOMMEND_SEEN_PENALTY = float(os.getenv("RECOMMEND_SEEN_PENALTY", "0.3"))
+
+class RecommendationCache:
+    """LRU of candidate lists with a TTL; entries of an older index version are misses"""
+
+    def __init__(self, max_entries: int = RECOMMEND_CACHE_SIZE, ttl: float = RECOMMEND_CACHE_TTL,
+                 shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # StorageBackend whose shared cache backs this one, or None
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(("hits", "misses", "shared_hits", "expired", "evicted", "invalidations"), 0)
+
+    def get_or_compute(self, key: Tuple, version: str, compute: Callable[[], Optional[Any]]) -> Optional[Any]:
+        """Cached value of key for this index version, computing (and caching) it on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                cached_version, stored_at, value = entry
+                if cached_version == version and now - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    self._counts["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._counts["expired" if cached_version == version else "invalidations"] += 1
+            self._counts["misses"] += 1
+
+        shared_key = "|".join(["recommend", version, *map(str, key)])
+        value = self._shared_get(shared_key)
+        if value is not None:
+            with self._lock:
+                self._counts["shared_hits"] += 1
+        else:
+            value = compute()
+            if value is None:
+                return None
+            self._shared_set(shared_key, value)
+
+        with self._lock:
+            self._entries[key] = (version, now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts["evicted"] += 1
+        return value
+
+    def _shared_get(self, key: str) -> Optional[Any]:
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.get_shared_cache(key)
+        except Exception as e:
+            print(f"Error reading shared cache: {e}")
+            return None
+
+    def _shared_set(self, key: str, value: Any):
+        if self.shared is None:
+            return
+        try:
+            self.shared.set_shared_cache(key, value, self.ttl)
+        except Exception as e:
+            print(f"Error writing shared cache: {e}")
+
+    def stats(self) -> Dict:
+        """Hit/miss counters since start; shared hits count as misses of this worker's LRU"""
+        with self._lock:
+            stats = dict(self._counts, entries=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["computed"] = stats["misses"] - stats["shared_hits"]
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+recommendation_cache = RecommendationCache()
+
+def _key(kind: str, emotion: str, language: Optional[str], artist: Optional[str]) -> Tuple:
+    return kind, normalize(emotion or ""), normalize(language or ""), normalize(artist or "")
+
+def mood_candidates(catalog, emotion: str, language: str = None, artist: str = None) -> Dict:
+    """Most popular catalog tracks for the combination (catalog.recommend), as {numbers, applied}"""
+    def compute():
+        tracks, applied = catalog.recommend(emotion, language, artist, limit=RECOMMEND_CANDIDATES)
+        return {"numbers": [track["number"] for track in tracks], "applied": applied}
+
+    return recommendation_cache.get_or_compute(_key("mood", emotion, language, artist), catalog.version, compute)
+
+def similar_candidates(catalog, index, emotion: str, language: str = None, artist: str = None) -> Dict:
+    """Nearest tracks to the emotion and the artist's sound (within the language), as {numbers, scores}"""
+    if not index.matches(catalog):
+        # Vectors of another catalog build: their row numbers are not this catalog's tracks
+        return {"numbers": [], "scores": []}
+
+    def compute():
+        preference = index.preference_vector(catalog.search(artist=artist, limit=20)) if artist else None
+        query = index.query_vector({emotion: 1.0}, preference)
+        candidates = catalog.postings["language"].get(language) if language else None
+        if candidates is not None and len(candidates):
+            numbers, scores = index.search(query, RECOMMEND_CANDIDATES, candidates=candidates)
+        else:
+            numbers, scores = index.search_ivf(query, RECOMMEND_CANDIDATES)
+        return {"numbers": numbers[0].tolist(), "scores": scores[0].astype(float).tolist()}
+
+    return recommendation_cache.get_or_compute(_key("similar", emotion, language, artist),
+                                               f"{catalog.version}/{index.version}", compute)
+
+def rerank(numbers: List[int], scores: List[float] = None, index=None, query: np.ndarray = None,
+           seen: Iterable[int] = (), limit: int = 10) -> List[int]:
+    """The limit best candidates for one user
+
+    Candidates are scored by their cached scores (or rank), averaged with
+    their similarity to the user's query vector when an index and query
+    are given; tracks in seen are pushed down.
+    """
+    numbers = np.asarray(numbers, dtype=np.int64)
+    if not len(numbers):
+        return []
+    if scores is not None:
+        base = np.asarray(scores, dtype=np.float64)
+    else:
+        # Rank order, on the same 0-1 scale as cosine scores
+        base = 1 - np.arange(len(numbers)) / len(numbers)
+    if index is not None and query is not None:
+        base = 0.5 * base + 0.5 * (np.asarray(index.vectors[numbers]) @ query)
+    seen = list(seen)
+    if seen:
+        base = base - RECOMMEND_SEEN_PENALTY * np.isin(numbers, seen)
+    return numbers[np.argsort(-base, kind='stable')[:limit]].tolist()
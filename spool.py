@@ -0,0 +1,244 @@
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import bson
+
+# Segment locks (POSIX); without them only one process may use a spool directory
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+# "always" fsyncs every record, "interval" at most every SPOOL_FSYNC_INTERVAL
+# seconds, "never" leaves it to the OS
+SPOOL_FSYNC = os.getenv("SPOOL_FSYNC", "interval")
+SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", "1.0"))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", "5000"))
+
+# Record header: payload length and CRC32 of the payload
+RECORD_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".seg"
+# Segments are created under this suffix, locked, then renamed, so every .seg file is locked from birth
+CREATING_SUFFIX = ".new"
+
+class EventSpool:
+    """Append-only, segment-rotated local spool for writes MongoDB has not accepted yet
+
+    Each record is a length-prefixed, checksummed BSON document holding the
+    target collection and the document itself. Segments are replayed oldest
+    first and deleted once every record in them has been written.
+
+    Several processes (app workers, manage.py replay-spool) can share a
+    directory: segment names carry the host and pid, the writer holds an
+    exclusive lock on its active segment, and replay only takes segments it
+    can lock, so a segment another process is still writing is left alone.
+    The lock goes away with its process, so a crashed writer's segment is
+    replayed like a sealed one.
+    """
+
+    def __init__(self, directory: str = SPOOL_DIR, segment_bytes: int = SPOOL_SEGMENT_BYTES,
+                 fsync: str = SPOOL_FSYNC, fsync_interval: float = SPOOL_FSYNC_INTERVAL):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown spool fsync policy: {fsync}")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+        self._last_fsync = 0.0
+        self._owner = f"{socket.gethostname()}-{os.getpid()}"
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        """(number, path) of every segment in the directory, oldest first"""
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith("spool-") and name.endswith(SEGMENT_SUFFIX):
+                # spool-<number>-<host>-<pid>.seg, or spool-<number>.seg from older versions
+                number = name[len("spool-"):-len(SEGMENT_SUFFIX)].split("-", 1)[0]
+                if number.isdigit():
+                    segments.append((int(number), os.path.join(self.directory, name)))
+        return sorted(segments)
+
+    def _open_segment(self):
+        """Create and lock a new segment numbered after every existing one"""
+        number = max((n for n, _ in self._segments()), default=0) + 1
+        while True:
+            name = f"spool-{number:08d}-{self._owner}"
+            creating = os.path.join(self.directory, name + CREATING_SUFFIX)
+            try:
+                fd = os.open(creating, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND, 0o644)
+            except FileExistsError:
+                number += 1
+                continue
+            if FCNTL_AVAILABLE:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            path = os.path.join(self.directory, name + SEGMENT_SUFFIX)
+            if os.path.exists(path):
+                # Same host, pid and number left by an earlier process: never append to it
+                os.close(fd)
+                os.remove(creating)
+                number += 1
+                continue
+            os.rename(creating, path)
+            break
+        self._active = os.fdopen(fd, "ab")
+        self._active_path = path
+        self._active_size = 0
+
+    def _seal_active(self):
+        """Close the active segment so it becomes eligible for replay"""
+        if self._active is None:
+            return
+        self._active.flush()
+        if self.fsync != "never":
+            os.fsync(self._active.fileno())
+        self._active.close()
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+
+    def append(self, collection_name: str, doc: Dict):
+        """Durably append one document destined for a collection"""
+        self.append_many(collection_name, [doc])
+
+    def append_many(self, collection_name: str, docs: List[Dict]):
+        """Append several documents with a single flush"""
+        records = []
+        for doc in docs:
+            payload = bson.encode({"c": collection_name, "d": doc})
+            records.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        data = b"".join(records)
+
+        with self._lock:
+            if self._active is None:
+                self._open_segment()
+            self._active.write(data)
+            self._active.flush()
+            self._active_size += len(data)
+
+            now = time.monotonic()
+            if self.fsync == "always" or (
+                self.fsync == "interval" and now - self._last_fsync >= self.fsync_interval
+            ):
+                os.fsync(self._active.fileno())
+                self._last_fsync = now
+
+            if self._active_size >= self.segment_bytes:
+                self._seal_active()
+
+    def _lock_segment(self, path: str) -> Optional[int]:
+        """Descriptor holding the lock of a segment no process is writing; None if it is in use or gone"""
+        if path == self._active_path:
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        if FCNTL_AVAILABLE:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return None
+        # Another replayer may have finished and removed it while we waited for the lock
+        if os.fstat(fd).st_nlink == 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def sealed_segments(self) -> List[str]:
+        """Segments that no process is writing to any more, oldest first"""
+        sealed = []
+        for _, path in self._segments():
+            fd = self._lock_segment(path)
+            if fd is not None:
+                os.close(fd)
+                sealed.append(path)
+        return sealed
+
+    def has_pending(self) -> bool:
+        with self._lock:
+            if self._active_size > 0:
+                return True
+        return bool(self.sealed_segments())
+
+    @staticmethod
+    def read_segment(path: str, fd: int = None) -> Iterator[Tuple[str, Dict]]:
+        """Yield (collection, document) records, stopping at a torn or corrupt tail"""
+        if fd is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            with os.fdopen(os.dup(fd), "rb") as f:
+                f.seek(0)
+                data = f.read()
+
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            payload = data[start:end]
+            if end > len(data) or zlib.crc32(payload) != crc:
+                print(f"Spool segment {path} has a damaged record at byte {offset}, skipping the rest")
+                return
+            record = bson.decode(payload)
+            yield record["c"], record["d"]
+            offset = end
+
+    def replay(self, writer: Callable[[str, List[Dict]], None],
+               batch_size: int = SPOOL_REPLAY_BATCH) -> int:
+        """Feed spooled documents to writer in batches; returns how many were replayed
+
+        writer must be idempotent (documents carry client-generated _ids) and
+        raise if a batch could not be written, which leaves the segment in
+        place for the next attempt.
+        """
+        with self._lock:
+            self._seal_active()
+
+        replayed = 0
+        for _, path in self._segments():
+            # Held until the segment is removed, so no other replayer takes it meanwhile
+            fd = self._lock_segment(path)
+            if fd is None:
+                continue
+            try:
+                batches = {}
+                for collection_name, doc in self.read_segment(path, fd):
+                    batch = batches.setdefault(collection_name, [])
+                    batch.append(doc)
+                    if len(batch) >= batch_size:
+                        writer(collection_name, batch)
+                        replayed += len(batch)
+                        batches[collection_name] = []
+
+                for collection_name, batch in batches.items():
+                    if batch:
+                        writer(collection_name, batch)
+                        replayed += len(batch)
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            finally:
+                os.close(fd)
+
+        return replayed
+
+    def close(self):
+        with self._lock:
+            self._seal_active()
@@ -0,0 +1,38 @@
+"""Storage backends for the music app
+
+STORAGE_BACKEND selects the implementation: "mongo" (default), "sqlite"
+for single-box kiosk deployments, or "memory" for load testing.
+"""
+import os
+import threading
+
+from storage.base import DuplicateUserError, StorageBackend
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo")
+
+_storage = None
+_storage_lock = threading.Lock()
+
+def create_storage(backend: str = STORAGE_BACKEND) -> StorageBackend:
+    """Build a new backend instance by name"""
+    if backend == "mongo":
+        from storage.mongo import MongoStorage
+        return MongoStorage()
+    if backend == "sqlite":
+        from storage.sqlite import SQLiteStorage
+        return SQLiteStorage()
+    if backend == "memory":
+        from storage.memory import MemoryStorage
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+def get_storage() -> StorageBackend:
+    """The process-wide backend selected by STORAGE_BACKEND"""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+__all__ = ["DuplicateUserError", "StorageBackend", "create_storage", "get_storage"]
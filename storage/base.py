@@ -0,0 +1,410 @@
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Bumped when the users.stats layout changes (see database.reconcile_user_stats)
+STATS_COUNTERS_VERSION = 2
+
+WEEKDAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+# Fields every backend keeps for an emotion_history document
+EMOTION_FIELDS = ('username', 'emotion', 'timestamp', 'language', 'singer',
+                  'artist', 'confidence', 'session_id')
+
+# Columns (and their kinds) of the emotion history DataFrame; see frame_from_batches
+HISTORY_FRAME_SCHEMA = {
+    'timestamp': 'datetime',
+    'emotion': 'category',
+    'language': 'category',
+    'singer': 'category'
+}
+
+class DuplicateUserError(Exception):
+    """Raised when creating a user whose username or email is taken"""
+
+class StorageBackend(ABC):
+    """Operations the app needs from its data store
+
+    Implementations: MongoStorage (database.py), SQLiteStorage (embedded,
+    WAL mode) and MemoryStorage (tests and load testing). Every backend must
+    pass storage.conformance.run_conformance().
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self._write_hooks = {}
+
+    def is_available(self) -> bool:
+        return True
+
+    # Write hooks
+    def add_write_hook(self, collection_name: str, hook: Callable[[List[Dict]], None]):
+        """Call hook with each batch of documents once they are stored"""
+        self._write_hooks.setdefault(collection_name, []).append(hook)
+
+    def _notify_written(self, collection_name: str, docs: List[Dict]):
+        for hook in self._write_hooks.get(collection_name, []):
+            try:
+                hook(docs)
+            except Exception as e:
+                print(f"Error in write hook for {collection_name}: {e}")
+
+    # Users
+    @abstractmethod
+    def get_user(self, username: str) -> Optional[Dict]:
+        """Get a user document by username"""
+
+    @abstractmethod
+    def find_user(self, identifier: str) -> Optional[Dict]:
+        """Get a user document by username or email"""
+
+    @abstractmethod
+    def find_user_by_email(self, email: str) -> Optional[Dict]:
+        """Get a user document by email"""
+
+    @abstractmethod
+    def create_user(self, user_doc: Dict) -> bool:
+        """Insert a new user; raises DuplicateUserError if username or email exists"""
+
+    @abstractmethod
+    def update_user(self, username: str, fields: Dict) -> bool:
+        """Set (dotted) fields on a user document"""
+
+    @abstractmethod
+    def record_login(self, username: str) -> bool:
+        """Bump stats.total_sessions, set last_login and count today as active"""
+
+    # Emotion history
+    @abstractmethod
+    def save_emotion(self, doc: Dict, defer: bool = False) -> bool:
+        """Store one emotion detection; defer allows batching it in the background"""
+
+    @abstractmethod
+    def iter_emotion_history(self, username: str, start_date: datetime = None,
+                             end_date: datetime = None,
+                             emotion_filter: List[str] = None,
+                             newest_first: bool = True) -> Iterable[Dict]:
+        """Stream matching history documents in timestamp order"""
+
+    def get_emotion_history(self, username: str, start_date: datetime = None,
+                            end_date: datetime = None,
+                            emotion_filter: List[str] = None,
+                            limit: int = 1000) -> List[Dict]:
+        """Most recent matching history documents, newest first"""
+        history = []
+        for doc in self.iter_emotion_history(username, start_date, end_date, emotion_filter):
+            history.append(doc)
+            if len(history) >= limit:
+                break
+        return history
+
+    def get_emotion_statistics(self, username: str, days: int = 30) -> Dict:
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=days)
+        counts, confidence = {}, {}
+        for doc in self.iter_emotion_history(username, start_date, end_date):
+            emotion = doc.get('emotion')
+            counts[emotion] = counts.get(emotion, 0) + 1
+            confidence[emotion] = confidence.get(emotion, 0.0) + (doc.get('confidence') or 0.0)
+        ranked = sorted(counts, key=counts.get, reverse=True)
+        return {
+            "emotion_counts": {e: counts[e] for e in ranked},
+            "confidence_scores": {e: confidence[e] / counts[e] for e in ranked},
+            "total_detections": sum(counts.values()),
+            "unique_emotions": len(counts),
+            "most_common_emotion": ranked[0] if ranked else None,
+            "period_days": days
+        }
+
+    def get_emotion_analytics(self, username: str, start_date: datetime = None,
+                              end_date: datetime = None,
+                              emotion_filter: List[str] = None,
+                              include_archive: bool = False) -> Dict:
+        """Same result shape as database.get_emotion_analytics"""
+        from analytics import AnalyticsArrays
+
+        arrays = AnalyticsArrays()
+        for frame in self.iter_emotion_frames(username, start_date, end_date, emotion_filter,
+                                              include_archive=include_archive):
+            arrays.add(frame)
+        return arrays.to_result()
+
+    def get_emotion_transitions(self, username: Optional[str], start_date: datetime = None,
+                                end_date: datetime = None) -> Dict:
+        """Same result shape as database.get_emotion_transitions, counted from one user's history
+
+        username None (all users) needs the global rollups only the MongoDB
+        backend keeps. Backends that count transitions as detections arrive
+        skip detections older than the user's open span, so their counts can
+        be approximate.
+        """
+        from transitions import frame_transitions
+
+        if username is None:
+            raise NotImplementedError(f"{type(self).__name__} keeps no global transition counts; "
+                                      "pass a username")
+        return frame_transitions(self.iter_emotion_frames(username, start_date, end_date,
+                                                          include_archive=True))
+
+    def get_global_analytics(self, start_date: datetime = None, end_date: datetime = None) -> Dict:
+        """Admin breakdowns across all users (database.get_global_analytics); {} without global rollups"""
+        return {}
+
+    def get_mood_alerts(self, username: str, include_acknowledged: bool = False,
+                        limit: int = 20) -> List[Dict]:
+        """Mood alerts raised for the user, newest first; [] without a mood detector"""
+        return []
+
+    def acknowledge_mood_alerts(self, username: str) -> int:
+        return 0
+
+    def get_shared_cache(self, key: str) -> Optional[Any]:
+        """A value set by any worker with set_shared_cache, until it expires; None without a shared cache"""
+        return None
+
+    def set_shared_cache(self, key: str, value: Any, ttl: float) -> bool:
+        """Store a JSON-compatible value for ttl seconds; False if the backend has no shared cache"""
+        return False
+
+    def get_emotion_page(self, username: str, before: Tuple[datetime, Any] = None,
+                         page_size: int = 20, emotion_filter: List[str] = None,
+                         language_filter: List[str] = None,
+                         include_archive: bool = False) -> Tuple[List[Dict], Optional[Tuple]]:
+        """One page of history, newest first, strictly older than the before cursor
+
+        before is a (timestamp, _id) cursor returned by the previous page, or
+        (timestamp, None) to start just before a point in time. Returns the
+        page and the cursor for the next (older) page, None on the last page.
+        """
+        end_date, last_id = before if before else (None, None)
+        languages = set(language_filter) if language_filter else None
+        page = []
+        for doc in self.iter_emotion_history(username, end_date=end_date, emotion_filter=emotion_filter):
+            if end_date is not None and doc['timestamp'] == end_date and \
+                    (last_id is None or doc['_id'] >= last_id):
+                continue
+            if languages is not None and doc.get('language') not in languages:
+                continue
+            if len(page) == page_size:
+                return page, page_cursor(page)
+            page.append(doc)
+        return page, None
+
+    def get_emotion_frame(self, username: str, start_date: datetime = None,
+                          end_date: datetime = None,
+                          emotion_filter: List[str] = None,
+                          limit: int = 1000) -> pd.DataFrame:
+        """History as a typed DataFrame (HISTORY_FRAME_SCHEMA columns), newest first"""
+        docs = self.get_emotion_history(username, start_date, end_date, emotion_filter, limit)
+        return frame_from_batches([docs], HISTORY_FRAME_SCHEMA)
+
+    def iter_emotion_frames(self, username: str, start_date: datetime = None,
+                            end_date: datetime = None,
+                            emotion_filter: List[str] = None,
+                            batch_size: int = 5000,
+                            include_archive: bool = False) -> Iterable[pd.DataFrame]:
+        """Complete matching history as DataFrame chunks, oldest first
+
+        include_archive also reads history moved out by the retention job;
+        backends without an archive ignore it.
+        """
+        batch = []
+        for doc in self.iter_emotion_history(username, start_date, end_date, emotion_filter,
+                                             newest_first=False):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield frame_from_batches([batch], HISTORY_FRAME_SCHEMA)
+                batch = []
+        if batch:
+            yield frame_from_batches([batch], HISTORY_FRAME_SCHEMA)
+
+    @abstractmethod
+    def get_user_quick_stats(self, username: str) -> Dict:
+        """total_detections, emotions, unique_emotions, first/last_session, last_emotion"""
+
+    def get_history_revision(self, username: str) -> Any:
+        """A value that changes whenever the user's emotion history does, for keying derived caches
+
+        Backends without archiving, backfills or cached stats can derive it
+        from the quick stats, which they read fresh.
+        """
+        stats = self.get_user_quick_stats(username)
+        return stats.get('total_detections'), stats.get('last_session')
+
+    # Music recommendations and games
+    @abstractmethod
+    def save_music_recommendation(self, username: str, platform: str, query: str,
+                                  emotion: str, language: str = "", artist: str = "") -> bool:
+        """Record a click on a music platform"""
+
+    @abstractmethod
+    def track_game_play(self, username: str, game_name: str, game_url: str = "",
+                        play_duration: int = 0) -> bool:
+        """Record a game launch and bump stats.games_played"""
+
+    @abstractmethod
+    def get_games_history(self, username: str, limit: int = 100) -> List[Dict]:
+        """Most recent game plays, newest first"""
+
+    # Preferences and sessions
+    @abstractmethod
+    def get_preferences(self, username: str) -> Optional[Dict]:
+        """Get the user_preferences document"""
+
+    @abstractmethod
+    def save_preferences(self, username: str, preferences: Dict) -> bool:
+        """Upsert fields of the user_preferences document"""
+
+    @abstractmethod
+    def start_session(self, username: str, email: str = "") -> bool:
+        """Record a login session (expires after 24 hours)"""
+
+    @abstractmethod
+    def count_active_sessions(self, username: str) -> int:
+        """Sessions started in the last 24 hours"""
+
+def new_user_doc(username: str, email: str, phone: str = "", password=b"",
+                 login_method: str = "email", email_verified: bool = False,
+                 logged_in: bool = False) -> Dict:
+    """User document in the layout every backend stores"""
+    now = datetime.utcnow()
+    return {
+        "username": username,
+        "email": email,
+        "phone": phone,
+        "password": password,
+        "created_at": now,
+        "last_login": now if logged_in else None,
+        "login_method": login_method,
+        "email_verified": email_verified,
+        "profile": {
+            "preferred_language": "",
+            "preferred_artist": "",
+            "spotify_connected": False,
+            "youtube_music_connected": False,
+            "email_notifications": True,
+            "emotion_alerts": False
+        },
+        "stats": {
+            "total_sessions": 1 if logged_in else 0,
+            "total_emotions": 0,
+            "games_played": 0,
+            "days_active": 1 if logged_in else 0,
+            "emotions": [],
+            "active_days": [now.strftime('%Y-%m-%d')] if logged_in else [],
+            "login_days": [now.strftime('%Y-%m-%d')] if logged_in else [],
+            "last_active_day": now.strftime('%Y-%m-%d') if logged_in else None,
+            "counters_version": STATS_COUNTERS_VERSION
+        }
+    }
+
+def empty_quick_stats() -> Dict:
+    return {
+        "total_detections": 0,
+        "emotions": [],
+        "unique_emotions": 0,
+        "first_session": None,
+        "last_session": None,
+        "last_emotion": None
+    }
+
+def apply_emotion_to_stats(stats: Dict, doc: Dict):
+    """Fold one stored detection into a users.stats dict (embedded backends)"""
+    timestamp = doc['timestamp']
+    stats['total_emotions'] = stats.get('total_emotions', 0) + 1
+    emotions = stats.setdefault('emotions', [])
+    if doc.get('emotion') not in emotions:
+        emotions.append(doc.get('emotion'))
+        emotions.sort(key=str)
+    if stats.get('first_emotion_at') is None or timestamp < stats['first_emotion_at']:
+        stats['first_emotion_at'] = timestamp
+    if stats.get('last_emotion_at') is None or timestamp >= stats['last_emotion_at']:
+        stats['last_emotion_at'] = timestamp
+        stats['last_emotion'] = doc.get('emotion')
+    apply_active_day(stats, timestamp.strftime('%Y-%m-%d'))
+
+def apply_active_day(stats: Dict, day: str):
+    """Count day towards stats.days_active once, in whatever order days arrive"""
+    days = stats.setdefault('active_days', [])
+    if day not in days:
+        days.append(day)
+        days.sort()
+    stats['days_active'] = len(days)
+    stats['last_active_day'] = days[-1]
+
+def apply_login_day(stats: Dict, day: str):
+    """Count a login day as active; login days are kept since logins have no history"""
+    logins = stats.setdefault('login_days', [])
+    if day not in logins:
+        logins.append(day)
+        logins.sort()
+    apply_active_day(stats, day)
+
+def quick_stats_from_user(user: Optional[Dict]) -> Dict:
+    stats = (user or {}).get('stats') or {}
+    quick = empty_quick_stats()
+    quick.update({
+        "total_detections": stats.get('total_emotions', 0),
+        "emotions": sorted(stats.get('emotions', []), key=str),
+        "unique_emotions": len(stats.get('emotions', [])),
+        "first_session": stats.get('first_emotion_at'),
+        "last_session": stats.get('last_emotion_at'),
+        "last_emotion": stats.get('last_emotion')
+    })
+    return quick
+
+def set_path(doc: Dict, dotted: str, value):
+    """Assign doc['a']['b'] for 'a.b', creating intermediate dicts"""
+    parts = dotted.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+def page_cursor(page: List[Dict]) -> Optional[Tuple]:
+    """Keyset cursor just past the last document of a page"""
+    return (page[-1]['timestamp'], page[-1]['_id']) if page else None
+
+def frame_from_batches(batches: Iterable[List[Dict]], schema: Dict[str, str]) -> pd.DataFrame:
+    """Build a DataFrame column by column from batches of documents
+
+    schema maps field name to 'datetime', 'category', 'str', 'float' or 'int'.
+    Each batch is reduced to NumPy arrays as soon as it arrives, so the
+    documents themselves never outlive their batch.
+    """
+    chunks = {field: [] for field in schema}
+    categories = {field: {} for field, kind in schema.items() if kind == 'category'}
+    for docs in batches:
+        if not docs:
+            continue
+        for field, kind in schema.items():
+            values = [doc.get(field) for doc in docs]
+            if kind == 'datetime':
+                chunk = pd.to_datetime(values).values.astype('datetime64[ms]')
+            elif kind == 'category':
+                # Codes against a growing category table; None maps to -1 (NaN)
+                codes = categories[field]
+                chunk = np.fromiter(
+                    (-1 if v is None else codes.setdefault(v, len(codes)) for v in values),
+                    dtype=np.int32, count=len(values)
+                )
+            elif kind == 'float':
+                chunk = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+            elif kind == 'int':
+                chunk = np.array([0 if v is None else v for v in values], dtype=np.int64)
+            else:
+                chunk = np.array(values, dtype=object)
+            chunks[field].append(chunk)
+
+    empty = {'datetime': 'datetime64[ms]', 'category': np.int32, 'float': np.float64,
+             'int': np.int64, 'str': object}
+    columns = {}
+    for field, kind in schema.items():
+        values = np.concatenate(chunks[field]) if chunks[field] else np.array([], dtype=empty[kind])
+        if kind == 'category':
+            values = pd.Categorical.from_codes(values, categories=list(categories[field]))
+        columns[field] = values
+    return pd.DataFrame(columns)
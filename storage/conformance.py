@@ -0,0 +1,307 @@
+"""Behavioural checks every storage backend must pass
+
+Run with: python manage.py check-storage --backend sqlite
+The checks write users and history that are never removed, so they run
+against scratch_storage: a temporary SQLite file, or a scratch MongoDB
+database (CONFORMANCE_MONGODB_DATABASE) that is dropped afterwards.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List
+
+from storage.base import DuplicateUserError, StorageBackend, new_user_doc
+
+CONFORMANCE_MONGODB_DATABASE = os.getenv("CONFORMANCE_MONGODB_DATABASE", "enhanced_music_app_conformance")
+
+CHECKS = []
+
+def check(func: Callable[[StorageBackend], None]):
+    CHECKS.append(func)
+    return func
+
+def _user(storage: StorageBackend) -> str:
+    username = f"conformance_{uuid.uuid4().hex[:12]}"
+    storage.create_user(new_user_doc(username, f"{username}@example.com", password=b"hash"))
+    return username
+
+def _base_time() -> datetime:
+    # Millisecond precision, which is all MongoDB keeps
+    return (datetime.utcnow() - timedelta(days=3)).replace(microsecond=0)
+
+@check
+def users_roundtrip(storage):
+    username = _user(storage)
+    user = storage.get_user(username)
+    assert user and user['username'] == username, "get_user did not return the new user"
+    assert user['password'] == b"hash", "password bytes were not preserved"
+    assert storage.find_user(f"{username}@example.com")['username'] == username, "find_user by email failed"
+    assert storage.find_user_by_email(f"{username}@example.com")['username'] == username
+    assert storage.get_user("missing_" + username) is None
+
+    try:
+        storage.create_user(new_user_doc(username, f"other_{username}@example.com"))
+    except DuplicateUserError:
+        pass
+    else:
+        raise AssertionError("duplicate username was accepted")
+
+    assert storage.update_user(username, {"phone": "+15550000", "profile.preferred_language": "Hindi"})
+    user = storage.get_user(username)
+    assert user['phone'] == "+15550000"
+    assert user['profile']['preferred_language'] == "Hindi", "dotted update_user field not applied"
+    assert user['profile']['emotion_alerts'] is False, "dotted update clobbered sibling fields"
+
+@check
+def login_counters(storage):
+    username = _user(storage)
+    assert storage.record_login(username)
+    assert storage.record_login(username)
+    stats = storage.get_user(username)['stats']
+    assert stats['total_sessions'] == 2, f"total_sessions is {stats['total_sessions']}"
+    assert stats['days_active'] == 1, "two logins on one day counted as two active days"
+
+@check
+def emotion_history_order_and_filters(storage):
+    username = _user(storage)
+    base = _base_time()
+    emotions = ['happy', 'sad', 'happy', 'neutral']
+    for i, emotion in enumerate(emotions):
+        assert storage.save_emotion({
+            "username": username, "emotion": emotion, "language": "English",
+            "singer": "Artist", "timestamp": base + timedelta(hours=i)
+        })
+
+    history = storage.get_emotion_history(username)
+    assert [doc['emotion'] for doc in history] == list(reversed(emotions)), "history is not newest first"
+    assert all(isinstance(doc['_id'], str) for doc in history), "_id should be a string"
+    assert len(storage.get_emotion_history(username, limit=2)) == 2
+
+    happy = storage.get_emotion_history(username, emotion_filter=['happy'])
+    assert len(happy) == 2, "emotion filter mismatch"
+    ranged = storage.get_emotion_history(username, start_date=base + timedelta(hours=1),
+                                         end_date=base + timedelta(hours=2))
+    assert [doc['emotion'] for doc in ranged] == ['happy', 'sad'], "date range filter mismatch"
+
+    oldest_first = list(storage.iter_emotion_history(username, newest_first=False))
+    assert [doc['emotion'] for doc in oldest_first] == emotions
+
+@check
+def history_frame_types(storage):
+    username = _user(storage)
+    base = _base_time()
+    for i, emotion in enumerate(['happy', 'sad', 'happy']):
+        storage.save_emotion({"username": username, "emotion": emotion, "language": "English",
+                              "timestamp": base + timedelta(minutes=i)})
+    frame = storage.get_emotion_frame(username)
+    assert list(frame.columns) == ['timestamp', 'emotion', 'language', 'singer']
+    assert str(frame['timestamp'].dtype) == 'datetime64[ms]', f"timestamp dtype is {frame['timestamp'].dtype}"
+    assert frame['emotion'].dtype == 'category'
+    assert list(frame['emotion']) == ['happy', 'sad', 'happy'][::-1], "frame is not newest first"
+    assert frame['timestamp'].iloc[0] == base + timedelta(minutes=2)
+    assert frame['singer'].isna().all(), "missing fields should be NaN"
+    assert storage.get_emotion_frame("missing_" + username).empty
+
+@check
+def keyset_pagination(storage):
+    username = _user(storage)
+    base = _base_time()
+    # Pairs of documents share a timestamp, so pages must break ties on _id
+    for i in range(9):
+        storage.save_emotion({"username": username, "emotion": ['happy', 'sad', 'fear'][i % 3],
+                              "language": "Hindi" if i % 2 else "English",
+                              "timestamp": base + timedelta(minutes=i // 2)})
+    expected = storage.get_emotion_history(username)
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = storage.get_emotion_page(username, before=cursor, page_size=2)
+        assert len(page) <= 2
+        seen.extend(page)
+        if cursor is None:
+            break
+    assert [d['_id'] for d in seen] == [d['_id'] for d in expected], "pages skipped or repeated documents"
+
+    page, cursor = storage.get_emotion_page(username, page_size=20, emotion_filter=['fear'],
+                                            language_filter=['Hindi'])
+    assert [(d['emotion'], d['language']) for d in page] == [('fear', 'Hindi')] and cursor is None
+
+    page, _ = storage.get_emotion_page(username, before=(base + timedelta(minutes=1), None), page_size=20)
+    assert [d['timestamp'] for d in page] == [base, base], "jump-to-date cursor mismatch"
+
+@check
+def emotion_writes_are_idempotent(storage):
+    username = _user(storage)
+    doc_id = uuid.uuid4().hex[:24]
+    doc = {"_id": doc_id, "username": username, "emotion": "fear", "timestamp": _base_time()}
+    storage.save_emotion(dict(doc))
+    storage.save_emotion(dict(doc))
+    assert len(storage.get_emotion_history(username)) == 1, "replaying the same _id stored it twice"
+    assert storage.get_user(username)['stats']['total_emotions'] == 1
+
+@check
+def quick_stats_and_counters(storage):
+    username = _user(storage)
+    base = _base_time()
+    for i, emotion in enumerate(['sad', 'happy', 'sad']):
+        storage.save_emotion({"username": username, "emotion": emotion,
+                              "timestamp": base + timedelta(days=i)})
+    stats = storage.get_user_quick_stats(username)
+    assert stats['total_detections'] == 3, f"total_detections is {stats['total_detections']}"
+    assert stats['emotions'] == ['happy', 'sad']
+    assert stats['unique_emotions'] == 2
+    assert stats['first_session'] == base
+    assert stats['last_session'] == base + timedelta(days=2)
+    assert stats['last_emotion'] == 'sad'
+    assert storage.get_user(username)['stats']['days_active'] == 3
+
+@check
+def out_of_order_active_days(storage):
+    username = _user(storage)
+    base = _base_time()
+    for days in (2, 0, 1, 0):
+        storage.save_emotion({"username": username, "emotion": "happy",
+                              "timestamp": base + timedelta(days=days)})
+    stats = storage.get_user(username)['stats']
+    assert stats['days_active'] == 3, f"days_active is {stats['days_active']}"
+    assert stats['last_active_day'] == (base + timedelta(days=2)).strftime('%Y-%m-%d')
+
+@check
+def history_revision_changes_with_writes(storage):
+    username = _user(storage)
+    before = storage.get_history_revision(username)
+    storage.save_emotion({"username": username, "emotion": "happy", "timestamp": _base_time()})
+    after = storage.get_history_revision(username)
+    assert after != before, "history revision did not change after a write"
+    assert storage.get_history_revision(username) == after, "history revision changed without a write"
+
+@check
+def analytics_shape(storage):
+    username = _user(storage)
+    # 2024-01-07 was a Sunday
+    base = datetime(2024, 1, 7, 9, 30)
+    for i, emotion in enumerate(['happy', 'happy', 'sad']):
+        storage.save_emotion({"username": username, "emotion": emotion, "language": "English",
+                              "singer": "A", "timestamp": base + timedelta(days=i)})
+    analytics = storage.get_emotion_analytics(username)
+    assert analytics['total_detections'] == 3
+    assert analytics['emotion_counts'] == {'happy': 2, 'sad': 1}
+    assert analytics['daily_counts'] == [('2024-01-07', 1), ('2024-01-08', 1), ('2024-01-09', 1)]
+    assert sorted((r['hour'], r['emotion'], r['count']) for r in analytics['hourly']) == \
+        [(9, 'happy', 2), (9, 'sad', 1)]
+    assert sorted((r['weekday'], r['count']) for r in analytics['weekday']) == \
+        [('Monday', 1), ('Sunday', 1), ('Tuesday', 1)]
+    assert analytics['language_counts'] == {'English': 3}
+
+    filtered = storage.get_emotion_analytics(username, emotion_filter=['sad'])
+    assert filtered['total_detections'] == 1, "analytics emotion filter not applied"
+    stats = storage.get_emotion_statistics(username, days=36500)
+    assert stats['emotion_counts'] == {'happy': 2, 'sad': 1}
+    assert stats['most_common_emotion'] == 'happy'
+
+@check
+def emotion_transitions(storage):
+    username = _user(storage)
+    base = datetime(2024, 1, 7, 9, 30)
+    # happy for 20s then sad for 10s, an hour's gap, then neutral (still open)
+    for seconds, emotion in [(0, 'happy'), (10, 'happy'), (20, 'sad'), (30, 'sad'), (3630, 'neutral')]:
+        storage.save_emotion({"username": username, "emotion": emotion,
+                              "timestamp": base + timedelta(seconds=seconds)})
+    transitions = storage.get_emotion_transitions(username)
+    emotions = transitions['emotions']
+    happy, sad = emotions.index('happy'), emotions.index('sad')
+    assert sum(map(sum, transitions['counts'])) == 1
+    assert transitions['counts'][happy][sad] == 1, "happy -> sad transition not counted"
+    # Dwell bins: happy 20s falls in (15, 30], sad 10s in (5, 15]
+    assert transitions['dwell'][happy][2] == 1 and transitions['dwell'][sad][1] == 1
+    assert sum(map(sum, transitions['dwell'])) == 2, "the open span should not be counted"
+
+@check
+def games_and_recommendations(storage):
+    username = _user(storage)
+    assert storage.track_game_play(username, "Moto X3M", "https://poki.com/en/g/moto-x3m")
+    assert storage.track_game_play(username, "Cut the Rope")
+    games = storage.get_games_history(username)
+    assert [g['game_name'] for g in games] == ["Cut the Rope", "Moto X3M"], "games not newest first"
+    assert storage.get_user(username)['stats']['games_played'] == 2
+    assert storage.save_music_recommendation(username, "spotify", "Hindi Arijit", "happy", "Hindi", "Arijit")
+
+@check
+def preferences_and_sessions(storage):
+    username = _user(storage)
+    assert storage.get_preferences(username) is None
+    storage.save_preferences(username, {"default_language": "English"})
+    storage.save_preferences(username, {"favorite_genres": "Pop"})
+    prefs = storage.get_preferences(username)
+    assert prefs['default_language'] == "English" and prefs['favorite_genres'] == "Pop", \
+        "save_preferences should merge fields"
+    storage.start_session(username, f"{username}@example.com")
+    assert storage.count_active_sessions(username) == 1
+
+@check
+def shared_cache(storage):
+    key = f"conformance|{uuid.uuid4().hex}"
+    value = {"numbers": [3, 1, 2], "applied": ["emotion"]}
+    if not storage.set_shared_cache(key, value, 60):
+        return  # no shared cache: every get misses
+    assert storage.get_shared_cache(key) == value, "shared cache value not returned"
+    storage.set_shared_cache(key, {"numbers": []}, 60)
+    assert storage.get_shared_cache(key) == {"numbers": []}, "shared cache value not replaced"
+    storage.set_shared_cache(key, value, -1)
+    assert storage.get_shared_cache(key) is None, "expired shared cache value returned"
+
+@check
+def write_hooks_fire_once(storage):
+    username = _user(storage)
+    seen = []
+    storage.add_write_hook('emotion_history',
+                           lambda docs: seen.extend(d for d in docs if d.get('username') == username))
+    doc_id = uuid.uuid4().hex[:24]
+    storage.save_emotion({"_id": doc_id, "username": username, "emotion": "happy", "timestamp": _base_time()})
+    storage.save_emotion({"_id": doc_id, "username": username, "emotion": "happy", "timestamp": _base_time()})
+    assert len(seen) == 1, f"write hook saw {len(seen)} documents"
+
+@contextmanager
+def scratch_storage(backend: str, mongo_database: str = CONFORMANCE_MONGODB_DATABASE) -> Iterator[StorageBackend]:
+    """A backend on throwaway storage, removed on exit
+
+    MongoDB is pointed at mongo_database (and a temporary spool, so writes
+    spooled while it is down are never replayed into the live database);
+    that has to happen before database.py is imported.
+    """
+    scratch = tempfile.mkdtemp(prefix="conformance-")
+    try:
+        if backend == "sqlite":
+            from storage.sqlite import SQLiteStorage
+            yield SQLiteStorage(os.path.join(scratch, "conformance.db"))
+        elif backend == "mongo":
+            if "database" in sys.modules:
+                raise RuntimeError("database.py is already connected; run the mongo checks in a fresh process")
+            os.environ["MONGODB_DATABASE"] = mongo_database
+            os.environ["SPOOL_DIR"] = os.path.join(scratch, "spool")
+            from storage.mongo import MongoStorage
+            storage = MongoStorage()
+            try:
+                yield storage
+            finally:
+                if storage.is_available():
+                    storage.db_manager.client.drop_database(mongo_database)
+        else:
+            from storage import create_storage
+            yield create_storage(backend)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+def run_conformance(storage: StorageBackend) -> List[str]:
+    """Run every check; returns failure messages (empty when the backend conforms)"""
+    failures = []
+    for func in CHECKS:
+        try:
+            func(storage)
+        except Exception as e:
+            failures.append(f"{func.__name__}: {type(e).__name__}: {e}")
+    return failures
@@ -0,0 +1,203 @@
+import bisect
+import copy
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from storage.base import (
+    DuplicateUserError, EMOTION_FIELDS, StorageBackend, apply_active_day, apply_emotion_to_stats,
+    apply_login_day, quick_stats_from_user, set_path
+)
+
+class MemoryStorage(StorageBackend):
+    """Process-local backend for load testing and development without a database"""
+
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+        self._users = {}
+        self._emails = {}
+        # Per-user history sorted by (timestamp, _id)
+        self._history = {}
+        self._emotion_ids = set()
+        self._recommendations = []
+        self._games = {}
+        self._preferences = {}
+        self._sessions = []
+
+    # Users
+    def get_user(self, username: str) -> Optional[Dict]:
+        with self._lock:
+            user = self._users.get(username)
+            return copy.deepcopy(user) if user else None
+
+    def find_user(self, identifier: str) -> Optional[Dict]:
+        with self._lock:
+            username = identifier if identifier in self._users else self._emails.get(identifier)
+            return self.get_user(username) if username else None
+
+    def find_user_by_email(self, email: str) -> Optional[Dict]:
+        with self._lock:
+            username = self._emails.get(email)
+            return self.get_user(username) if username else None
+
+    def create_user(self, user_doc: Dict) -> bool:
+        with self._lock:
+            email = user_doc.get('email')
+            if user_doc['username'] in self._users or (email and email in self._emails):
+                raise DuplicateUserError("Username or email already exists")
+            doc = copy.deepcopy(user_doc)
+            doc.setdefault('_id', uuid.uuid4().hex)
+            self._users[doc['username']] = doc
+            if email:
+                self._emails[email] = doc['username']
+            return True
+
+    def update_user(self, username: str, fields: Dict) -> bool:
+        with self._lock:
+            user = self._users.get(username)
+            if user is None:
+                return False
+            if 'email' in fields and fields['email'] != user.get('email'):
+                if fields['email'] in self._emails:
+                    raise DuplicateUserError("Email already exists")
+                self._emails.pop(user.get('email'), None)
+                if fields['email']:
+                    self._emails[fields['email']] = username
+            for key, value in fields.items():
+                set_path(user, key, copy.deepcopy(value))
+            return True
+
+    def record_login(self, username: str) -> bool:
+        with self._lock:
+            user = self._users.get(username)
+            if user is None:
+                return False
+            now = datetime.utcnow()
+            user['last_login'] = now
+            stats = user.setdefault('stats', {})
+            stats['total_sessions'] = stats.get('total_sessions', 0) + 1
+            apply_login_day(stats, now.strftime('%Y-%m-%d'))
+            return True
+
+    # Emotion history
+    def save_emotion(self, doc: Dict, defer: bool = False) -> bool:
+        stored = {field: doc.get(field) for field in EMOTION_FIELDS if field in doc}
+        stored['_id'] = str(doc.get('_id') or uuid.uuid4().hex)
+        stored.setdefault('timestamp', datetime.utcnow())
+        with self._lock:
+            if stored['_id'] in self._emotion_ids:
+                # Already stored, as MongoDB would report a duplicate _id
+                return True
+            self._emotion_ids.add(stored['_id'])
+            rows = self._history.setdefault(stored['username'], [])
+            key = (stored['timestamp'], stored['_id'])
+            if rows and (rows[-1]['timestamp'], rows[-1]['_id']) > key:
+                # Out-of-order write (e.g. a replayed batch)
+                index = bisect.bisect_right([(r['timestamp'], r['_id']) for r in rows], key)
+                rows.insert(index, stored)
+            else:
+                rows.append(stored)
+            user = self._users.get(stored['username'])
+            if user is not None:
+                apply_emotion_to_stats(user.setdefault('stats', {}), stored)
+        self._notify_written('emotion_history', [dict(stored)])
+        return True
+
+    def iter_emotion_history(self, username: str, start_date: datetime = None,
+                             end_date: datetime = None,
+                             emotion_filter: List[str] = None,
+                             newest_first: bool = True) -> Iterable[Dict]:
+        with self._lock:
+            rows = list(self._history.get(username, []))
+        if newest_first:
+            rows.reverse()
+        emotions = set(emotion_filter) if emotion_filter else None
+        for row in rows:
+            if start_date and row['timestamp'] < start_date:
+                continue
+            if end_date and row['timestamp'] > end_date:
+                continue
+            if emotions is not None and row.get('emotion') not in emotions:
+                continue
+            yield dict(row)
+
+    def get_user_quick_stats(self, username: str) -> Dict:
+        with self._lock:
+            return quick_stats_from_user(self._users.get(username))
+
+    # Music recommendations and games
+    def save_music_recommendation(self, username: str, platform: str, query: str,
+                                  emotion: str, language: str = "", artist: str = "") -> bool:
+        doc = {
+            "_id": uuid.uuid4().hex,
+            "username": username,
+            "platform": platform,
+            "query": query,
+            "emotion": emotion,
+            "language": language,
+            "artist": artist,
+            "timestamp": datetime.utcnow()
+        }
+        with self._lock:
+            self._recommendations.append(doc)
+        self._notify_written('music_recommendations', [dict(doc)])
+        return True
+
+    def track_game_play(self, username: str, game_name: str, game_url: str = "",
+                        play_duration: int = 0) -> bool:
+        now = datetime.utcnow()
+        doc = {
+            "_id": uuid.uuid4().hex,
+            "username": username,
+            "game_name": game_name,
+            "game_url": game_url,
+            "play_duration": play_duration,
+            "timestamp": now,
+            "session_id": f"{username}_{now.strftime('%Y%m%d')}"
+        }
+        with self._lock:
+            self._games.setdefault(username, []).append(doc)
+            user = self._users.get(username)
+            if user is not None:
+                stats = user.setdefault('stats', {})
+                stats['games_played'] = stats.get('games_played', 0) + 1
+                apply_active_day(stats, now.strftime('%Y-%m-%d'))
+        self._notify_written('games_history', [dict(doc)])
+        return True
+
+    def get_games_history(self, username: str, limit: int = 100) -> List[Dict]:
+        with self._lock:
+            rows = self._games.get(username, [])
+            return [dict(row) for row in reversed(rows[-limit:])]
+
+    # Preferences and sessions
+    def get_preferences(self, username: str) -> Optional[Dict]:
+        with self._lock:
+            prefs = self._preferences.get(username)
+            return dict(prefs) if prefs else None
+
+    def save_preferences(self, username: str, preferences: Dict) -> bool:
+        with self._lock:
+            prefs = self._preferences.setdefault(username, {"username": username})
+            prefs.update(preferences)
+            prefs['updated_at'] = datetime.utcnow()
+            return True
+
+    def start_session(self, username: str, email: str = "") -> bool:
+        with self._lock:
+            self._sessions.append({
+                "username": username,
+                "email": email,
+                "session_start": datetime.utcnow()
+            })
+            return True
+
+    def count_active_sessions(self, username: str) -> int:
+        cutoff = datetime.utcnow() - timedelta(hours=24)
+        with self._lock:
+            self._sessions = [s for s in self._sessions if s['session_start'] >= cutoff]
+            return sum(1 for s in self._sessions if s['username'] == username)
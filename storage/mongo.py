@@ -0,0 +1,241 @@
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+from storage.base import DuplicateUserError, StorageBackend
+
+class MongoStorage(StorageBackend):
+    """MongoDB backend; the queries live in database.py"""
+
+    name = "mongo"
+
+    def __init__(self):
+        super().__init__()
+        # Imported here so embedded deployments never open a MongoDB client
+        import database
+        self.database = database
+        self.db_manager = database.db_manager
+
+    def is_available(self) -> bool:
+        return self.db_manager.is_available()
+
+    def add_write_hook(self, collection_name: str, hook: Callable[[List[Dict]], None]):
+        self.db_manager.add_write_hook(collection_name, hook)
+
+    def _users(self):
+        return self.db_manager.get_collection('users')
+
+    def _run(self, action: str, operation: Callable[[], Any], default: Any = None) -> Any:
+        """Run a MongoDB call, reporting failures to the circuit breaker; default on error"""
+        try:
+            return operation()
+        except DuplicateKeyError:
+            raise
+        except Exception as e:
+            self.db_manager.report_failure(e)
+            print(f"Error {action}: {e}")
+            return default
+
+    # Users
+    def get_user(self, username: str) -> Optional[Dict]:
+        users = self._users()
+        if users is None:
+            return None
+        return self._run("getting user", lambda: users.find_one({"username": username}))
+
+    def find_user(self, identifier: str) -> Optional[Dict]:
+        users = self._users()
+        if users is None:
+            return None
+        return self._run("finding user", lambda: users.find_one(
+            {"$or": [{"username": identifier}, {"email": identifier}]}
+        ))
+
+    def find_user_by_email(self, email: str) -> Optional[Dict]:
+        users = self._users()
+        if users is None:
+            return None
+        return self._run("finding user by email", lambda: users.find_one({"email": email}))
+
+    def create_user(self, user_doc: Dict) -> bool:
+        users = self._users()
+        if users is None:
+            return False
+        try:
+            return self._run("creating user",
+                             lambda: users.insert_one(dict(user_doc)).inserted_id is not None, False)
+        except DuplicateKeyError:
+            raise DuplicateUserError("Username or email already exists")
+
+    def update_user(self, username: str, fields: Dict) -> bool:
+        users = self._users()
+        if users is None:
+            return False
+        try:
+            return self._run("updating user",
+                             lambda: users.update_one({"username": username}, {"$set": fields}).matched_count > 0,
+                             False)
+        except DuplicateKeyError:
+            raise DuplicateUserError("Email already exists")
+
+    def record_login(self, username: str) -> bool:
+        users = self._users()
+        if users is None:
+            return False
+        now = datetime.utcnow()
+
+        def record():
+            result = users.update_one(
+                {"username": username},
+                {
+                    "$set": {"last_login": now},
+                    "$inc": {"stats.total_sessions": 1}
+                }
+            )
+            users.bulk_write([self.database.active_day_update(username, now.strftime('%Y-%m-%d'), login=True)])
+            return result.matched_count > 0
+
+        return self._run("recording login", record, False)
+
+    # Emotion history
+    def save_emotion(self, doc: Dict, defer: bool = False) -> bool:
+        return self.db_manager.insert_one('emotion_history', dict(doc), defer=defer)
+
+    def iter_emotion_history(self, username: str, start_date: datetime = None,
+                             end_date: datetime = None,
+                             emotion_filter: List[str] = None,
+                             newest_first: bool = True) -> Iterable[Dict]:
+        emotions = self.db_manager.get_collection('emotion_history')
+        if emotions is None:
+            return
+        query = self.database.build_history_match(username, start_date, end_date, emotion_filter)
+        direction = -1 if newest_first else 1
+        sort = [("timestamp", direction), ("_id", direction)]
+        try:
+            for doc in self.db_manager.history.find(emotions, query, sort=sort):
+                doc['_id'] = str(doc['_id'])
+                yield doc
+        except Exception as e:
+            # Stops early; the breaker learns of connectivity errors
+            self.db_manager.report_failure(e)
+            print(f"Error reading emotion history: {e}")
+
+    def get_emotion_history(self, username: str, start_date: datetime = None,
+                            end_date: datetime = None,
+                            emotion_filter: List[str] = None,
+                            limit: int = 1000) -> List[Dict]:
+        return self.database.get_emotion_history(username, start_date, end_date, emotion_filter, limit)
+
+    def get_emotion_page(self, username: str, before=None, page_size: int = 20,
+                         emotion_filter: List[str] = None, language_filter: List[str] = None,
+                         include_archive: bool = False):
+        return self.database.get_emotion_page(username, before, page_size, emotion_filter,
+                                              language_filter, include_archive)
+
+    def get_emotion_frame(self, username: str, start_date: datetime = None,
+                          end_date: datetime = None,
+                          emotion_filter: List[str] = None,
+                          limit: int = 1000):
+        return self.database.get_emotion_frame(username, start_date, end_date, emotion_filter, limit)
+
+    def iter_emotion_frames(self, username: str, start_date: datetime = None,
+                            end_date: datetime = None,
+                            emotion_filter: List[str] = None,
+                            batch_size: int = 5000,
+                            include_archive: bool = False):
+        return self.database.iter_emotion_frames(username, start_date, end_date, emotion_filter,
+                                                 batch_size, include_archive)
+
+    def get_emotion_statistics(self, username: str, days: int = 30) -> Dict:
+        return self.database.get_emotion_statistics(username, days)
+
+    def get_emotion_analytics(self, username: str, start_date: datetime = None,
+                              end_date: datetime = None,
+                              emotion_filter: List[str] = None,
+                              include_archive: bool = False) -> Dict:
+        return self.database.get_emotion_analytics(username, start_date, end_date, emotion_filter,
+                                                   include_archive)
+
+    def get_emotion_transitions(self, username: Optional[str], start_date: datetime = None,
+                                end_date: datetime = None) -> Dict:
+        return self.database.get_emotion_transitions(username, start_date, end_date)
+
+    def get_global_analytics(self, start_date: datetime = None, end_date: datetime = None) -> Dict:
+        return self.database.get_global_analytics(start_date, end_date)
+
+    def get_mood_alerts(self, username: str, include_acknowledged: bool = False,
+                        limit: int = 20) -> List[Dict]:
+        return self.database.get_mood_alerts(username, include_acknowledged, limit)
+
+    def acknowledge_mood_alerts(self, username: str) -> int:
+        return self.database.acknowledge_mood_alerts(username)
+
+    def get_shared_cache(self, key: str) -> Optional[Any]:
+        cache = self.db_manager.get_collection('shared_cache')
+        if cache is None:
+            return None
+        # The TTL monitor only runs once a minute
+        doc = self._run("reading shared cache",
+                        lambda: cache.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}}))
+        return doc['value'] if doc else None
+
+    def set_shared_cache(self, key: str, value: Any, ttl: float) -> bool:
+        cache = self.db_manager.get_collection('shared_cache')
+        if cache is None:
+            return False
+        doc = {"value": value, "expires_at": datetime.utcnow() + timedelta(seconds=ttl)}
+        return self._run("writing shared cache",
+                         lambda: cache.replace_one({"_id": key}, doc, upsert=True) is not None, False)
+
+    def get_user_quick_stats(self, username: str) -> Dict:
+        return self.database.get_user_quick_stats(username)
+
+    def get_history_revision(self, username: str) -> Any:
+        return self.database.get_history_revision(username)
+
+    # Music recommendations and games
+    def save_music_recommendation(self, username: str, platform: str, query: str,
+                                  emotion: str, language: str = "", artist: str = "") -> bool:
+        return self.database.save_music_recommendation(username, platform, query, emotion, language, artist)
+
+    def track_game_play(self, username: str, game_name: str, game_url: str = "",
+                        play_duration: int = 0) -> bool:
+        return self.database.track_game_play(username, game_name, game_url, play_duration)
+
+    def get_games_history(self, username: str, limit: int = 100) -> List[Dict]:
+        return self.database.get_games_history(username, limit)
+
+    # Preferences and sessions
+    def get_preferences(self, username: str) -> Optional[Dict]:
+        prefs = self.db_manager.get_collection('user_preferences')
+        if prefs is None:
+            return None
+        return self._run("getting preferences", lambda: prefs.find_one({"username": username}))
+
+    def save_preferences(self, username: str, preferences: Dict) -> bool:
+        prefs = self.db_manager.get_collection('user_preferences')
+        if prefs is None:
+            return False
+        return self._run("saving preferences", lambda: prefs.update_one(
+            {"username": username},
+            {"$set": dict(preferences, updated_at=datetime.utcnow())},
+            upsert=True
+        ) is not None, False)
+
+    def start_session(self, username: str, email: str = "") -> bool:
+        # Expired by the TTL index on session_start
+        return self.db_manager.insert_one('user_sessions', {
+            "username": username,
+            "email": email,
+            "session_start": datetime.utcnow()
+        })
+
+    def count_active_sessions(self, username: str) -> int:
+        sessions = self.db_manager.get_collection('user_sessions')
+        if sessions is None:
+            return 0
+        cutoff = datetime.utcnow() - timedelta(hours=24)
+        return self._run("counting sessions", lambda: sessions.count_documents(
+            {"username": username, "session_start": {"$gte": cutoff}}
+        ), 0)
@@ -0,0 +1,441 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from storage.base import (
+    DuplicateUserError, EMOTION_FIELDS, StorageBackend, WEEKDAY_NAMES,
+    apply_active_day, apply_emotion_to_stats, apply_login_day, page_cursor, quick_stats_from_user,
+    set_path
+)
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "music_app.db")
+SQLITE_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    email TEXT UNIQUE,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS emotion_history (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    emotion TEXT,
+    timestamp TEXT NOT NULL,
+    language TEXT,
+    singer TEXT,
+    artist TEXT,
+    confidence REAL,
+    session_id TEXT
+);
+CREATE INDEX IF NOT EXISTS emotion_history_user_time
+    ON emotion_history (username, timestamp DESC, id DESC);
+CREATE INDEX IF NOT EXISTS emotion_history_emotion ON emotion_history (emotion);
+CREATE TABLE IF NOT EXISTS games_history (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    game_name TEXT,
+    game_url TEXT,
+    play_duration INTEGER,
+    timestamp TEXT NOT NULL,
+    session_id TEXT
+);
+CREATE INDEX IF NOT EXISTS games_history_user_time ON games_history (username, timestamp DESC);
+CREATE TABLE IF NOT EXISTS music_recommendations (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    platform TEXT,
+    query TEXT,
+    emotion TEXT,
+    language TEXT,
+    artist TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS music_recommendations_user_time
+    ON music_recommendations (username, timestamp DESC);
+CREATE INDEX IF NOT EXISTS music_recommendations_platform ON music_recommendations (platform);
+CREATE TABLE IF NOT EXISTS user_preferences (
+    username TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_sessions (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    email TEXT,
+    session_start TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_sessions_user_start ON user_sessions (username, session_start DESC);
+CREATE INDEX IF NOT EXISTS user_sessions_start ON user_sessions (session_start);
+CREATE TABLE IF NOT EXISTS shared_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shared_cache_expires ON shared_cache (expires_at);
+"""
+
+def _ts(value: datetime) -> str:
+    # Fixed width so text order matches time order
+    return value.isoformat(sep=' ', timespec='microseconds')
+
+def _parse_ts(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": _ts(value)}
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Cannot store {type(value).__name__} in SQLite document")
+
+def _decode(obj: Dict):
+    if len(obj) == 1 and "$date" in obj:
+        return _parse_ts(obj["$date"])
+    if len(obj) == 1 and "$bytes" in obj:
+        return base64.b64decode(obj["$bytes"])
+    return obj
+
+def dumps(doc: Dict) -> str:
+    return json.dumps(doc, default=_encode)
+
+def loads(text: str) -> Dict:
+    return json.loads(text, object_hook=_decode)
+
+class SQLiteStorage(StorageBackend):
+    """Embedded single-file backend for kiosk deployments without a MongoDB server
+
+    Uses WAL journaling so page renders can read while the camera thread
+    writes. Each thread gets its own connection.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # Users
+    def _load_user(self, conn, where: str, args) -> Optional[Dict]:
+        row = conn.execute(f"SELECT doc FROM users WHERE {where}", args).fetchone()
+        return loads(row['doc']) if row else None
+
+    def _save_user(self, conn, user: Dict):
+        conn.execute(
+            "UPDATE users SET email = ?, doc = ? WHERE username = ?",
+            (user.get('email') or None, dumps(user), user['username'])
+        )
+
+    def get_user(self, username: str) -> Optional[Dict]:
+        return self._load_user(self._connect(), "username = ?", (username,))
+
+    def find_user(self, identifier: str) -> Optional[Dict]:
+        return self._load_user(self._connect(), "username = ? OR email = ?", (identifier, identifier))
+
+    def find_user_by_email(self, email: str) -> Optional[Dict]:
+        return self._load_user(self._connect(), "email = ?", (email,))
+
+    def create_user(self, user_doc: Dict) -> bool:
+        doc = dict(user_doc)
+        doc.setdefault('_id', uuid.uuid4().hex)
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT INTO users (username, email, doc) VALUES (?, ?, ?)",
+                    (doc['username'], doc.get('email') or None, dumps(doc))
+                )
+        except sqlite3.IntegrityError:
+            raise DuplicateUserError("Username or email already exists")
+        return True
+
+    def update_user(self, username: str, fields: Dict) -> bool:
+        try:
+            with self._connect() as conn:
+                # Take the write lock before reading so concurrent updates are not lost
+                conn.execute("BEGIN IMMEDIATE")
+                user = self._load_user(conn, "username = ?", (username,))
+                if user is None:
+                    return False
+                for key, value in fields.items():
+                    set_path(user, key, value)
+                self._save_user(conn, user)
+        except sqlite3.IntegrityError:
+            raise DuplicateUserError("Email already exists")
+        return True
+
+    def record_login(self, username: str) -> bool:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            user = self._load_user(conn, "username = ?", (username,))
+            if user is None:
+                return False
+            now = datetime.utcnow()
+            user['last_login'] = now
+            stats = user.setdefault('stats', {})
+            stats['total_sessions'] = stats.get('total_sessions', 0) + 1
+            apply_login_day(stats, now.strftime('%Y-%m-%d'))
+            self._save_user(conn, user)
+        return True
+
+    # Emotion history
+    def save_emotion(self, doc: Dict, defer: bool = False) -> bool:
+        """Store one detection; defer is ignored
+
+        defer exists to keep network round trips off the camera thread. A
+        local WAL insert costs about as much as spooling the document would,
+        so it is always written straight away.
+        """
+        stored = {field: doc.get(field) for field in EMOTION_FIELDS}
+        stored['_id'] = str(doc.get('_id') or uuid.uuid4().hex)
+        stored['timestamp'] = stored['timestamp'] or datetime.utcnow()
+        with self._connect() as conn:
+            inserted = conn.execute(
+                "INSERT OR IGNORE INTO emotion_history "
+                "(id, username, emotion, timestamp, language, singer, artist, confidence, session_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (stored['_id'], stored['username'], stored['emotion'], _ts(stored['timestamp']),
+                 stored['language'], stored['singer'], stored['artist'], stored['confidence'],
+                 stored['session_id'])
+            ).rowcount
+            if not inserted:
+                return True
+            user = self._load_user(conn, "username = ?", (stored['username'],))
+            if user is not None:
+                apply_emotion_to_stats(user.setdefault('stats', {}), stored)
+                self._save_user(conn, user)
+        self._notify_written('emotion_history', [{k: v for k, v in stored.items() if v is not None}])
+        return True
+
+    @staticmethod
+    def _history_where(username: str, start_date: datetime = None, end_date: datetime = None,
+                       emotion_filter: List[str] = None):
+        clauses, args = ["username = ?"], [username]
+        if start_date:
+            clauses.append("timestamp >= ?")
+            args.append(_ts(start_date))
+        if end_date:
+            clauses.append("timestamp <= ?")
+            args.append(_ts(end_date))
+        if emotion_filter:
+            clauses.append(f"emotion IN ({', '.join('?' for _ in emotion_filter)})")
+            args.extend(emotion_filter)
+        return " AND ".join(clauses), args
+
+    @staticmethod
+    def _history_row(row: sqlite3.Row) -> Dict:
+        doc = {"_id": row['id']}
+        for field in EMOTION_FIELDS:
+            if row[field] is not None:
+                doc[field] = row[field]
+        doc['timestamp'] = _parse_ts(row['timestamp'])
+        return doc
+
+    def iter_emotion_history(self, username: str, start_date: datetime = None,
+                             end_date: datetime = None,
+                             emotion_filter: List[str] = None,
+                             newest_first: bool = True) -> Iterable[Dict]:
+        where, args = self._history_where(username, start_date, end_date, emotion_filter)
+        order = "DESC" if newest_first else "ASC"
+        cursor = self._connect().execute(
+            f"SELECT * FROM emotion_history WHERE {where} ORDER BY timestamp {order}, id {order}", args
+        )
+        while True:
+            rows = cursor.fetchmany(SQLITE_BATCH)
+            if not rows:
+                break
+            for row in rows:
+                yield self._history_row(row)
+
+    def get_emotion_page(self, username: str, before: Tuple[datetime, Any] = None,
+                         page_size: int = 20, emotion_filter: List[str] = None,
+                         language_filter: List[str] = None,
+                         include_archive: bool = False) -> Tuple[List[Dict], Optional[Tuple]]:
+        where, args = self._history_where(username, emotion_filter=emotion_filter)
+        if language_filter:
+            where += f" AND language IN ({', '.join('?' for _ in language_filter)})"
+            args.extend(language_filter)
+        if before and before[1] is not None:
+            # Row-value comparison is a single range scan of emotion_history_user_time
+            where += " AND (timestamp, id) < (?, ?)"
+            args.extend([_ts(before[0]), before[1]])
+        elif before:
+            where += " AND timestamp < ?"
+            args.append(_ts(before[0]))
+        rows = self._connect().execute(
+            f"SELECT * FROM emotion_history WHERE {where} "
+            f"ORDER BY timestamp DESC, id DESC LIMIT ?", args + [page_size + 1]
+        ).fetchall()
+        page = [self._history_row(row) for row in rows[:page_size]]
+        return page, page_cursor(page) if len(rows) > page_size else None
+
+    def get_emotion_analytics(self, username: str, start_date: datetime = None,
+                              end_date: datetime = None,
+                              emotion_filter: List[str] = None,
+                              include_archive: bool = False) -> Dict:
+        where, args = self._history_where(username, start_date, end_date, emotion_filter)
+        conn = self._connect()
+
+        def query(select: str, group: str, order: str = "", limit: str = ""):
+            return conn.execute(
+                f"SELECT {select}, COUNT(*) AS count FROM emotion_history WHERE {where} "
+                f"GROUP BY {group} {order} {limit}", args
+            ).fetchall()
+
+        emotions = query("emotion", "emotion", "ORDER BY count DESC")
+        daily = query("substr(timestamp, 1, 10) AS day", "day", "ORDER BY day")
+        hourly = query("CAST(strftime('%H', timestamp) AS INTEGER) AS hour, emotion", "hour, emotion")
+        weekday = query("CAST(strftime('%w', timestamp) AS INTEGER) AS weekday, emotion", "weekday, emotion")
+        languages = query("language", "language HAVING language IS NOT NULL", "ORDER BY count DESC", "LIMIT 10")
+        singers = query("singer", "singer HAVING singer IS NOT NULL", "ORDER BY count DESC", "LIMIT 10")
+
+        return {
+            "total_detections": sum(row['count'] for row in emotions),
+            "emotion_counts": {row['emotion']: row['count'] for row in emotions},
+            "daily_counts": [(row['day'], row['count']) for row in daily],
+            "hourly": [{"hour": row['hour'], "emotion": row['emotion'], "count": row['count']} for row in hourly],
+            "weekday": [{"weekday": WEEKDAY_NAMES[row['weekday']], "emotion": row['emotion'],
+                         "count": row['count']} for row in weekday],
+            "language_counts": {row['language']: row['count'] for row in languages},
+            "singer_counts": {row['singer']: row['count'] for row in singers}
+        }
+
+    def get_user_quick_stats(self, username: str) -> Dict:
+        return quick_stats_from_user(self.get_user(username))
+
+    # Music recommendations and games
+    def save_music_recommendation(self, username: str, platform: str, query: str,
+                                  emotion: str, language: str = "", artist: str = "") -> bool:
+        doc = {
+            "_id": uuid.uuid4().hex,
+            "username": username,
+            "platform": platform,
+            "query": query,
+            "emotion": emotion,
+            "language": language,
+            "artist": artist,
+            "timestamp": datetime.utcnow()
+        }
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO music_recommendations "
+                "(id, username, platform, query, emotion, language, artist, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (doc['_id'], username, platform, query, emotion, language, artist, _ts(doc['timestamp']))
+            )
+        self._notify_written('music_recommendations', [doc])
+        return True
+
+    def track_game_play(self, username: str, game_name: str, game_url: str = "",
+                        play_duration: int = 0) -> bool:
+        now = datetime.utcnow()
+        doc = {
+            "_id": uuid.uuid4().hex,
+            "username": username,
+            "game_name": game_name,
+            "game_url": game_url,
+            "play_duration": play_duration,
+            "timestamp": now,
+            "session_id": f"{username}_{now.strftime('%Y%m%d')}"
+        }
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO games_history "
+                "(id, username, game_name, game_url, play_duration, timestamp, session_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (doc['_id'], username, game_name, game_url, play_duration, _ts(now), doc['session_id'])
+            )
+            user = self._load_user(conn, "username = ?", (username,))
+            if user is not None:
+                stats = user.setdefault('stats', {})
+                stats['games_played'] = stats.get('games_played', 0) + 1
+                apply_active_day(stats, now.strftime('%Y-%m-%d'))
+                self._save_user(conn, user)
+        self._notify_written('games_history', [doc])
+        return True
+
+    def get_games_history(self, username: str, limit: int = 100) -> List[Dict]:
+        rows = self._connect().execute(
+            "SELECT * FROM games_history WHERE username = ? ORDER BY timestamp DESC LIMIT ?",
+            (username, limit)
+        ).fetchall()
+        return [{
+            "_id": row['id'],
+            "username": row['username'],
+            "game_name": row['game_name'],
+            "game_url": row['game_url'],
+            "play_duration": row['play_duration'],
+            "timestamp": _parse_ts(row['timestamp']),
+            "session_id": row['session_id']
+        } for row in rows]
+
+    # Preferences and sessions
+    def get_preferences(self, username: str) -> Optional[Dict]:
+        row = self._connect().execute(
+            "SELECT doc FROM user_preferences WHERE username = ?", (username,)
+        ).fetchone()
+        return loads(row['doc']) if row else None
+
+    def save_preferences(self, username: str, preferences: Dict) -> bool:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT doc FROM user_preferences WHERE username = ?", (username,)).fetchone()
+            prefs = loads(row['doc']) if row else {"username": username}
+            prefs.update(preferences)
+            prefs['updated_at'] = datetime.utcnow()
+            conn.execute(
+                "INSERT INTO user_preferences (username, doc) VALUES (?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET doc = excluded.doc",
+                (username, dumps(prefs))
+            )
+        return True
+
+    # Shared cache (every process using the file sees it)
+    def get_shared_cache(self, key: str) -> Optional[Any]:
+        row = self._connect().execute(
+            "SELECT value FROM shared_cache WHERE key = ? AND expires_at > ?", (key, _ts(datetime.utcnow()))
+        ).fetchone()
+        return loads(row['value']) if row else None
+
+    def set_shared_cache(self, key: str, value: Any, ttl: float) -> bool:
+        now = datetime.utcnow()
+        with self._connect() as conn:
+            conn.execute("DELETE FROM shared_cache WHERE expires_at <= ?", (_ts(now),))
+            conn.execute("INSERT OR REPLACE INTO shared_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, dumps(value), _ts(now + timedelta(seconds=ttl))))
+        return True
+
+    def start_session(self, username: str, email: str = "") -> bool:
+        now = datetime.utcnow()
+        with self._connect() as conn:
+            # Same 24 hour expiry as the MongoDB TTL index
+            conn.execute("DELETE FROM user_sessions WHERE session_start < ?", (_ts(now - timedelta(hours=24)),))
+            conn.execute(
+                "INSERT INTO user_sessions (id, username, email, session_start) VALUES (?, ?, ?, ?)",
+                (uuid.uuid4().hex, username, email, _ts(now))
+            )
+        return True
+
+    def count_active_sessions(self, username: str) -> int:
+        cutoff = _ts(datetime.utcnow() - timedelta(hours=24))
+        row = self._connect().execute(
+            "SELECT COUNT(*) FROM user_sessions WHERE username = ? AND session_start >= ?",
+            (username, cutoff)
+        ).fetchone()
+        return row[0]
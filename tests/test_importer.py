@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from importer import CSVSource, normalize_frame
+
+
+def _rows(n):
+    return pd.DataFrame({"username": ["alice"] * n, "emotion": ["happy"] * n,
+                         "timestamp": ["2024-05-01 10:00:00"] * n, "language": ["Hindi"] * n,
+                         "singer": ["Arijit Singh"] * n})
+
+
+def test_identical_rows_keep_separate_documents(tmp_path):
+    path = tmp_path / "export.csv"
+    _rows(3).to_csv(path, index=False)
+    source = CSVSource(str(path))
+    rows = pd.concat([normalize_frame(frame, origin=source.key, first_row=position - len(frame))[0]
+                      for frame, position in source.chunks(0, batch_size=2)])
+    assert len(rows) == 3
+    assert rows["_id"].nunique() == 3
+
+
+def test_ids_are_stable_across_runs_and_batch_sizes(tmp_path):
+    path = tmp_path / "export.csv"
+    _rows(5).to_csv(path, index=False)
+    source = CSVSource(str(path))
+
+    def ids(batch_size):
+        return [i for frame, position in source.chunks(0, batch_size)
+                for i in normalize_frame(frame, origin=source.key, first_row=position - len(frame))[0]["_id"]]
+
+    assert ids(2) == ids(5)
+    assert len(set(ids(5))) == 5
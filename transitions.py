@@ -0,0 +1,134 @@
+"""Emotion spans, transitions and dwell times
+
+A span is a run of consecutive detections of one emotion with no gap
+longer than SPAN_GAP_SECONDS. When the next detection shows a different
+emotion within the gap, the span closes with a transition to it and its
+dwell time runs up to that detection; when the gap is exceeded, it closes
+without a transition and its dwell time runs to its last detection.
+Closed spans are counted on the UTC day they started, as a
+len(TRANSITION_EMOTIONS) square matrix of from -> to counts and a dwell
+time histogram per emotion.
+"""
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Row and column order of the matrices; other emotions break spans but are not counted
+TRANSITION_EMOTIONS = ['angry', 'disgust', 'fear', 'happy', 'neutral', 'sad', 'surprise']
+# Upper edges (seconds) of the dwell-time bins; the last bin is open-ended
+DWELL_BINS = [5, 15, 30, 60, 120, 300, 600, 1800, 3600]
+SPAN_GAP_SECONDS = float(os.getenv("SPAN_GAP_SECONDS", "60"))
+
+MS_PER_DAY = 86400 * 1000
+_EMOTION_CODES = {emotion: i for i, emotion in enumerate(TRANSITION_EMOTIONS)}
+
+def emotion_codes(emotions) -> np.ndarray:
+    """Matrix indexes of emotions; -1 for emotions outside TRANSITION_EMOTIONS"""
+    return np.array([_EMOTION_CODES.get(e, -1) for e in emotions], dtype=np.int64)
+
+def empty_matrices() -> Tuple[np.ndarray, np.ndarray]:
+    n = len(TRANSITION_EMOTIONS)
+    return np.zeros((n, n), dtype=np.int64), np.zeros((n, len(DWELL_BINS) + 1), dtype=np.int64)
+
+def close_spans(times: np.ndarray, codes: np.ndarray, open_span: Optional[Dict] = None,
+                gap_seconds: float = SPAN_GAP_SECONDS) -> Tuple[Dict[str, np.ndarray], Optional[Dict]]:
+    """Spans closed by detections in time order, and the span left open
+
+    times are epoch milliseconds; open_span is the {emotion, start, last}
+    (codes and epoch milliseconds) returned by the previous call.
+    """
+    gap = gap_seconds * 1000
+    if open_span is not None:
+        previous_time = np.concatenate([[open_span['last']], times[:-1]])
+        previous_code = np.concatenate([[open_span['emotion']], codes[:-1]])
+        breaks = (codes != previous_code) | (times - previous_time > gap)
+    else:
+        breaks = np.ones(len(times), dtype=bool)
+        breaks[1:] = (codes[1:] != codes[:-1]) | (np.diff(times) > gap)
+    starts = np.flatnonzero(breaks)
+    # Each span's last detection is the one before the next span starts
+    last = times[np.concatenate([starts[1:], [len(times)]]) - 1] if len(times) else times
+
+    span_start, span_code, span_last = times[starts], codes[starts], last
+    if open_span is not None:
+        # Detections before the first break extend the open span
+        extended = starts[0] if len(starts) else len(times)
+        open_last = times[extended - 1] if extended else open_span['last']
+        span_start = np.concatenate([[open_span['start']], span_start])
+        span_code = np.concatenate([[open_span['emotion']], span_code])
+        span_last = np.concatenate([[open_last], span_last])
+    if len(span_start) == 0:
+        return {'start': span_start, 'from': span_code, 'to': span_code, 'dwell': span_start}, None
+
+    # Every span but the last is closed by the one after it
+    next_start = span_start[1:]
+    switched = next_start - span_last[:-1] <= gap
+    closed = {
+        'start': span_start[:-1],
+        'from': span_code[:-1],
+        'to': np.where(switched, span_code[1:], -1),
+        'dwell': np.where(switched, next_start - span_start[:-1], span_last[:-1] - span_start[:-1]) / 1000
+    }
+    still_open = {'emotion': int(span_code[-1]), 'start': int(span_start[-1]), 'last': int(span_last[-1])}
+    return closed, still_open
+
+def matrices_by_day(closed: Dict[str, np.ndarray]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Transition counts and dwell histograms of closed spans, per start day"""
+    n, bins = len(TRANSITION_EMOTIONS), len(DWELL_BINS) + 1
+    counted = closed['from'] >= 0
+    if not counted.any():
+        return {}
+    days = closed['start'][counted] // MS_PER_DAY
+    first = int(days.min())
+    day = days - first
+    n_days = int(day.max()) + 1
+    source, target = closed['from'][counted], closed['to'][counted]
+    dwell_bin = np.searchsorted(DWELL_BINS, closed['dwell'][counted], side='right')
+
+    moved = target >= 0
+    counts = np.bincount((day[moved] * n + source[moved]) * n + target[moved],
+                         minlength=n_days * n * n).reshape(n_days, n, n)
+    dwell = np.bincount((day * n + source) * bins + dwell_bin, minlength=n_days * n * bins).reshape(n_days, n, bins)
+    labels = np.datetime64(first, 'D') + np.arange(n_days)
+    return {str(label): (counts[i], dwell[i]) for i, label in enumerate(labels)
+            if counts[i].any() or dwell[i].any()}
+
+def frame_day_matrices(frames) -> Tuple[Dict[str, Tuple[np.ndarray, np.ndarray]], Optional[Dict]]:
+    """Per-day matrices of history DataFrame chunks (oldest first), and the span left open"""
+    days = {}
+    open_span = None
+    for frame in frames:
+        if frame.empty:
+            continue
+        times = frame['timestamp'].to_numpy().astype('datetime64[ms]').astype(np.int64)
+        closed, open_span = close_spans(times, emotion_codes(frame['emotion'].astype(object)), open_span)
+        for day, (counts, dwell) in matrices_by_day(closed).items():
+            if day in days:
+                counts, dwell = days[day][0] + counts, days[day][1] + dwell
+            days[day] = (counts, dwell)
+    return days, open_span
+
+def frame_transitions(frames) -> Dict:
+    """Transitions of history DataFrame chunks (oldest first), in get_emotion_transitions' shape"""
+    counts, dwell = empty_matrices()
+    for day_counts, day_dwell in frame_day_matrices(frames)[0].values():
+        counts += day_counts
+        dwell += day_dwell
+    return transitions_result(counts, dwell)
+
+def transitions_result(counts: np.ndarray, dwell: np.ndarray) -> Dict:
+    return {
+        "emotions": list(TRANSITION_EMOTIONS),
+        "dwell_bins": list(DWELL_BINS),
+        "counts": counts.tolist(),
+        "dwell": dwell.tolist()
+    }
+
+def transition_probabilities(counts: List[List[int]]) -> pd.DataFrame:
+    """Row-normalized counts: P(next emotion | current emotion)"""
+    matrix = np.asarray(counts, dtype=np.float64)
+    totals = matrix.sum(axis=1, keepdims=True)
+    probabilities = np.divide(matrix, totals, out=np.zeros_like(matrix), where=totals > 0)
+    return pd.DataFrame(probabilities, index=TRANSITION_EMOTIONS, columns=TRANSITION_EMOTIONS)
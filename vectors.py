@@ -0,0 +1,290 @@
+"""Vector similarity retrieval over the track catalog
+
+Every catalog track has a feature vector: its affinity to each emotion
+(from valence/arousal, or its mood label) followed by its most common
+tags, then the acoustic descriptors of tracks found in the local music
+library (audio_features.py). Vectors are L2-normalized and stored as one contiguous float32
+matrix (CATALOG_DIR/vectors.f32, row i = catalog track number i) that is
+memory-mapped, so only the rows a query touches are paged in.
+
+Queries are built from the smoothed emotion probabilities and the user's
+preference vector. Exact search scores blocks of rows with one matmul and
+keeps each block's top k with argpartition; the optional IVF index
+(k-means lists) scores only the rows in the nprobe lists nearest to the
+query, for catalogs too large to scan per request.
+"""
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from audio_features import AUDIO_FEATURES, AUDIO_FEATURES_PATH, load_features, match_tracks
+from catalog import CATALOG_DIR, EMOTION_VALENCE_AROUSAL, Catalog, file_version
+from transitions import TRANSITION_EMOTIONS
+
+VECTORS_PATH = os.path.join(CATALOG_DIR, "vectors.f32")
+IVF_PATH = os.path.join(CATALOG_DIR, "ivf.npz")
+# Most common tags given their own dimension
+VECTOR_TAG_DIMS = int(os.getenv("VECTOR_TAG_DIMS", "32"))
+# Weight of the tag dimensions against the emotion dimensions
+VECTOR_TAG_WEIGHT = float(os.getenv("VECTOR_TAG_WEIGHT", "0.5"))
+# Norm of the (standardized) acoustic descriptors, for tracks in the library
+VECTOR_AUDIO_WEIGHT = float(os.getenv("VECTOR_AUDIO_WEIGHT", "0.5"))
+# Width of the valence-arousal kernel turning distances into emotion affinities
+VECTOR_AFFINITY_WIDTH = float(os.getenv("VECTOR_AFFINITY_WIDTH", "0.05"))
+# Rows scored per matmul in exact search
+VECTOR_BLOCK_ROWS = int(os.getenv("VECTOR_BLOCK_ROWS", "262144"))
+IVF_LISTS = int(os.getenv("IVF_LISTS", "1024"))
+IVF_PROBES = int(os.getenv("IVF_PROBES", "16"))
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+def emotion_affinities(valence: np.ndarray, arousal: np.ndarray, labels: List[str]) -> np.ndarray:
+    """Affinity of each track to each of TRANSITION_EMOTIONS (rows sum to 1)
+
+    A softmax over minus the valence-arousal distances to the emotions'
+    centres; tracks without valence/arousal get their mood label one-hot.
+    """
+    affinities = np.zeros((len(valence), len(TRANSITION_EMOTIONS)), dtype=np.float32)
+    known = ~(np.isnan(valence) | np.isnan(arousal))
+    centres = np.array([EMOTION_VALENCE_AROUSAL[emotion] for emotion in TRANSITION_EMOTIONS], dtype=np.float32)
+    points = np.stack([valence[known], arousal[known]], axis=1).astype(np.float32)
+    logits = -((points[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2) / VECTOR_AFFINITY_WIDTH
+    weights = np.exp(logits - logits.max(axis=1, keepdims=True, initial=-np.inf))
+    affinities[known] = weights / weights.sum(axis=1, keepdims=True)
+
+    codes = {emotion: i for i, emotion in enumerate(TRANSITION_EMOTIONS)}
+    for row in np.flatnonzero(~known):
+        if labels[row] in codes:
+            affinities[row, codes[labels[row]]] = 1
+    return affinities
+
+def ivf_path_for(path: str = VECTORS_PATH) -> str:
+    """The IVF lists of a vectors file, which live next to it"""
+    return os.path.join(os.path.dirname(path) or ".", "ivf.npz")
+
+def ivf_lists(ivf_path: str = IVF_PATH) -> int:
+    """Number of lists of an existing IVF index, 0 if there is none"""
+    if not os.path.exists(ivf_path):
+        return 0
+    with np.load(ivf_path) as ivf:
+        return len(ivf["centroids"])
+
+def build_vectors(catalog: Catalog, path: str = VECTORS_PATH, tag_dims: int = VECTOR_TAG_DIMS,
+                  audio_path: str = AUDIO_FEATURES_PATH) -> Dict:
+    """Write the catalog's feature matrix and its column names (path + .json)
+
+    The IVF lists next to path were built from the previous vectors and are
+    removed; rebuild them with build_ivf.
+    """
+    n = len(catalog)
+    labels = [catalog.columns["emotion"][i] for i in range(n)]
+    columns = list(TRANSITION_EMOTIONS)
+    tag_postings = catalog.postings["tag"]
+    tag_dims = min(tag_dims, len(tag_postings.values))
+    features = load_features(audio_path)
+    numbers, library_rows = match_tracks(catalog, features) if features is not None else ([], [])
+    audio_dims = len(AUDIO_FEATURES) if len(numbers) else 0
+    partial = path + ".partial"
+    matrix = np.memmap(partial, dtype=np.float32, mode='w+',
+                       shape=(n, len(TRANSITION_EMOTIONS) + tag_dims + audio_dims))
+    matrix[:, :len(TRANSITION_EMOTIONS)] = emotion_affinities(catalog.numbers["valence"],
+                                                              catalog.numbers["arousal"], labels)
+
+    sizes = np.diff(tag_postings.offsets)
+    for dim, code in enumerate(np.argsort(-sizes, kind='stable')[:tag_dims]):
+        columns.append(f"tag:{tag_postings.values[code]}")
+        rows = tag_postings.ids[tag_postings.offsets[code]:tag_postings.offsets[code + 1]]
+        matrix[rows, len(TRANSITION_EMOTIONS) + dim] = VECTOR_TAG_WEIGHT
+
+    if audio_dims:
+        # Standardized over the matched tracks, so no descriptor's unit dominates
+        audio = features["features"][library_rows].astype(np.float32)
+        spread = audio.std(axis=0)
+        audio = (audio - audio.mean(axis=0)) / np.where(spread > 0, spread, 1)
+        matrix[numbers, len(TRANSITION_EMOTIONS) + tag_dims:] = audio * VECTOR_AUDIO_WEIGHT / np.sqrt(audio_dims)
+        columns += [f"audio:{name}" for name in AUDIO_FEATURES]
+
+    for start in range(0, n, VECTOR_BLOCK_ROWS):
+        matrix[start:start + VECTOR_BLOCK_ROWS] = _normalize_rows(matrix[start:start + VECTOR_BLOCK_ROWS])
+    matrix.flush()
+    del matrix
+    # Removed before the new vectors are in place, so no reader pairs them with stale lists
+    ivf_path = ivf_path_for(path)
+    if os.path.exists(ivf_path):
+        os.remove(ivf_path)
+    os.replace(partial, path)
+    return _write_meta(path, n, columns, catalog.version)
+
+def _write_meta(path: str, rows: int, columns: List[str], catalog_version: str = None) -> Dict:
+    # catalog_version ties the rows to the catalog build whose track numbers they follow
+    meta = {"rows": rows, "columns": columns, "catalog_version": catalog_version}
+    # Written after the matrix, and replaced atomically, so its version marks a complete build
+    with open(path + ".json.partial", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".json.partial", path + ".json")
+    return meta
+
+def save_vectors(matrix: np.ndarray, columns: List[str], path: str = VECTORS_PATH) -> Dict:
+    """Write an already normalized feature matrix in the memory-mappable layout"""
+    np.ascontiguousarray(matrix, dtype=np.float32).tofile(path + ".partial")
+    os.replace(path + ".partial", path)
+    return _write_meta(path, len(matrix), columns)
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Columns and scores of the k best scores of each row, best first"""
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k else np.zeros((len(scores), 0), dtype=np.int64)
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+class VectorIndex:
+    def __init__(self, path: str = VECTORS_PATH, ivf_path: Optional[str] = IVF_PATH):
+        self.version = index_version(path, ivf_path)
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]
+        self.catalog_version = meta.get("catalog_version")
+        self.vectors = np.memmap(path, dtype=np.float32, mode='r', shape=(meta["rows"], len(self.columns)))
+        self.ivf = None
+        if ivf_path and os.path.exists(ivf_path):
+            with np.load(ivf_path) as ivf:
+                ivf = {name: ivf[name] for name in ("centroids", "offsets", "ids")}
+            # Lists built from other vectors (a different width or row count) would return wrong tracks
+            if ivf["centroids"].shape[1] == len(self.columns) and len(ivf["ids"]) == len(self.vectors):
+                self.ivf = ivf
+            else:
+                print(f"Ignoring {ivf_path}: it was built for other vectors; rebuild it with build_ivf")
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def matches(self, catalog: Catalog) -> bool:
+        """Whether row i is catalog track i; older builds without a catalog version only check the size"""
+        if self.catalog_version:
+            return self.catalog_version == catalog.version
+        return len(self) == len(catalog)
+
+    def query_vector(self, emotion_probabilities: Dict[str, float],
+                     preference: Optional[np.ndarray] = None, preference_weight: float = 0.5) -> np.ndarray:
+        """Normalized query from emotion probabilities and an optional preference vector"""
+        query = np.zeros(len(self.columns), dtype=np.float32)
+        for i, emotion in enumerate(TRANSITION_EMOTIONS):
+            query[i] = emotion_probabilities.get(emotion, 0.0)
+        query = _normalize_rows(query)
+        if preference is not None and np.any(preference):
+            query = _normalize_rows((1 - preference_weight) * query + preference_weight * _normalize_rows(preference))
+        return query
+
+    def preference_vector(self, track_numbers: np.ndarray) -> np.ndarray:
+        """Mean vector of tracks a user likes (e.g. their preferred artist's top tracks)"""
+        if len(track_numbers) == 0:
+            return np.zeros(len(self.columns), dtype=np.float32)
+        return _normalize_rows(np.asarray(self.vectors[np.sort(track_numbers)]).mean(axis=0))
+
+    def search(self, queries: np.ndarray, k: int = 10,
+               candidates: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Exact top k (track numbers, cosine scores) per query row, best first
+
+        candidates (ascending track numbers, e.g. a catalog posting)
+        restricts the search to those tracks.
+        """
+        queries = np.atleast_2d(queries).astype(np.float32)
+        if candidates is not None:
+            columns, scores = _top_k(queries @ np.asarray(self.vectors[candidates]).T, k)
+            return np.asarray(candidates)[columns], scores
+
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.vectors), VECTOR_BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + VECTOR_BLOCK_ROWS])
+            columns, scores = _top_k(queries @ block.T, k)
+            # Merge this block's top k into the running top k
+            merged_ids = np.concatenate([best_ids, columns + start], axis=1)
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            columns, best_scores = _top_k(merged_scores, k)
+            best_ids = np.take_along_axis(merged_ids, columns, axis=1)
+        return best_ids, best_scores
+
+    def search_ivf(self, queries: np.ndarray, k: int = 10,
+                   probes: int = IVF_PROBES) -> Tuple[np.ndarray, np.ndarray]:
+        """Approximate top k: exact scores over the rows of the probes nearest lists"""
+        if self.ivf is None:
+            return self.search(queries, k)
+        queries = np.atleast_2d(queries).astype(np.float32)
+        centroids, offsets, list_ids = self.ivf["centroids"], self.ivf["offsets"], self.ivf["ids"]
+        nearest = np.argsort(-(queries @ centroids.T), axis=1)[:, :probes]
+        results_ids, results_scores = [], []
+        for query, lists in zip(queries, nearest):
+            rows = np.sort(np.concatenate([list_ids[offsets[c]:offsets[c + 1]] for c in lists]))
+            ids, scores = self.search(query, k, candidates=rows)
+            results_ids.append(ids[0])
+            results_scores.append(scores[0])
+        return np.stack(results_ids), np.stack(results_scores)
+
+def build_ivf(path: str = VECTORS_PATH, ivf_path: str = IVF_PATH, lists: int = IVF_LISTS,
+              iterations: int = 10, sample: int = 100000, seed: int = 0) -> Dict:
+    """Cluster the vectors with spherical k-means (fitted on a sample) and write the lists"""
+    index = VectorIndex(path, ivf_path=None)
+    vectors = index.vectors
+    rng = np.random.default_rng(seed)
+    lists = min(lists, len(vectors))
+    fit_rows = np.sort(rng.choice(len(vectors), size=min(sample, len(vectors)), replace=False))
+    fit = np.asarray(vectors[fit_rows])
+    centroids = fit[rng.choice(len(fit), size=lists, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(fit @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, fit)
+        empty = np.bincount(assignment, minlength=lists) == 0
+        # Reseed empty lists with random sample rows
+        sums[empty] = fit[rng.choice(len(fit), size=int(empty.sum()))]
+        centroids = _normalize_rows(sums)
+
+    assignment = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), VECTOR_BLOCK_ROWS):
+        block = np.asarray(vectors[start:start + VECTOR_BLOCK_ROWS])
+        assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.zeros(lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignment, minlength=lists), out=offsets[1:])
+    partial = ivf_path + ".partial.npz"
+    np.savez(partial, centroids=centroids.astype(np.float32), offsets=offsets, ids=order.astype(np.int32))
+    os.replace(partial, ivf_path)
+    sizes = np.diff(offsets)
+    return {"lists": lists, "largest": int(sizes.max()), "empty": int((sizes == 0).sum())}
+
+def index_version(path: str = VECTORS_PATH, ivf_path: Optional[str] = IVF_PATH) -> str:
+    """Changes whenever the vectors or the IVF lists are rebuilt; "" if there are no vectors"""
+    meta = file_version(path + ".json")
+    return f"{meta}/{file_version(ivf_path) if ivf_path else ''}" if meta else ""
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+def get_vector_index(path: str = VECTORS_PATH, catalog: Catalog = None) -> Optional[VectorIndex]:
+    """The catalog's vector index, mapped once per process and again when it is rebuilt; None if it was not built
+
+    With catalog, also None while the vectors belong to another build of the
+    catalog (between ingest-catalog replacing the index and rebuilding the
+    vectors), whose track numbers would not match.
+    """
+    ivf_path = ivf_path_for(path)
+    version = index_version(path, ivf_path)
+    with _index_lock:
+        cached = _indexes.get(path)
+        if cached is None or cached[0] != version:
+            try:
+                _indexes[path] = (version, VectorIndex(path, ivf_path) if version else None)
+            except Exception as e:
+                print(f"Error loading vector index: {e}")
+                _indexes[path] = (version, None)
+        index = _indexes[path][1]
+    if index is not None and catalog is not None and not index.matches(catalog):
+        return None
+    return index